@@ -1,18 +1,33 @@
 REM Postprocess the snow-on point cloud
 
-REM Perform ground filtering with cloth simulation filter (see Scripts\Filter_CSF.R for usage information)
+REM Perform ground filtering with cloth simulation filter (see Scripts\Filter_CSF.py for usage information)
 REM Here, allow steep slope processing and set classification threshhold to 0.01 (for aggressive filtering)
-RScript Scripts\Filter_CSF.R "Data\SnowOnSfMData\SnowOnGround.laz" TRUE 0.01 filtered
+REM The intermediate clouds are written in the (uncompressed) npc format, and only the final clouds as LAZ (see Scripts\npc.py)
+python Scripts\Filter_CSF.py -f npc "Data\SnowOnSfMData\SnowOnGround.laz" TRUE 0.01 filtered
+
+REM Build spatial indexes of the reference clouds (only the first time, or if they change; see Scripts\spatial_index.py)
+python Scripts\spatial_index.py "Data\SnowOffSfMData\SnowOffGround_filtered.laz" "Data\SnowOffSfMData\SnowOffCanopy.laz"
 
 REM Remove any large vertical offset between SfM and reference point cloud
-python Scripts\RemoveVerticalOffset.py -a "Data\SnowOnSfMData\SnowOnCanopy.laz" "Data\SnowOnSfMData\SnowOnGround_filtered.laz" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" corrected
+python Scripts\RemoveVerticalOffset.py -f npc -a "Data\SnowOnSfMData\SnowOnCanopy.laz" "Data\SnowOnSfMData\SnowOnGround_filtered.npc" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" corrected
 
-REM Use CloudCompare's Iterative Closest Point Algorithm to match the point clouds using the reference canopy points
-python Scripts\ICP.py -a "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.laz" "Data\SnowOnSfMData\SnowOnCanopy_corrected.laz" "Data\SnowOffSfMData\SnowOffCanopy.laz" None
+REM Use an Iterative Closest Point Algorithm to match the point clouds using the reference canopy points
+python Scripts\ICP.py -a "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.npc" "Data\SnowOnSfMData\SnowOnCanopy_corrected.npc" "Data\SnowOffSfMData\SnowOffCanopy.laz" None
 
 REM Clamp the model to the ground surface (but first adding a first guess for snow thickness)
 REM First, use a 1st order polynomial model to remove tilting in the model
-python Scripts\dewarp_model.py -r -d "Data\FirstGuessSnowDepth\FirstGuess.tif" -a "Data\SnowOnSfMData\SnowOnCanopy_corrected.laz" "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.laz" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" 1 None
+python Scripts\dewarp_model.py -r -d "Data\FirstGuessSnowDepth\FirstGuess.tif" -a "Data\SnowOnSfMData\SnowOnCanopy_corrected.npc" "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.npc" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" 1 None
 
 REM Next, use a 2nd order polynomial model to remove and warping in the model (such as dome or bowl effect)
-python Scripts\dewarp_model.py -r -d "Data\FirstGuessSnowDepth\FirstGuess.tif" -a "Data\SnowOnSfMData\SnowOnCanopy_corrected.laz" "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.laz" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" 2 None
+REM (writing the final clouds as LAZ)
+python Scripts\dewarp_model.py -r -f laz -d "Data\FirstGuessSnowDepth\FirstGuess.tif" -a "Data\SnowOnSfMData\SnowOnCanopy_corrected.npc" "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.npc" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" 2 None
+
+REM Compute snow depth rasters (count, mean, median and standard deviation) at several resolutions (see Scripts\snow_depth.py)
+python Scripts\snow_depth.py "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.laz" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" "Data\SnowOnSfMData\SnowDepth"
+
+REM To follow a whole season, append the corrected ground cloud of each flight to a data cube of differences from the reference
+REM ground cloud as the flights arrive (see Scripts\stack.py), e.g.:
+REM python Scripts\stack.py -d 2020-02-15 "Data\SnowOnSfMData\Season.nc" "Data\SnowOffSfMData\SnowOffGround_filtered.laz" "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.laz"
+
+REM Remove the intermediate clouds
+del "Data\SnowOnSfMData\SnowOnGround_filtered.npc" "Data\SnowOnSfMData\SnowOnGround_filtered_corrected.npc" "Data\SnowOnSfMData\SnowOnCanopy_corrected.npc"
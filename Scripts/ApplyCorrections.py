@@ -0,0 +1,78 @@
+import sys, os
+from osgeo import gdal
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from apply_correction import apply_correction_to_clouds, report_results
+from correction_chain import CorrectionChain
+from backends import get_backend, backends
+from tracing import start_trace
+
+# Applies a chain of corrections (as built up by running RemoveVerticalOffset.py, ICP.py and dewarp_model.py with the
+# -c/--chain option) to one or more point clouds, in a single read/write pass per cloud.  This avoids writing (and
+# re-reading) an intermediate cloud after each correction step.
+#
+# Usage: ApplyCorrections.py <options> <Chain File> <Suffix> <Cloud 1> <Cloud 2> ...
+#
+# Chain File: Path to the correction chain file (see correction_chain.py)
+# Suffix: suffix to be added to the outputted las files (Warning, if set to "None", will overwrite the input files!)
+# Cloud 1, Cloud 2, ...: Paths to the point clouds to correct
+# Options:
+# -w, --workers: Number of clouds to correct at the same time (defaults to the number of cores)
+# -b, --backend: Backend that corrects the clouds: native (the default), fusion (FUSION's ClipData and CloudCompare, which
+#       must be on the system path) or stub (only prints the commands the fusion backend would run), see backends.py
+# --retries: Number of times to run an external program again if it fails (fusion and stub backends, defaults to 0)
+# --fail_fast: Stop correcting clouds as soon as one fails (by default, the other clouds are still corrected)
+# -f, --format: Format of the output clouds: laz, las or npc (an uncompressed, memory-mapped format for intermediate clouds,
+#       see npc.py).  Defaults to npc for .npc input clouds and laz otherwise
+# --trace: Write a trace of the time, memory and points processed by each step to this file (JSON lines, or Chrome trace
+#       format if it ends in .json; see tracing.py)
+#
+# A file describing the corrections that were applied is written next to each output cloud (<output cloud>_correction.json)
+#
+# Note that in addition to the dependencies listed above, this code requires the laspy library
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] chain_file suffix input_file(s)'
+    p = OptionParser(usage)
+    p.add_option('-w', '--workers', dest='workers', type='int', help='Number of clouds to correct at the same time (defaults to the number of cores)')
+    p.add_option('-b', '--backend', dest='backend', type='choice', choices=list(backends), default='native', help='Backend that corrects the clouds (native, fusion or stub)')
+    p.add_option('--retries', dest='retries', type='int', default=0, help='Number of times to run a failed external program again')
+    p.add_option('--fail_fast', dest='fail_fast', action='store_true', help='Stop as soon as a cloud fails')
+    p.add_option('-f', '--format', dest='format', type='choice', choices=['laz', 'las', 'npc'], help='Format of the output clouds (laz, las or npc)')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    argv = gdal.GeneralCmdLineProcessor( sys.argv )
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    start_trace(options.trace)
+    if len(args) < 3:
+        parser.print_help()
+        sys.exit(1)
+    chain_file = args[0]            # Correction chain file
+    out_suffix = args[1]            # Output file suffix (for saved files)
+    clouds = args[2:]               # Point clouds to correct
+
+    # Check for the existance of the chain file and the input clouds
+    path_errors = False
+    for path in [chain_file] + clouds:
+        if not os.path.exists(path):
+            print('Error: ' + path + ' does not exist!')
+            path_errors = True
+    if path_errors == True:
+        sys.exit(1)
+
+    # Apply the chain of corrections to all of the clouds (all at the same time)
+    chain = CorrectionChain.load(chain_file)
+    print('Applying ' + str(len(chain)) + ' correction steps to ' + ', '.join(clouds))
+    backend = get_backend(options.backend, retries=options.retries)
+    results = apply_correction_to_clouds(clouds, out_suffix, workers=options.workers, output_format=options.format, chain=chain,
+                                         sidecar=True, backend=backend, fail_fast=bool(options.fail_fast))
+    if not report_results(results):
+        sys.exit(1)
@@ -0,0 +1,83 @@
+import sys, os
+from osgeo import gdal
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from point_io import read_cloud, write_cloud
+from csf import csf
+from tracing import start_trace, stage
+
+# Python code to run the Cloth Simulation Filter (CSF; Zhang et al., 2016) algorithm to perform ground filtering (see csf.py)
+#
+# Usage: python Filter_CSF.py <options> <Input Cloud> <sloop_smooth> <class_threshold> <Suffix>
+#
+# Input Cloud: Path to input point cloud
+# sloop_smooth: When steep slopes exist, set this parameter to TRUE to reduce errors during post-processing
+# class_threshold: The distance to the simulated cloth to classify a point cloud into ground and non-ground
+# Suffix: suffix to be added to the outputted las file (Warning, if set to "None", will overwrite the input file!)
+# Options:
+# -r, --cloth_resolution: The distance between particles in the cloth (defaults to 0.5)
+# -i, --rigidness: The rigidness of the cloth (1 to 3, defaults to 1)
+# -w, --workers: Number of threads used to update the cloth (defaults to the number of cores)
+# -f, --format: Format of the output cloud: laz, las or npc (an uncompressed, memory-mapped format for intermediate clouds,
+#       see npc.py).  Defaults to that of the input cloud
+# --trace: Write a trace of the time, memory and points processed by each step to this file (JSON lines, or Chrome trace
+#       format if it ends in .json; see tracing.py)
+#
+# Note that in addition to the dependencies listed above, this code requires the laspy and scipy libraries
+
+# Function to filter the ground points of an in-memory point cloud (a laspy LasData object), returning the ground points
+# (classified as ground, as lidR's lasground does)
+def filter_ground(las, sloop_smooth=False, class_threshold=0.5, **kwargs):
+    with stage('csf', sloop_smooth=sloop_smooth, class_threshold=class_threshold) as record:
+        record['points'] = len(las.points)
+        ground = csf(las.x, las.y, las.z, sloop_smooth=sloop_smooth, class_threshold=class_threshold, **kwargs)
+    las = las[ground]
+    las.classification = np.full(len(las.points), 2, dtype=np.uint8)
+    return las
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] input_file sloop_smooth class_threshold suffix'
+    p = OptionParser(usage)
+    p.add_option('-r', '--cloth_resolution', dest='cloth_resolution', type='float', default=0.5, help='Distance between particles in the cloth')
+    p.add_option('-i', '--rigidness', dest='rigidness', type='int', default=1, help='Rigidness of the cloth (1 to 3)')
+    p.add_option('-w', '--workers', dest='workers', type='int', help='Number of threads used to update the cloth (defaults to the number of cores)')
+    p.add_option('-f', '--format', dest='format', type='choice', choices=['laz', 'las', 'npc'], help='Format of the output cloud (laz, las or npc)')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    argv = gdal.GeneralCmdLineProcessor( sys.argv )
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    start_trace(options.trace)
+    if len(args) < 4:
+        parser.print_help()
+        sys.exit(1)
+    infname = args[0]                                   # Input point cloud
+    sloop_smooth = args[1].lower() == 'true'            # Slope post-processing
+    class_threshold = float(args[2])                    # Classification threshold
+    out_suffix = args[3]                                # Output file suffix (for saved files)
+
+    if not os.path.exists(infname):
+        print('Error: ' + infname + ' does not exist!')
+        sys.exit(1)
+
+    # Name the output file (depending on whether a suffix to be added)
+    extension = '.' + options.format if options.format != None else os.path.splitext(infname)[1]
+    if out_suffix != 'None':
+        ofname = os.path.splitext(infname)[0] + '_' + out_suffix + extension
+    else:
+        ofname = os.path.splitext(infname)[0] + extension
+
+    # Perform CSF filter, and only write out the ground returns
+    lidardata = read_cloud(infname)
+    lidarsubset = filter_ground(lidardata, sloop_smooth, class_threshold, cloth_resolution=options.cloth_resolution,
+                                rigidness=options.rigidness, workers=options.workers)
+    print('Classified ' + str(len(lidarsubset.points)) + ' of ' + str(len(lidardata.points)) + ' points as ground')
+    write_cloud(lidarsubset, ofname)
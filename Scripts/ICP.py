@@ -1,95 +1,150 @@
-import sys, os, shutil
-import subprocess
-from osgeo import gdal
-from osgeo.gdalconst import *
-sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
-from GeoRefPars import GeoRefPars
-
-# Uses CloudCompare's Iterative Closest Point (ICP) Algorithm to match a canopy point cloud with uncertain georeferncing with
-# a refernce canopy point cloud (requires that the clouds match up reasonably closely in both the horizontal and vertical)
-# See http://www.cloudcompare.org/doc/wiki/index.php?title=ICP for ICP filter documentation
-#
-# Usage: ICP.py <options> <Input Cloud> <Reference Cloud> <Suffix>
-#
-# Input Cloud: Path to input canopy point cloud
-# Refernce Cloud: Path to the reference ground point cloud
-# Suffix: suffix to be added to the outputted las file (Warning, if set to "None", will overwrite the input file!)
-# Options: 
-# -a, --additional_clouds: Specfies additional clouds (separated by commas) to perform the same adjustment for (for example, 
-#       to adjust a point cloud containing ground points using the same adjustment that is applied to the canopy point cloud)
-# 
-# Note that in addition to the dependencies listed above, this code assumes that CloudCompare is installed and that it is 
-# accessable via the command line (e.g. on the system path), as this script makes subprocess calls to its command line mode
-#
-# Created by Patrick Broxton
-# Updated 6/30/2020
-
-# Read the georeferencing information and fusion parameters
-(crs, fusion_parameters, cellsize) = GeoRefPars()
-
-# Optional parameters
-def optparse_init():
-    """Prepare the option parser for input (argv)"""
-
-    from optparse import OptionParser, OptionGroup
-    usage = 'Usage: %prog [options] input_file(s) [output]'
-    p = OptionParser(usage)
-    p.add_option('-a', '--additional_clouds', dest='additional_clouds', help='Additional clouds to apply the correction to')
-    return p
-    
-if __name__ == '__main__':
-
-    # Parse the command line arguments      
-    argv = gdal.GeneralCmdLineProcessor( sys.argv ) 
-    parser = optparse_init()
-    options,args = parser.parse_args(args=argv[1:])
-    incloud_canopy = args[0]        # Input canopy point cloud
-    ref_cloud_canopy = args[1]      # Bare earth canopy surface file
-    out_suffix = args[2]        	# Output file suffix (for saved files)
-    additional_clouds = options.additional_clouds
-    
-    # Check for the existance of the input and reference clouds
-    path_errors = False
-    if not os.path.exists(incloud_canopy):
-        print('Error: ' + incloud_canopy + ' does not exist!')
-        path_errors = True
-    if not os.path.exists(ref_cloud_canopy):
-        print('Error: ' + ref_cloud_canopy + ' does not exist!')
-        path_errors = True
-    if path_errors == True:
-        sys.exit()
-        
-    # Name the output file (depending on whether a suffix to be added)
-    if out_suffix == 'None':
-        outcloud = incloud_canopy[:-4] + '.laz'
-    else: 
-        outcloud = incloud_canopy[:-4] + '_' + out_suffix + '.laz'
-    
-    # Perform CloudCompare's ICP Algorithm to match the input cloud to the reference cloud
-    cmd = 'CloudCompare -SILENT -C_EXPORT_FMT LAS -AUTO_SAVE OFF -O -GLOBAL_SHIFT AUTO "' + incloud_canopy + '" -O -GLOBAL_SHIFT AUTO "' + ref_cloud_canopy + '" -ICP -FARTHEST_REMOVAL -POP_CLOUDS -SAVE_CLOUDS File "' + outcloud + '"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)    
-    
-    # Apply the same adjustment to any additional point clouds
-    if additional_clouds != None:
-        AdditionalClouds = additional_clouds.split(',')
-        
-        # Find and read in the registration matrix file produced by the ICP algorithm
-        for fname in os.listdir(os.path.dirname(incloud_canopy)): 
-            if 'REGISTRATION_MATRIX' in fname:
-                registration_matrix_file = os.path.dirname(incloud_canopy) + '/' + fname
-                
-        for incloud in AdditionalClouds:
-            # If necissary, apply a suffix to these additional clouds
-            if out_suffix == 'None':
-                outcloud = incloud[:-4] + '.laz'
-            else: 
-                outcloud = incloud[:-4] + '_' + out_suffix + '.laz'
-                
-            # Apply the same transformation from the registration matrix file    
-            cmd = 'CloudCompare -SILENT -C_EXPORT_FMT LAS -AUTO_SAVE OFF -O -GLOBAL_SHIFT AUTO "' + incloud + '" -APPLY_TRANS "' + registration_matrix_file + '" -SAVE_CLOUDS File "' + outcloud + '"'
-            print(cmd)
-            subprocess.call(cmd, shell=True)
-    
-    # Remove the registration matrix file
-    os.remove(registration_matrix_file)
\ No newline at end of file
+import sys, os
+from osgeo import gdal
+from osgeo.gdalconst import *
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from point_io import read_points
+from spatial_index import indexed_points
+import icp_engine
+from apply_correction import apply_correction_to_clouds, report_results
+from correction_chain import CorrectionChain
+from tracing import start_trace, stage
+
+# Uses an Iterative Closest Point (ICP) Algorithm to match a canopy point cloud with uncertain georeferncing with a refernce
+# canopy point cloud (requires that the clouds match up reasonably closely in both the horizontal and vertical).  The ICP
+# algorithm runs in-process (see icp_engine.py), and works much like CloudCompare's ICP with farthest point removal
+# See http://www.cloudcompare.org/doc/wiki/index.php?title=ICP for CloudCompare's ICP filter documentation
+#
+# Usage: ICP.py <options> <Input Cloud> <Reference Cloud> <Suffix>
+#
+# Input Cloud: Path to input canopy point cloud
+# Refernce Cloud: Path to the reference ground point cloud
+# Suffix: suffix to be added to the outputted las file (Warning, if set to "None", will overwrite the input file!)
+# Options: 
+# -a, --additional_clouds: Specfies additional clouds (separated by commas) to perform the same adjustment for (for example, 
+#       to adjust a point cloud containing ground points using the same adjustment that is applied to the canopy point cloud)
+# -c, --chain: Correction chain file (see correction_chain.py). If given, the input cloud is read with the corrections already in
+#       the chain applied, the estimated correction is added to the chain, and no clouds are written (use ApplyCorrections.py to
+#       apply all of the corrections in the chain at once)
+# -w, --workers: Number of clouds to correct at the same time (the input cloud and any additional clouds are corrected in
+#       parallel; defaults to the number of cores)
+# -m, --mode: ICP mode, either point_to_point (the default, as in CloudCompare) or point_to_plane
+# -i, --iterations: Maximum number of ICP iterations
+# -t, --tolerance: Stop iterating once the RMS distance improves by less than this amount
+# -n, --max_points: Number of (randomly sampled) input points to use for the registration
+# -p, --pyramid: Number of levels of a coarse-to-fine registration.  Both clouds are first registered after voxel thinning
+#       them (see thinning.py) to a voxel size of voxel_size * 2**(levels-2), and each finer level (halving the voxel size, up
+#       to full resolution) starts from the previous level's registration.  This is faster, and handles larger initial
+#       misalignments, than a single registration at full resolution (defaults to 1, a single registration)
+# --voxel_size: Voxel size of the finest thinned level of the coarse-to-fine registration (defaults to 1)
+# -f, --format: Format of the output clouds: laz, las or npc (an uncompressed, memory-mapped format for intermediate clouds,
+#       see npc.py).  Defaults to npc for .npc input clouds and laz otherwise
+# --trace: Write a trace of the time, memory and points processed by each step to this file (JSON lines, or Chrome trace
+#       format if it ends in .json; see tracing.py)
+# 
+# Note that in addition to the dependencies listed above, this code requires the laspy and scipy libraries
+#
+# Created by Patrick Broxton
+# Updated 6/30/2020
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Margin (around the input cloud) within which reference points are used for the registration
+search_margin = 10
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] input_file(s) [output]'
+    p = OptionParser(usage)
+    p.add_option('-a', '--additional_clouds', dest='additional_clouds', help='Additional clouds to apply the correction to')
+    p.add_option('-c', '--chain', dest='chain', help='Correction chain file to add the correction to (instead of correcting the clouds)')
+    p.add_option('-w', '--workers', dest='workers', type='int', help='Number of clouds to correct at the same time (defaults to the number of cores)')
+    p.add_option('-m', '--mode', dest='mode', default='point_to_point', help='ICP mode (point_to_point or point_to_plane)')
+    p.add_option('-i', '--iterations', dest='iterations', type='int', default=icp_engine.max_iterations, help='Maximum number of iterations')
+    p.add_option('-t', '--tolerance', dest='tolerance', type='float', default=icp_engine.tolerance, help='Minimum RMS improvement between iterations')
+    p.add_option('-n', '--max_points', dest='max_points', type='int', default=icp_engine.max_points, help='Number of input points used for the registration')
+    p.add_option('-p', '--pyramid', dest='pyramid', type='int', default=1, help='Number of levels of a coarse-to-fine registration')
+    p.add_option('--voxel_size', dest='voxel_size', type='float', default=icp_engine.pyramid_voxel_size, help='Voxel size of the finest thinned level')
+    p.add_option('-f', '--format', dest='format', type='choice', choices=['laz', 'las', 'npc'], help='Format of the output clouds (laz, las or npc)')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    return p
+    
+if __name__ == '__main__':
+
+    # Parse the command line arguments      
+    argv = gdal.GeneralCmdLineProcessor( sys.argv ) 
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    start_trace(options.trace)
+    incloud_canopy = args[0]        # Input canopy point cloud
+    ref_cloud_canopy = args[1]      # Bare earth canopy surface file
+    out_suffix = args[2]        	# Output file suffix (for saved files)
+    additional_clouds = options.additional_clouds
+    
+    # Check for the existance of the input and reference clouds
+    path_errors = False
+    if not os.path.exists(incloud_canopy):
+        print('Error: ' + incloud_canopy + ' does not exist!')
+        path_errors = True
+    if not os.path.exists(ref_cloud_canopy):
+        print('Error: ' + ref_cloud_canopy + ' does not exist!')
+        path_errors = True
+    if path_errors == True:
+        sys.exit()
+        
+    # If specified, load the chain of corrections estimated so far (the input cloud is read with these applied)
+    chain = None
+    if options.chain != None:
+        chain = CorrectionChain.load(options.chain)
+    
+    # Read a random sample of the input cloud and the reference cloud (only the part that overlaps the input cloud, which is
+    # all that is read if the reference cloud has a spatial index, see spatial_index.py)
+    with stage('read_points', cloud=incloud_canopy) as record:
+        source = read_points(incloud_canopy, max_points=options.max_points, chain=chain)
+        record['points_kept'] = len(source)
+    if len(source) == 0:
+        print('Error: ' + incloud_canopy + ' does not contain any points!')
+        sys.exit(1)
+    (xmin, ymin) = source[:, :2].min(axis=0)
+    (xmax, ymax) = source[:, :2].max(axis=0)
+    extent = (xmin - search_margin, ymin - search_margin, xmax + search_margin, ymax + search_margin)
+    with stage('read_points', cloud=ref_cloud_canopy) as record:
+        reference = indexed_points(ref_cloud_canopy, extent)
+        record['points_kept'] = len(reference)
+    if len(reference) == 0:
+        print('Error: the input and reference clouds do not overlap!')
+        sys.exit(1)
+    
+    # Perform the ICP Algorithm to match the input cloud to the reference cloud
+    print('Registering ' + incloud_canopy + ' to ' + ref_cloud_canopy + ' (' + options.mode + ')')
+    # (coarse to fine, if specified)
+    with stage('icp', mode=options.mode, levels=options.pyramid) as record:
+        levels = icp_engine.pyramid_levels(options.pyramid, options.voxel_size)
+        (T, rms, iterations) = icp_engine.pyramid_icp(source, reference, levels, mode=options.mode,
+                                                      max_iterations=options.iterations, tolerance=options.tolerance,
+                                                      farthest_removal=True, max_points=options.max_points)
+        record.update({'points': len(source), 'reference_points': len(reference), 'rms': rms, 'iterations': iterations})
+    print('Final RMS: ' + str(rms) + ' after ' + str(iterations) + ' iterations')
+    print('Registration matrix:')
+    print(np.array2string(T, precision=6, suppress_small=True))
+    
+    # If using a correction chain, add the transformation to it
+    if chain != None:
+        chain.add_matrix(T)
+        chain.save(options.chain)
+        print('Added the registration matrix to ' + options.chain)
+        
+    # Otherwise, apply the transformation to the input cloud and any additional point clouds (all at the same time)
+    else:
+        clouds = [incloud_canopy]
+        if additional_clouds != None:
+            clouds += additional_clouds.split(',')
+        print('Applying the registration matrix to ' + ', '.join(clouds))
+        results = apply_correction_to_clouds(clouds, out_suffix, workers=options.workers, output_format=options.format, matrix=T)
+        if not report_results(results):
+            sys.exit(1)
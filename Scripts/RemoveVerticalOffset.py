@@ -1,167 +1,175 @@
-import sys, os, shutil
-import subprocess
-from osgeo import gdal
-from osgeo.gdalconst import *
-import tempfile
-import numpy as np
-sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
-from GeoRefPars import GeoRefPars
-
-# Removes vertical offset for an for a ground point cloud with uncertain georeferncing by comparing its elevation with
-# that from reference ground point cloud (requires that the clouds match up reasonably closely in the horizontal)
-#
-# Usage: RemoveVerticalOffset.py <options> <Input Cloud> <Reference Cloud> <Suffix>
-#
-# Input Cloud: Path to input ground point cloud
-# Refernce Cloud: Path to the reference ground point cloud
-# Suffix: suffix to be added to the outputted las file (Warning, if set to "None", will overwrite the input file!)
-# Options: 
-# -a, --additional_clouds: Specfies additional clouds (separated by commas) to perform the same adjustment for (for example, 
-#       to adjust a point cloud containing canopy points using the same adjustment that is applied to the ground point cloud)
-# 
-# Note that in addition to the dependencies listed above, this code assumes that the gdal and Fusion command line tools are 
-# installed and are accessable via the command line (e.g. on the system path), as this script makes subprocess calls to them
-#
-# Created by Patrick Broxton
-# Updated 6/30/2020
-
-# Read the georeferencing information and fusion parameters
-(crs, fusion_parameters, cellsize) = GeoRefPars()
-
-# Optional parameters
-def optparse_init():
-    """Prepare the option parser for input (argv)"""
-
-    from optparse import OptionParser, OptionGroup
-    usage = 'Usage: %prog [options] input_file(s) [output]'
-    p = OptionParser(usage)
-    p.add_option('-a', '--additional_clouds', dest='additional_clouds', help='Additional clouds to apply the correction to')
-    return p
-    
-if __name__ == '__main__':
-
-    # Parse the command line arguments      
-    argv = gdal.GeneralCmdLineProcessor( sys.argv ) 
-    parser = optparse_init()
-    options,args = parser.parse_args(args=argv[1:])
-    incloud_ground = args[0]        # Input ground point cloud
-    ref_cloud_ground = args[1]      # Reference ground surface file
-    out_suffix = args[2]        	# Output file suffix (for saved files)
-    additional_clouds = options.additional_clouds
-    
-    # Check for the existance of the input and reference clouds
-    path_errors = False
-    if not os.path.exists(incloud_ground):
-        print('Error: ' + incloud_ground + ' does not exist!')
-        path_errors = True
-    if not os.path.exists(ref_cloud_ground):
-        print('Error: ' + ref_cloud_ground + ' does not exist!')
-        path_errors = True 
-    if path_errors == True:
-        sys.exit()
-        
-    # Create a temporary working directory`
-    working_dir = tempfile.mktemp()
-    if not os.path.exists(working_dir):
-        os.makedirs(working_dir)
-        
-    # Create Surface files for the SFM ground point cloud in the temporary directory (using Fusion's GridSurfaceCreate program)
-    cmd = 'GridSurfaceCreate "' + working_dir + '/surf_sfm.dtm" ' + str(cellsize) + ' ' + fusion_parameters + ' "' + incloud_ground + '"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Convert from dtm format to asc format (so it can be read by gdal)
-    cmd = 'DTM2ASCII "' + working_dir + '/surf_sfm.dtm" "' + working_dir + '/surf_sfm.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Assign georeferencing information using a gdal virtual raster layer
-    cmd = 'gdalbuildvrt -a_srs "EPSG:' + str(crs) + '" "' + working_dir + '/surf_sfm.vrt" "' + working_dir + '/surf_sfm.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-
-    # Open the dataset
-    inDs = gdal.Open(working_dir + '/surf_sfm.vrt')
-    if inDs is None:
-        print('Could not open ' + working_dir + '/surf_sfm.vrt')
-        sys.exit(1)
-    
-    # Get raster characteristics
-    width = inDs.RasterXSize
-    height = inDs.RasterYSize
-    gt = inDs.GetGeoTransform()
-    ulx = gt[0]
-    lry = gt[3] + width*gt[4] + height*gt[5] 
-    lrx = gt[0] + width*gt[1] + height*gt[2]
-    uly = gt[3] 
-    dx = gt[1]
-    dy = -gt[5]
-    
-    # Read the ground surface file
-    band = inDs.GetRasterBand(inDs.RasterCount)    
-    sfm_z = band.ReadAsArray()
-    sfm_z[sfm_z == band.GetNoDataValue()] = np.nan
-    inDs = None
-    
-    # Create Surface files for the reference point cloud in the temporary directory (using Fusion's GridSurfaceCreate program)
-    cmd = 'GridSurfaceCreate "' + working_dir + '/surf_lidar.dtm" ' + str(cellsize) + ' ' + fusion_parameters + ' "' + ref_cloud_ground + '"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Convert from dtm format to asc format (so it can be read by gdal)    
-    cmd = 'DTM2ASCII "' + working_dir + '/surf_lidar.dtm" "' + working_dir + '/surf_lidar.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Assign georeferencing information using a gdal virtual raster layer
-    te_str = str(ulx) + ' ' + str(lry) + ' ' + str(lrx) + ' ' + str(uly)
-    cmd = 'gdalbuildvrt -te ' + te_str + ' -a_srs "EPSG:' + str(crs) + '" "' + working_dir + '/surf_lidar.vrt" "' + working_dir + '/surf_lidar.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Open the dataset
-    inDs2 = gdal.Open(working_dir + '/surf_lidar.vrt')
-    if inDs2 is None:
-        print('Could not open ' + working_dir + '/surf_lidar.vrt')
-        sys.exit(1)
-    
-    # Read the reference cloud
-    band = inDs2.GetRasterBand(inDs2.RasterCount)    
-    lidar_z = band.ReadAsArray()
-    lidar_z[lidar_z == band.GetNoDataValue()] = np.nan
-    inDs2 = None
-    
-    # Figure out the average difference
-    diff = sfm_z - lidar_z
-    vcorr = np.nanmean(diff)
-    
-    # Name the output file (depending on whether a suffix to be added)
-    if out_suffix == 'None':
-        outcloud = incloud_ground[:-4] + '.laz'
-    else: 
-        outcloud = incloud_ground[:-4] + '_' + out_suffix + '.laz'
-        
-    # Apply the vertical offset to the input point cloud (using Fusion's clipdata program)
-    cmd = 'clipdata /height /biaselev:' + str(-vcorr) + ' "' + incloud_ground + '" "' + outcloud + '" ' + str(ulx) + ' ' + str(lry) + ' ' + str(lrx) + ' ' + str(uly)
-    print(cmd)
-    subprocess.call(cmd, shell=True)    
-    
-    # Apply the same vertical offset to any additional point clouds
-    if additional_clouds != None:
-        AdditionalClouds = additional_clouds.split(',')
-        
-        for incloud in AdditionalClouds:
-            # If necissary, apply a suffix to these additional clouds
-            if out_suffix == 'None':
-                outcloud = incloud[:-4] + '.laz'
-            else: 
-                outcloud = incloud[:-4] + '_' + out_suffix + '.laz'
-                
-            # Apply the vertical offset to each additional cloud
-            cmd = 'clipdata /height  /biaselev:' + str(-vcorr) + ' "' + incloud + '" "' + outcloud + '" ' + str(ulx) + ' ' + str(lry) + ' ' + str(lrx) + ' ' + str(uly)
-            print(cmd)
-            subprocess.call(cmd, shell=True)
-    
-    # Remove the temporary directory (including any orphaned files)
-    if os.path.exists(working_dir):
-       shutil.rmtree(working_dir)
\ No newline at end of file
+import sys, os, shutil
+import tempfile
+from osgeo import gdal
+from osgeo.gdalconst import *
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from grid_surface import aligned_extent
+from point_io import cloud_bounds
+from surface_cache import grid_with_reference
+from tiling import tile_clouds, tiled_vertical_offset
+import vertical_offset
+from apply_correction import apply_correction_to_clouds, report_results
+from correction_chain import CorrectionChain
+from tracing import start_trace, stage
+
+# Removes vertical offset for an for a ground point cloud with uncertain georeferncing by comparing its elevation with
+# that from reference ground point cloud (requires that the clouds match up reasonably closely in the horizontal)
+#
+# Usage: RemoveVerticalOffset.py <options> <Input Cloud> <Reference Cloud> <Suffix>
+#
+# Input Cloud: Path to input ground point cloud
+# Refernce Cloud: Path to the reference ground point cloud
+# Suffix: suffix to be added to the outputted las file (Warning, if set to "None", will overwrite the input file!)
+# Options: 
+# -a, --additional_clouds: Specfies additional clouds (separated by commas) to perform the same adjustment for (for example, 
+#       to adjust a point cloud containing canopy points using the same adjustment that is applied to the ground point cloud)
+# --no_cache: Always grid the reference cloud (by default, gridded reference surfaces are kept in a cache, see surface_cache.py)
+# -c, --chain: Correction chain file (see correction_chain.py). If given, the input cloud is read with the corrections already in
+#       the chain applied, the estimated correction is added to the chain, and no clouds are written (use ApplyCorrections.py to
+#       apply all of the corrections in the chain at once)
+# --tile_size: Process the domain in square tiles of this size (in map units), in parallel, so that it never has to be gridded
+#       as a whole (for domains that are too large to grid in memory, see tiling.py)
+# -m, --method: How to estimate the offset: grid (the mean difference between the gridded SfM and reference surfaces, the
+#       default) or sample (a robust estimate from a random sample of SfM points compared with the mean of the reference points
+#       in the same cell, without gridding either cloud, see vertical_offset.py)
+# --estimator: Estimate used by the sample method: median (the default) or trimmed (a 20% trimmed mean)
+# --tolerance: The sample method stops drawing samples once the 95% confidence interval of the estimate is narrower than
+#       plus or minus this (defaults to 0.01; it can only stop early if the reference cloud has a spatial index, see
+#       spatial_index.py)
+# --max_samples: Maximum number of SfM points used by the sample method (defaults to 100000)
+# -w, --workers: Number of clouds to correct (or tiles to process) at the same time (the input cloud and any additional clouds
+#       are corrected in parallel; defaults to the number of cores)
+# -f, --format: Format of the output clouds: laz, las or npc (an uncompressed, memory-mapped format for intermediate clouds,
+#       see npc.py).  Defaults to npc for .npc input clouds and laz otherwise
+# --trace: Write a trace of the time, memory and points processed by each step to this file (JSON lines, or Chrome trace
+#       format if it ends in .json; see tracing.py)
+# 
+# Note that in addition to the dependencies listed above, this code requires the laspy library, as the point clouds are 
+# gridded (see grid_surface.py) and corrected (see apply_correction.py) natively
+#
+# Created by Patrick Broxton
+# Updated 6/30/2020
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Function to estimate the vertical offset between an SFM ground surface and a reference ground surface
+def estimate_vertical_offset(sfm_z, lidar_z):
+    diff = sfm_z - lidar_z
+    return np.nanmean(diff)
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] input_file(s) [output]'
+    p = OptionParser(usage)
+    p.add_option('-a', '--additional_clouds', dest='additional_clouds', help='Additional clouds to apply the correction to')
+    p.add_option('--no_cache', dest='no_cache', action='store_true', help='Do not use the cache of gridded reference surfaces')
+    p.add_option('-c', '--chain', dest='chain', help='Correction chain file to add the correction to (instead of correcting the clouds)')
+    p.add_option('--tile_size', dest='tile_size', type='float', help='Process the domain in tiles of this size (in map units)')
+    p.add_option('-m', '--method', dest='method', type='choice', choices=['grid', 'sample'], default='grid', help='Estimation method (grid or sample)')
+    p.add_option('--estimator', dest='estimator', type='choice', choices=['median', 'trimmed'], default='median', help='Estimate used by the sample method')
+    p.add_option('--tolerance', dest='tolerance', type='float', default=vertical_offset.tolerance, help='Confidence interval half width at which the sample method stops')
+    p.add_option('--max_samples', dest='max_samples', type='int', default=vertical_offset.max_samples, help='Maximum number of points used by the sample method')
+    p.add_option('-w', '--workers', dest='workers', type='int', help='Number of clouds to correct (or tiles to process) at the same time (defaults to the number of cores)')
+    p.add_option('-f', '--format', dest='format', type='choice', choices=['laz', 'las', 'npc'], help='Format of the output clouds (laz, las or npc)')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    return p
+    
+if __name__ == '__main__':
+
+    # Parse the command line arguments      
+    argv = gdal.GeneralCmdLineProcessor( sys.argv ) 
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    start_trace(options.trace)
+    incloud_ground = args[0]        # Input ground point cloud
+    ref_cloud_ground = args[1]      # Reference ground surface file
+    out_suffix = args[2]        	# Output file suffix (for saved files)
+    additional_clouds = options.additional_clouds
+    
+    # Check for the existance of the input and reference clouds
+    path_errors = False
+    if not os.path.exists(incloud_ground):
+        print('Error: ' + incloud_ground + ' does not exist!')
+        path_errors = True
+    if not os.path.exists(ref_cloud_ground):
+        print('Error: ' + ref_cloud_ground + ' does not exist!')
+        path_errors = True 
+    if path_errors == True:
+        sys.exit()
+    if options.tile_size != None and options.method == 'sample':
+        print('Error: the sample method (-m sample) does not need (and can not be used with) --tile_size')
+        sys.exit(1)
+        
+    # If specified, load the chain of corrections estimated so far (the input cloud is read with these applied)
+    chain = None
+    if options.chain != None:
+        chain = CorrectionChain.load(options.chain)
+    
+    # If specified, process the domain in tiles (the average difference is assembled from the differences in each tile)
+    if options.tile_size != None:
+        tile_dir = tempfile.mkdtemp()
+        try:
+            tiling = tile_clouds(incloud_ground, ref_cloud_ground, tile_dir, options.tile_size, cellsize, chain)
+            (ulx, lry, lrx, uly) = tiling['extent']
+            with stage('tiled_vertical_offset', tiles=len(tiling['tiles'])):
+                vcorr = tiled_vertical_offset(tiling, tile_dir, options.workers)
+        finally:
+            shutil.rmtree(tile_dir, ignore_errors=True)
+    
+    # If specified, estimate the offset from a sample of the SfM points (the extent is that of the SfM cloud, unless the
+    # points are moved by a chain of corrections, in which case no points are clipped)
+    elif options.method == 'sample':
+        with stage('sampled_vertical_offset', estimator=options.estimator) as record:
+            (vcorr, info) = vertical_offset.sampled_vertical_offset(incloud_ground, ref_cloud_ground, options.tolerance,
+                                                                    options.max_samples, cellsize, options.estimator, chain)
+            record.update(info)
+        if info['samples'] == 0:
+            print('Error: none of the sampled points are near the reference cloud!')
+            sys.exit(1)
+        print('Estimated the offset from ' + str(info['samples']) + ' points (95% confidence interval: ' + 
+              str(-info['ci'][1]) + ' to ' + str(-info['ci'][0]) + ')')
+        if not info['converged']:
+            print('Warning: the confidence interval is wider than the tolerance (' + str(options.tolerance) + ')')
+        (ulx, lry, lrx, uly) = aligned_extent(*cloud_bounds(incloud_ground), cellsize=cellsize)
+    
+    else:
+        # Grid the SFM ground point cloud (on its own extent) and the reference ground point cloud on the same grid, at the same
+        # time (using the surface cache for the reference, unless disabled)
+        (sfm_z, lidar_z, gt) = grid_with_reference(incloud_ground, ref_cloud_ground, cellsize, chain, not options.no_cache)
+        
+        # Get raster characteristics
+        (height, width) = sfm_z.shape
+        ulx = gt[0]
+        lry = gt[3] + width*gt[4] + height*gt[5] 
+        lrx = gt[0] + width*gt[1] + height*gt[2]
+        uly = gt[3] 
+        dx = gt[1]
+        dy = -gt[5]
+        
+        # Figure out the average difference
+        vcorr = estimate_vertical_offset(sfm_z, lidar_z)
+    
+    # If using a correction chain, add the vertical offset to it
+    if chain != None:
+        if options.method != 'sample':
+            chain.add_clip((ulx, lry, lrx, uly))
+        chain.add_offset(vcorr)
+        chain.save(options.chain)
+        print('Added a vertical offset of ' + str(-vcorr) + ' to ' + options.chain)
+        
+    # Otherwise, apply the vertical offset to the input point cloud and any additional point clouds (all at the same time)
+    else:
+        clouds = [incloud_ground]
+        if additional_clouds != None:
+            clouds += additional_clouds.split(',')
+        print('Applying a vertical offset of ' + str(-vcorr) + ' to ' + ', '.join(clouds))
+        results = apply_correction_to_clouds(clouds, out_suffix, workers=options.workers, output_format=options.format,
+                                             offset=vcorr, extent=(ulx, lry, lrx, uly))
+        if not report_results(results):
+            sys.exit(1)
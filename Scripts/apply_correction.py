@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+from point_io import read_header, read_chunks, ChunkWriter
+from npc import npc_file
+from correction_chain import CorrectionChain, sidecar_file
+from task_graph import Task, TaskError, run_graph
+from tracing import stage
+
+# Streaming, in-process replacement for applying corrections with FUSION's ClipData (/height, /dtm and /biaselev).  Points
+# are read from the input cloud in chunks (see point_io.py), the correction is evaluated at each point's exact x/y location,
+# subtracted from its elevation, and the points are written to the output cloud (all other point attributes are preserved).
+#
+# The correction can be a constant vertical offset, a 2D polynomial model (see polynomial.py) or both:
+#   correction(x, y) = offset + polyval2d(x - origin[0], y - origin[1], coefficients)
+# Points can also be moved by a 4x4 rigid transformation matrix (e.g. from ICP, see icp_engine.py), which is applied before
+# the vertical correction.  Other corrections (e.g. spline models, see bspline.py) are given as a chain
+#
+# Usage (from another script):
+#   from apply_correction import apply_correction
+#   apply_correction(<input cloud>, <output cloud>, offset=<offset>)
+#   apply_correction(<input cloud>, <output cloud>, coefficients=m, origin=(ulx, lry))
+#   apply_correction(<input cloud>, <output cloud>, matrix=T)
+#   apply_correction(<input cloud>, <output cloud>, chain=<CorrectionChain>, sidecar=True)
+#   results = apply_correction_to_clouds([<cloud 1>, <cloud 2>, ...], <suffix>, workers=<n>, offset=<offset>)
+#   results = apply_correction_to_clouds([<cloud 1>, ...], <suffix>, backend=get_backend('fusion'), chain=<CorrectionChain>)
+#
+# Options:
+#   extent: (ulx, lry, lrx, uly) - if given, points outside of this extent are dropped (as ClipData does)
+#   chain: A chain of corrections (see correction_chain.py) to apply, in place of the correction given by the other options
+#   sidecar: Write a file describing the correction next to the output cloud (<output cloud>_correction.json)
+#
+# The input and output cloud may be the same file, in which case the input is only replaced once the output has been
+# completely written.  apply_correction_to_clouds applies the same correction to several clouds at once (e.g. a ground cloud
+# and the additional clouds given on the command line) in a pool of worker processes, naming the outputs as the scripts do
+# (with a suffix of "None" overwriting the input clouds), and returns a (input cloud, output cloud, points written, error)
+# tuple for each cloud.  The clouds are corrected natively, unless another backend is given (see backends.py, in which case
+# the number of points written is not known).  With fail_fast, the clouds that have not been started when one fails are
+# left alone (their error is that they were not run)
+#
+# Note that this requires the laspy library (and the lazrs or laszip backend to read and write .laz files)
+
+# Function to apply a correction to a point cloud (returns the number of points written)
+def apply_correction(incloud, outcloud, offset=0.0, coefficients=None, origin=(0.0, 0.0), matrix=None, extent=None,
+                     chain=None, sidecar=False):
+
+    # Describe the correction as a chain of steps (unless a chain is given)
+    if chain is None:
+        chain = CorrectionChain.from_arguments(offset, coefficients, origin, matrix, extent)
+
+    # If the output would overwrite the input, write to a (uniquely named) temporary file first
+    overwrite = os.path.exists(outcloud) and os.path.samefile(incloud, outcloud)
+    if overwrite:
+        (fd, writecloud) = tempfile.mkstemp(suffix=os.path.splitext(outcloud)[1], dir=os.path.dirname(os.path.abspath(outcloud)))
+        os.close(fd)
+    else:
+        writecloud = outcloud
+
+    with stage('apply_correction', cloud=incloud, output=outcloud) as record:
+        record['points'] = 0
+        try:
+            with ChunkWriter(writecloud, read_header(incloud)) as writer:
+                for (pts, records) in read_chunks(incloud, records=True):
+                    # Apply the correction to each point (dropping any points that are clipped)
+                    record['points'] += len(pts)
+                    (pts, keep) = chain.apply(pts)
+                    writer.write(pts, records[keep])
+        except BaseException:
+            if os.path.exists(writecloud):
+                os.remove(writecloud)
+            raise
+        record['points_written'] = writer.npoints
+
+    if overwrite:
+        pts = records = None        # (release the memory-mapped input, if any, so it can be replaced)
+        shutil.copymode(outcloud, writecloud)
+        os.replace(writecloud, outcloud)
+
+    # If specified, write a sidecar file describing the correction
+    if sidecar:
+        chain.save(sidecar_file(outcloud))
+    return writer.npoints
+
+# Function to name an output cloud (depending on whether a suffix is to be added).  Output clouds are LAZ files, unless
+# another format (laz, las or npc) is given or the input cloud is an (intermediate) .npc cloud, in which case they are too.
+def output_cloud(incloud, out_suffix, output_format=None):
+    if output_format is None:
+        output_format = 'npc' if npc_file(incloud) else 'laz'
+    if out_suffix == 'None':
+        return incloud[:-4] + '.' + output_format
+    else:
+        return incloud[:-4] + '_' + out_suffix + '.' + output_format
+
+# Function to apply a correction to a point cloud with a backend (see backends.py)
+def backend_correction(backend, incloud, outcloud, chain=None, sidecar=False, **arguments):
+    if chain is None:
+        chain = CorrectionChain.from_arguments(**arguments)
+    backend.apply(incloud, outcloud, chain)
+    if sidecar:
+        chain.save(sidecar_file(outcloud))
+    return None
+
+# Function to apply the same correction to several clouds at once (in a pool of worker processes, or of threads running the
+# programs of a backend)
+def apply_correction_to_clouds(clouds, out_suffix, workers=None, output_format=None, backend=None, fail_fast=False,
+                               **correction):
+
+    # Make sure that no output overwrites another cloud's input or output (e.g. a.las and a.laz with a suffix of None)
+    jobs = []
+    seen = {}
+    for incloud in clouds:
+        outcloud = output_cloud(incloud, out_suffix, output_format)
+        source = os.path.realpath(incloud)
+        if source in [os.path.realpath(job[0]) for job in jobs]:
+            continue    # The same cloud was given more than once
+        for path in set([source, os.path.realpath(outcloud)]):
+            if path in seen and seen[path] != source:
+                raise ValueError(incloud + ' and ' + seen[path] + ' would overwrite each other (' + path + ')')
+            seen[path] = source
+        jobs.append((incloud, outcloud))
+
+    # The clouds are independent of each other, so they are all corrected at the same time (up to the number of workers).
+    # The native workers are processes started with 'spawn' (as on Windows, see task_graph.py), since forking a process whose
+    # LAZ reader has started its own threads can leave the workers deadlocked
+    native = backend is None or backend.name == 'native'
+    if native:
+        tasks = [Task(incloud, apply_correction, incloud, outcloud, **correction) for (incloud, outcloud) in jobs]
+    else:
+        tasks = [Task(incloud, backend_correction, backend, incloud, outcloud, **correction) for (incloud, outcloud) in jobs]
+    try:
+        (npoints, errors, skipped) = (run_graph(tasks, workers, fail_fast=fail_fast, processes=native), {}, set())
+    except TaskError as e:
+        (npoints, errors, skipped) = (e.results, e.errors, e.skipped)
+
+    # Report the results in the order in which the clouds were given
+    results = []
+    for (incloud, outcloud) in jobs:
+        if incloud in skipped:
+            errors[incloud] = RuntimeError('not run, as another cloud failed')
+        results.append((incloud, outcloud, npoints.get(incloud, 0), errors.get(incloud)))
+    return results
+
+# Function to print the results from apply_correction_to_clouds (returns True if all of the clouds were corrected)
+def report_results(results):
+    success = True
+    for (incloud, outcloud, npoints, error) in results:
+        if error is None and npoints is None:
+            print('Corrected ' + incloud + ' -> ' + outcloud)
+        elif error is None:
+            print('Corrected ' + incloud + ' -> ' + outcloud + ' (' + str(npoints) + ' points)')
+        else:
+            print('Error: could not correct ' + incloud + ' (' + str(error) + ')')
+            success = False
+    return success
@@ -0,0 +1,199 @@
+import sys, os
+import shutil
+import tempfile
+import threading
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from point_io import cloud_bounds
+from npc import npc_file
+from grid_surface import aligned_extent
+from apply_correction import apply_correction
+from polynomial import polygrid2d
+from bspline import splinegrid2d
+from tracing import run_command
+
+# Backends for applying corrections to clouds (ApplyCorrections.py -b), so that a chain of corrections can be applied either
+# natively (in Python, the default), with the external programs the workflow was originally built on (FUSION and
+# CloudCompare), or faked for testing:
+#   apply(incloud, outcloud, chain): Apply a chain of corrections (see correction_chain.py), including clips, to a cloud
+#
+# Usage (from another script):
+#   from backends import get_backend
+#   backend = get_backend('fusion', retries=2)          # 'native', 'fusion' or 'stub'
+#   backend.apply(<input cloud>, <output cloud>, chain)
+# Operations are plain calls that either succeed or raise an error, so independent operations (such as correcting several
+# clouds) can be run at the same time with run_graph (see task_graph.py and apply_correction.apply_correction_to_clouds).
+# The other steps of the workflow (gridding and registration) always run natively.
+#
+# The fusion backend runs each program with a list of arguments (no shell) through tracing.run_command, which checks its exit
+# status (a program that fails raises a RuntimeError instead of being ignored) and runs failed programs again up to `retries`
+# times.  It needs FUSION (ASCII2DTM and ClipData) and CloudCompare on the system path, and only handles LAS/LAZ clouds.  The stub backend builds the same commands as the fusion backend but runs a
+# Python process that only prints them in place of each program (failing the first `failures[<program>]` runs of a program,
+# to exercise retries), and records every command in its commands list, so workflows can be tested without the programs.
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Function to write a 4x4 transformation matrix to a text file (in the format of CloudCompare's registration matrices)
+def write_matrix(matrix_file, matrix):
+    np.savetxt(matrix_file, np.asarray(matrix), fmt='%.12f')
+
+# Class of the native backend
+class NativeBackend:
+    """Applies the corrections in Python (see apply_correction.py)"""
+
+    name = 'native'
+
+    def __init__(self, **options):
+        pass
+
+    def apply(self, incloud, outcloud, chain):
+        apply_correction(incloud, outcloud, chain=chain)
+        return outcloud
+
+# Class of the backend that runs FUSION and CloudCompare
+class ExternalBackend:
+    """Applies the corrections with FUSION and CloudCompare"""
+
+    name = 'fusion'
+
+    def __init__(self, fusion_parameters=fusion_parameters, retries=0, retry_delay=1.0, **options):
+        self.fusion_parameters = fusion_parameters.split()
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def run(self, cmd):
+        """Run a program (a list of arguments), raising a RuntimeError if it still fails after the retries"""
+        print(' '.join(str(c) for c in cmd))
+        return run_command([str(c) for c in cmd], retries=self.retries, retry_delay=self.retry_delay)
+
+    def check_cloud(self, cloud):
+        if npc_file(cloud):
+            raise ValueError('The ' + self.name + ' backend can not read or write .npc clouds (' + cloud + ')')
+
+    def cloudcompare(self, outcloud):
+        """Start of a CloudCompare command line that saves clouds in the format of outcloud"""
+        return ['CloudCompare', '-SILENT', '-AUTO_SAVE', 'OFF', '-C_EXPORT_FMT', 'LAS', '-EXT', os.path.splitext(outcloud)[1][1:]]
+
+    def apply(self, incloud, outcloud, chain):
+        self.check_cloud(incloud)
+        self.check_cloud(outcloud)
+        overwrite = os.path.exists(outcloud) and os.path.samefile(incloud, outcloud)
+        if len(chain) == 0:
+            # (an empty chain only copies the cloud, to the format of the output cloud)
+            if not overwrite:
+                self.run(self.cloudcompare(outcloud) + ['-O', '-GLOBAL_SHIFT', 'AUTO', incloud, '-SAVE_CLOUDS', 'FILE', outcloud])
+            return outcloud
+
+        # Each step is one program run, from the output of the previous step (in a temporary directory) to the next (the
+        # last step writes the output cloud, unless it replaces the input cloud, in which case it is moved into place)
+        working_dir = tempfile.mkdtemp()
+        try:
+            source = incloud
+            expected = self.bounds(incloud)
+            for (k, step) in enumerate(chain.steps):
+                target = os.path.join(working_dir, 'step' + str(k) + os.path.splitext(outcloud)[1])
+                if k == len(chain) - 1 and not overwrite:
+                    target = outcloud
+                bounds = self.bounds(source, expected)
+                if step['type'] == 'clip':
+                    self.run(['ClipData', source, target] + list(step['extent']))
+                    (xmin, ymin, xmax, ymax) = step['extent']
+                    expected = (max(bounds[0], xmin), max(bounds[1], ymin), min(bounds[2], xmax), min(bounds[3], ymax))
+                elif step['type'] == 'offset':
+                    self.run(['ClipData', '/height', '/biaselev:' + str(-step['offset']), source, target] + list(bounds))
+                elif step['type'] == 'matrix':
+                    matrix_file = os.path.join(working_dir, 'step' + str(k) + '.txt')
+                    write_matrix(matrix_file, step['matrix'])
+                    self.run(self.cloudcompare(target) + ['-O', '-GLOBAL_SHIFT', 'AUTO', source, '-APPLY_TRANS', matrix_file,
+                                                          '-SAVE_CLOUDS', 'FILE', target])
+                elif step['type'] in ('polynomial', 'spline'):
+                    # (the correction is evaluated on a grid, which ClipData subtracts from the elevations of the points.  As
+                    # ClipData needs a positive surface, the grid is shifted up by vcorr, which /biaselev takes off again)
+                    asc = os.path.join(working_dir, 'correction' + str(k) + '.asc')
+                    dtm = os.path.join(working_dir, 'correction' + str(k) + '.dtm')
+                    vcorr = self.write_correction_grid(asc, step, bounds)
+                    self.run(['ASCII2DTM', dtm] + self.fusion_parameters + [asc])
+                    self.run(['ClipData', '/height', '/dtm:' + dtm, '/biaselev:' + str(-vcorr), source, target] + list(bounds))
+                else:
+                    raise ValueError('Unknown correction step: ' + str(step['type']))
+                source = target
+            if overwrite:
+                shutil.move(source, outcloud)
+        finally:
+            shutil.rmtree(working_dir, ignore_errors=True)
+        return outcloud
+
+    def bounds(self, cloud, expected=None):
+        """Bounds (xmin, ymin, xmax, ymax) of a cloud, from its header (expected is what they should be from the steps
+        applied to it so far)"""
+        return cloud_bounds(cloud)
+
+    def write_correction_grid(self, asc, step, bounds):
+        """Evaluate a polynomial or spline step on a grid (covering the bounds) and write it as an ESRI ASCII grid, shifted
+        so that it is all positive (at least 1).  Returns the shift (vcorr) that was subtracted from the correction"""
+        (ulx, lry, lrx, uly) = aligned_extent(*bounds, cellsize=cellsize)
+        xs = ulx + (np.arange(int(round((lrx - ulx) / cellsize))) + 0.5) * cellsize
+        ys = uly - (np.arange(int(round((uly - lry) / cellsize))) + 0.5) * cellsize
+        (x0, y0) = step['origin']
+        if step['type'] == 'spline':
+            zz = splinegrid2d(xs - x0, ys - y0, step['coefficients'], step['spacing'], dtype=np.float64)
+        else:
+            zz = polygrid2d(xs - x0, ys - y0, np.asarray(step['coefficients']), dtype=np.float64)
+        vcorr = float(np.min(zz)) - 1
+        with open(asc, 'w') as f:
+            f.write('ncols ' + str(len(xs)) + '\nnrows ' + str(len(ys)) + '\nxllcorner ' + repr(ulx) + '\nyllcorner ' +
+                    repr(lry) + '\ncellsize ' + repr(cellsize) + '\nNODATA_value -9999\n')
+            np.savetxt(f, zz - vcorr, fmt='%.6f')
+        return vcorr
+
+# Program run by the stub backend in place of each external program.  It prints the command, and fails while the count in
+# its failure file (if there is one) is above zero, counting it down on each run
+stub_program = '''import sys, os
+failures = int(open(sys.argv[1]).read()) if os.path.exists(sys.argv[1]) else 0
+if failures > 0:
+    open(sys.argv[1], 'w').write(str(failures - 1))
+    sys.exit(1)
+print('stub: ' + ' '.join(sys.argv[2:]))'''
+
+# Class of the stub backend
+class StubBackend(ExternalBackend):
+    """Builds the commands of the fusion backend, but only records them (and runs a stand-in for each program)"""
+
+    name = 'stub'
+
+    def __init__(self, failures=None, **options):
+        ExternalBackend.__init__(self, **options)
+        self.commands = []
+        self.lock = threading.Lock()
+        self.failure_dir = tempfile.mkdtemp() if failures else None
+        for (program, count) in (failures or {}).items():
+            with open(self.failure_file(program), 'w') as f:
+                f.write(str(count))
+
+    def failure_file(self, program):
+        """File with the number of times a program is still to fail (which need not exist)"""
+        if self.failure_dir is None:
+            return ''
+        return os.path.join(self.failure_dir, os.path.basename(program) + '.failures')
+
+    def run(self, cmd):
+        cmd = [str(c) for c in cmd]
+        with self.lock:
+            self.commands.append(cmd)
+        return run_command([sys.executable, '-c', stub_program, self.failure_file(cmd[0])] + cmd, name=cmd[0],
+                           retries=self.retries, retry_delay=self.retry_delay)
+
+    def bounds(self, cloud, expected=None):
+        # (the intermediate clouds of a chain are never written, so use the bounds they would have)
+        return cloud_bounds(cloud) if os.path.exists(cloud) or expected is None else expected
+
+# Available backends
+backends = {'native': NativeBackend, 'fusion': ExternalBackend, 'stub': StubBackend}
+
+# Function to create a backend by name (options such as retries are passed on to it)
+def get_backend(name='native', **options):
+    if name not in backends:
+        raise ValueError('Unknown backend: ' + str(name) + ' (use ' + ', '.join(backends) + ')')
+    return backends[name](**options)
@@ -0,0 +1,269 @@
+import sys, os
+import csv
+import json
+import time
+import hashlib
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from osgeo import gdal
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from pipeline import run_pipeline, config_path
+from apply_correction import output_cloud
+from correction_chain import sidecar_file
+import snow_depth
+
+# Runs the correction pipeline (see pipeline.py) for many sites and flights at once, from a manifest of jobs.  Each job is
+# a pipeline configuration with its own georeferencing (crs, cellsize, fusion_parameters) and input paths, so one manifest
+# can cover sites in different coordinate systems.  Jobs are run in a pool of worker processes (each job gets a fresh
+# process, optionally with a limit on its memory), jobs whose outputs are already up to date are skipped, and a summary
+# table with the status and timings of each job is written at the end.
+#
+# Usage: python batch.py <options> <Manifest File>
+#
+# Manifest File: Path to a JSON file such as the following (relative paths are relative to the manifest file):
+#   {
+#     "defaults": {"output_suffix": "corrected", "stages": [{"stage": "vertical_offset"}, {"stage": "icp"}]},
+#     "jobs": [
+#       {"name": "SiteA_20200215", "crs": 31966, "cellsize": 1,
+#        "ground_cloud": "SiteA/20200215/Ground.laz", "canopy_cloud": "SiteA/20200215/Canopy.laz",
+#        "reference_ground": "SiteA/SnowOff/Ground.laz", "reference_canopy": "SiteA/SnowOff/Canopy.laz"},
+#       {"name": "SiteB_20200301", "config": "SiteB/20200301/pipeline.json", "crs": 32612}
+#     ]
+#   }
+# Each job is the "defaults", updated with the pipeline config file given by "config" (if any, with paths relative to that
+# file), updated with the keys of the job itself.  Jobs need a unique "name".
+#
+# Options:
+# -j, --jobs: Number of jobs to run at the same time (defaults to the number of cores)
+# -m, --memory: Maximum memory (in GB) that each job may use; a job that goes over it fails with a MemoryError instead of
+#       exhausting the memory of the machine (only on systems with the resource module, i.e. not on Windows)
+# -t, --threads: Number of threads each job may use for numerical libraries (defaults to the cores divided by the jobs)
+# -f, --force: Run all of the jobs, even those that are up to date
+# -s, --summary: Path of the summary table (defaults to <Manifest File>_summary.csv)
+# -l, --log_dir: Directory for the output of each job (defaults to <Manifest File>_logs), along with a trace of the time and
+#       memory used by each of its stages (<name>_trace.jsonl, see tracing.py)
+#
+# A job is up to date if all of its outputs (the output clouds and their chains of corrections, and any difference and snow
+# depth rasters) exist, are newer than all of its inputs, and were made with the same job configuration (which is recorded
+# next to the output ground cloud in <output cloud>_job.json).
+
+# Function to build the list of jobs from a manifest (dictionary), resolving all paths
+def load_jobs(manifest, base_dir='.'):
+    jobs = []
+    names = set()
+    for entry in manifest['jobs']:
+        job = dict(manifest.get('defaults', {}))
+        job_dir = base_dir
+        if entry.get('config') is not None:
+            config_file = config_path(entry, 'config', base_dir)
+            with open(config_file) as f:
+                job.update(json.load(f))
+            job_dir = os.path.dirname(os.path.abspath(config_file))
+        job.update(entry)
+        job.pop('config', None)
+
+        if job.get('name') is None:
+            raise ValueError('Each job needs a name')
+        if job['name'] in names:
+            raise ValueError('Duplicate job name: ' + str(job['name']))
+        names.add(job['name'])
+
+        # Resolve all paths (so the job does not depend on the directory it is run from)
+        for key in ('ground_cloud', 'canopy_cloud', 'reference_ground', 'reference_canopy', 'trace'):
+            job[key] = config_path(job, key, job_dir)
+        job['stages'] = [dict(stage) for stage in job['stages']]
+        for stage in job['stages']:
+            for key in ('difference_map', 'output_raster', 'output_prefix'):
+                if stage.get(key) is not None:
+                    stage[key] = config_path(stage, key, job_dir)
+        jobs.append(job)
+    return jobs
+
+# Function to list the input files of a job
+def job_inputs(job):
+    inputs = [job[key] for key in ('ground_cloud', 'canopy_cloud', 'reference_ground', 'reference_canopy')]
+    inputs += [stage['difference_map'] for stage in job['stages'] if stage.get('difference_map') is not None]
+    return inputs
+
+# Function to list the output files of a job
+def job_outputs(job):
+    out_suffix = job.get('output_suffix', 'corrected')
+    outputs = []
+    for key in ('ground_cloud', 'canopy_cloud'):
+        outcloud = output_cloud(job[key], out_suffix)
+        outputs += [outcloud, sidecar_file(outcloud)]
+    outputs += [stage['output_raster'] for stage in job['stages'] if stage.get('output_raster') is not None]
+    for stage in job['stages']:
+        if stage['stage'] == 'snow_depth':
+            (resolutions, _) = snow_depth.resolution_factors(stage.get('resolutions', snow_depth.resolutions))
+            outputs += [snow_depth.product_file(stage['output_prefix'], r) for r in resolutions]
+    return outputs
+
+# Function to name the file that records the configuration a job's outputs were made with
+def stamp_file(job):
+    return output_cloud(job['ground_cloud'], job.get('output_suffix', 'corrected'))[:-4] + '_job.json'
+
+# Function to compute a hash of a job's configuration
+def job_hash(job):
+    return hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()
+
+# Function to check whether the outputs of a job are up to date
+def up_to_date(job):
+    try:
+        with open(stamp_file(job)) as f:
+            if json.load(f)['hash'] != job_hash(job):
+                return False
+        newest_input = max(os.path.getmtime(path) for path in job_inputs(job))
+        oldest_output = min(os.path.getmtime(path) for path in job_outputs(job))
+    except (OSError, ValueError, KeyError):
+        return False
+    return oldest_output >= newest_input
+
+# Function to run a single job (in a worker process), returning a row of the summary table
+def run_job(job, log_dir, memory=None, threads=None):
+    start = time.time()
+    row = {'name': job['name'], 'status': 'done', 'seconds': 0.0, 'max_memory_mb': '', 'error': '',
+           'log': os.path.join(log_dir, job['name'] + '.log')}
+
+    # Send the output of the job (including that of any programs it runs) to its log file
+    log = open(row['log'], 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    try:
+        # Limit the memory available to the job
+        if memory is not None and resource is not None:
+            limit = int(memory * 1024**3)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+        config = dict(job)
+        if threads is not None:
+            config['threads'] = threads
+        if config.get('trace') is None:
+            config['trace'] = os.path.join(log_dir, job['name'] + '_trace.jsonl')
+        summary = run_pipeline(config)
+        with open(stamp_file(job), 'w') as f:
+            json.dump({'hash': job_hash(job), 'job': job, 'summary': summary}, f, indent=2)
+    except BaseException as e:
+        traceback.print_exc()
+        row['status'] = 'failed'
+        row['error'] = type(e).__name__ + ': ' + str(e)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        log.close()
+
+    row['seconds'] = round(time.time() - start, 2)
+    if resource is not None:
+        row['max_memory_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)     # ru_maxrss is in KB
+    return row
+
+# Function to run a single job in a fresh worker process of its own, so that the memory it used is returned once it is done
+# (the same as a process pool with max_tasks_per_child=1, which needs python 3.11).  The process is spawned rather than
+# forked, as it is started from a thread (see run_batch)
+def run_job_process(job, log_dir, memory=None, threads=None):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_job, job, log_dir, memory, threads).result()
+
+# Function to run all of the jobs of a manifest, returning the rows of the summary table (in the order of the jobs)
+def run_batch(jobs, log_dir, workers=None, memory=None, threads=None, force=False):
+    os.makedirs(log_dir, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count()
+
+    # Limit the threads used by numerical libraries in each job (the worker processes inherit the environment)
+    if threads is None:
+        threads = max(1, os.cpu_count() // max(1, min(workers, len(jobs))))
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(threads)
+
+    rows = {}
+    todo = []
+    for job in jobs:
+        if not force and up_to_date(job):
+            print(job['name'] + ': up to date')
+            rows[job['name']] = {'name': job['name'], 'status': 'skipped', 'seconds': 0.0, 'max_memory_mb': '', 'error': '',
+                                 'log': ''}
+        else:
+            todo.append(job)
+
+    if len(todo) > 0:
+        # Each job gets a fresh worker process (see run_job_process), and a thread waits for each of the running jobs
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(todo)))) as pool:
+            futures = {}
+            for job in todo:
+                futures[pool.submit(run_job_process, job, log_dir, memory, threads)] = job
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    row = future.result()
+                except Exception as e:
+                    row = {'name': job['name'], 'status': 'failed', 'seconds': '', 'max_memory_mb': '',
+                           'error': type(e).__name__ + ': ' + str(e), 'log': os.path.join(log_dir, job['name'] + '.log')}
+                print(row['name'] + ': ' + row['status'] + ' (' + str(row['seconds']) + ' s)')
+                rows[job['name']] = row
+    return [rows[job['name']] for job in jobs]
+
+# Function to write the summary table
+def write_summary(rows, summary_file):
+    with open(summary_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['name', 'status', 'seconds', 'max_memory_mb', 'error', 'log'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] manifest_file'
+    p = OptionParser(usage)
+    p.add_option('-j', '--jobs', dest='jobs', type='int', help='Number of jobs to run at the same time (defaults to the number of cores)')
+    p.add_option('-m', '--memory', dest='memory', type='float', help='Maximum memory (in GB) for each job')
+    p.add_option('-t', '--threads', dest='threads', type='int', help='Number of threads for each job')
+    p.add_option('-f', '--force', dest='force', action='store_true', help='Run all jobs, even those that are up to date')
+    p.add_option('-s', '--summary', dest='summary', help='Path of the summary table')
+    p.add_option('-l', '--log_dir', dest='log_dir', help='Directory for the output of each job')
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    argv = gdal.GeneralCmdLineProcessor( sys.argv )
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(1)
+    manifest_file = args[0]
+    if not os.path.exists(manifest_file):
+        print('Error: ' + manifest_file + ' does not exist!')
+        sys.exit(1)
+    summary_file = options.summary if options.summary != None else os.path.splitext(manifest_file)[0] + '_summary.csv'
+    log_dir = options.log_dir if options.log_dir != None else os.path.splitext(manifest_file)[0] + '_logs'
+
+    # Read the manifest and check for the existance of the inputs of each job
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    jobs = load_jobs(manifest, os.path.dirname(os.path.abspath(manifest_file)))
+    path_errors = False
+    for job in jobs:
+        for path in job_inputs(job):
+            if path is None or not os.path.exists(path):
+                print('Error: ' + str(path) + ' (' + job['name'] + ') does not exist!')
+                path_errors = True
+    if path_errors == True:
+        sys.exit(1)
+
+    rows = run_batch(jobs, log_dir, options.jobs, options.memory, options.threads, options.force)
+    write_summary(rows, summary_file)
+    print('Wrote ' + summary_file)
+    if any(row['status'] == 'failed' for row in rows):
+        sys.exit(1)
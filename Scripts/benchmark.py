@@ -0,0 +1,276 @@
+import sys, os
+import json
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import laspy
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from point_io import ChunkWriter, point_dtype
+from correction_chain import CorrectionChain
+from tracing import start_trace, run_command
+
+# Benchmark suite that measures the speed and accuracy of the correction stages on synthetic data with a known answer.
+# Synthetic terrain (ground) and canopy (surface) clouds are generated at a given size, along with "SfM" versions of the
+# same clouds that have been distorted by a known vertical offset, rigid misalignment and tilt / dome warp.  The stages
+# (RemoveVerticalOffset.py, ICP.py and dewarp_model.py, run with a correction chain, see correction_chain.py) are then run
+# one after another, and for each one the wall clock time, CPU time and peak memory are recorded, along with how closely
+# the corrections found so far map the distorted points back onto their true positions.
+#
+# Usage: python benchmark.py <options>
+#
+# Options:
+# -n, --sizes: Number of points in each cloud, separated by commas (e.g. 1e5,1e6,1e7; defaults to 1e5)
+# -o, --output: Path of the JSON report (defaults to benchmark_<date>_<time>.json)
+# -b, --baseline: A previous report to compare against; the benchmark fails (exit code 1) if any stage got slower or less
+#       accurate by more than the tolerances
+# --time_tolerance: Allowed slowdown relative to the baseline (defaults to 1.25, i.e. 25% slower)
+# --error_tolerance: Allowed increase in the error relative to the baseline, in m (defaults to 0.01)
+# --tile_size: Run the vertical offset and dewarp stages in tiled mode with this tile size (see tiling.py)
+# -d, --working_dir: Directory for the synthetic clouds (defaults to a temporary directory, which is removed afterwards)
+# -s, --seed: Random seed for the synthetic data (defaults to 0)
+# --trace: Write a trace of every step of every stage to this file (see tracing.py)
+#
+# Clouds are generated and written in chunks (and the stages read them in chunks), so sizes up to 10^9 points only need
+# enough disk space (about 10 bytes per point per cloud as LAZ).  Accuracy is measured on a sample of the distorted SfM
+# ground and canopy points, which are regenerated along with their true positions.  Peak memory is measured per stage
+# (on systems with os.wait4, i.e. not on Windows).
+
+# Density of the synthetic clouds (points per square metre), which sets the size of the domain
+density = 4.0
+
+# Spacing of the (jittered) lattice of trees, and noise of the synthetic points (in m)
+tree_spacing = 15.0
+noise = 0.02
+
+# Number of points generated at a time
+chunk_size = 1000000
+
+# Number of points used to measure the accuracy
+sample_size = 100000
+
+# Default distortion of the SfM clouds
+distortion = {'offset': 5.0,                            # Vertical offset (m)
+              'rotation': [0.002, -0.001, 0.004],       # Rotation about the x, y and z axes (radians)
+              'translation': [1.5, -1.0, 0.0],         # Horizontal / vertical shift (m)
+              'tilt': [0.002, -0.001],                  # Slope of the warp in x and y (m/m)
+              'dome': 2e-6}                             # Curvature of the warp (m/m^2)
+
+# Function to compute the height of the synthetic terrain (x and y are relative to the corner of the domain)
+def terrain(x, y):
+    return 15*np.sin(x/180)*np.cos(y/230) + 0.02*x - 0.01*y + 3*np.sin(x/41 + y/57)
+
+# Function to hash lattice cells (and a seed) into uniform random numbers in [0, 1)
+def cell_random(i, j, seed, k):
+    h = (i * 73856093) ^ (j * 19349663) ^ ((seed + 1) * 83492791) ^ (k * 2654435761)
+    h = (h ^ (h >> 13)) * 1274126177
+    return ((h ^ (h >> 16)) & 0xFFFFFF) / float(0x1000000)
+
+# Function to compute the height of the synthetic canopy above the terrain (cone shaped trees on a jittered lattice)
+def canopy(x, y, seed):
+    i = np.floor(x / tree_spacing).astype(np.int64)
+    j = np.floor(y / tree_spacing).astype(np.int64)
+    present = cell_random(i, j, seed, 0) < 0.6
+    cx = (i + 0.5 + 0.3 * (cell_random(i, j, seed, 1) - 0.5)) * tree_spacing
+    cy = (j + 0.5 + 0.3 * (cell_random(i, j, seed, 2) - 0.5)) * tree_spacing
+    radius = 2 + 3 * cell_random(i, j, seed, 3)
+    height = 6 + 14 * cell_random(i, j, seed, 4)
+    d = np.hypot(x - cx, y - cy)
+    return np.where(present & (d < radius), height * (1 - d / radius), 0.0)
+
+# Function to describe the synthetic domain for a given number of points
+def make_domain(npoints):
+    side = float(np.ceil(np.sqrt(npoints / density)))
+    return {'xmin': 500000.0, 'ymin': 4000000.0, 'side': side, 'npoints': int(npoints)}
+
+# Function to apply the distortion to a set of (true) points, in place
+def distort(pts, domain, distortion):
+    c = np.array([domain['xmin'] + domain['side']/2, domain['ymin'] + domain['side']/2, 0.0])
+    (a, b, g) = distortion['rotation']
+    Rx = np.array([[1, 0, 0], [0, np.cos(a), -np.sin(a)], [0, np.sin(a), np.cos(a)]])
+    Ry = np.array([[np.cos(b), 0, np.sin(b)], [0, 1, 0], [-np.sin(b), 0, np.cos(b)]])
+    Rz = np.array([[np.cos(g), -np.sin(g), 0], [np.sin(g), np.cos(g), 0], [0, 0, 1]])
+    xyz = (np.column_stack((pts['x'], pts['y'], pts['z'])) - c) @ (Rz @ Ry @ Rx).T + c + distortion['translation']
+    (dx, dy) = (xyz[:, 0] - c[0], xyz[:, 1] - c[1])
+    xyz[:, 2] += distortion['offset'] + distortion['tilt'][0]*dx + distortion['tilt'][1]*dy + distortion['dome']*(dx**2 + dy**2)
+    (pts['x'], pts['y'], pts['z']) = (xyz[:, 0], xyz[:, 1], xyz[:, 2])
+
+# Function to generate one chunk of a synthetic cloud ('ground' or 'canopy'), returning the true and distorted points (the
+# seed draws the point positions and noise, and the scene seed places the trees, so clouds of the same scene drawn with
+# different seeds sample the same forest)
+def synthetic_chunk(kind, domain, k, n, seed, distortion=None, scene=0):
+    rng = np.random.default_rng([seed, k, 0 if kind == 'ground' else 1])
+    truth = np.empty(n, dtype=point_dtype)
+    truth['x'] = domain['xmin'] + domain['side'] * rng.random(n)
+    truth['y'] = domain['ymin'] + domain['side'] * rng.random(n)
+    truth['z'] = terrain(truth['x'] - domain['xmin'], truth['y'] - domain['ymin']) + noise * rng.standard_normal(n)
+    truth['classification'] = 2
+    if kind == 'canopy':
+        height = canopy(truth['x'], truth['y'], scene)
+        truth['z'] += height
+        truth['classification'][height > 0] = 5
+    distorted = truth.copy()
+    if distortion is not None:
+        distort(distorted, domain, distortion)
+    return (truth, distorted)
+
+# Function to write a synthetic cloud (distorted if a distortion is given)
+def write_synthetic_cloud(cloud, kind, domain, seed, distortion=None, scene=0):
+    header = laspy.LasHeader(point_format=3, version='1.2')
+    header.scales = np.array([0.001, 0.001, 0.001])
+    header.offsets = np.array([domain['xmin'], domain['ymin'], 0.0])
+    with ChunkWriter(cloud, header) as writer:
+        for (k, start) in enumerate(range(0, domain['npoints'], chunk_size)):
+            n = min(chunk_size, domain['npoints'] - start)
+            (_, pts) = synthetic_chunk(kind, domain, k, n, seed, distortion, scene)
+            writer.write(pts)
+
+# Function to measure how far a chain of corrections leaves a sample of distorted points from their true positions
+def chain_error(chain, kind, domain, seed, distortion, scene=0):
+    (truth, distorted) = synthetic_chunk(kind, domain, 0, min(sample_size, domain['npoints']), seed, distortion, scene)
+    (corrected, keep) = chain.apply(distorted)
+    truth = truth[keep]
+    if len(truth) == 0:
+        return None
+    dz = corrected['z'] - truth['z']
+    dxy = np.hypot(corrected['x'] - truth['x'], corrected['y'] - truth['y'])
+    return {'rms_z': float(np.sqrt(np.mean(dz**2))), 'mean_z': float(np.mean(dz)), 'rms_xy': float(np.sqrt(np.mean(dxy**2))),
+            'max_abs_z': float(np.max(np.abs(dz))), 'points_kept': float(len(truth)) / len(keep)}
+
+# Function to run a script (writing both its output and its errors to the log), returning its wall clock time, CPU time and
+# peak memory
+def run_stage(cmd, log):
+    record = run_command(cmd, stdout=log, stderr=log, check=False)
+    if record['returncode'] != 0:
+        raise RuntimeError(' '.join(cmd) + ' failed (see ' + log.name + ')')
+    return {'seconds': record['seconds'], 'cpu_seconds': record['cpu_seconds'], 'peak_memory_mb': record['peak_rss_mb']}
+
+# Function to run the benchmark for one cloud size, returning a list of results (one per stage)
+def run_size(npoints, working_dir, seed=0, tile_size=None):
+    scripts = os.path.dirname(os.path.realpath(__file__))
+    domain = make_domain(npoints)
+    clouds = {}
+
+    # (the SfM and reference clouds are different samples of the same scene)
+    for (name, kind, dist) in (('sfm_ground', 'ground', distortion), ('sfm_canopy', 'canopy', distortion),
+                               ('ref_ground', 'ground', None), ('ref_canopy', 'canopy', None)):
+        clouds[name] = os.path.join(working_dir, name + '_' + str(npoints) + '.laz')
+        write_synthetic_cloud(clouds[name], kind, domain, seed if dist is not None else seed + 1, dist, scene=seed)
+
+    chain_file = os.path.join(working_dir, 'chain_' + str(npoints) + '.json')
+    if os.path.exists(chain_file):
+        os.remove(chain_file)
+    tiles = ['--tile_size', str(tile_size)] if tile_size is not None else []
+    stages = [('vertical_offset', ['RemoveVerticalOffset.py', '--no_cache'] + tiles + ['-c', chain_file, clouds['sfm_ground'], clouds['ref_ground'], 'x']),
+              ('icp', ['ICP.py', '-c', chain_file, clouds['sfm_canopy'], clouds['ref_canopy'], 'x']),
+              ('dewarp', ['dewarp_model.py', '--no_cache'] + tiles + ['-c', chain_file, clouds['sfm_ground'], clouds['ref_ground'], '2', 'x'])]
+
+    results = [{'points': npoints, 'stage': 'initial', 'error': chain_error(CorrectionChain(), 'ground', domain, seed, distortion, seed)}]
+    with open(os.path.join(working_dir, 'benchmark_' + str(npoints) + '.log'), 'w') as log:
+        for (stage, args) in stages:
+            print(str(npoints) + ' points: ' + stage)
+            result = {'points': npoints, 'stage': stage}
+            result.update(run_stage([sys.executable, os.path.join(scripts, args[0])] + args[1:], log))
+            chain = CorrectionChain.load(chain_file)
+            result['error'] = chain_error(chain, 'ground', domain, seed, distortion, seed)
+            result['canopy_error'] = chain_error(chain, 'canopy', domain, seed, distortion, seed)
+            results.append(result)
+    return results
+
+# Function to compare a report with a baseline report, returning a list of regressions
+def compare_reports(report, baseline, time_tolerance=1.25, error_tolerance=0.01):
+    regressions = []
+    previous = dict(((r['points'], r['stage']), r) for r in baseline['results'])
+    for r in report['results']:
+        old = previous.get((r['points'], r['stage']))
+        if old is None or r['stage'] == 'initial':
+            continue
+        name = str(r['points']) + ' points, ' + r['stage']
+        if r['seconds'] > time_tolerance * old['seconds']:
+            regressions.append(name + ': ' + str(round(r['seconds'], 2)) + ' s (was ' + str(round(old['seconds'], 2)) + ' s)')
+        for key in ('error', 'canopy_error'):
+            if r.get(key) is None or old.get(key) is None:
+                continue
+            for metric in ('rms_z', 'rms_xy'):
+                if r[key][metric] > old[key][metric] + error_tolerance:
+                    regressions.append(name + ': ' + key + ' ' + metric + ' ' + str(round(r[key][metric], 4)) + ' m (was ' +
+                                       str(round(old[key][metric], 4)) + ' m)')
+    return regressions
+
+# Function to describe the code and machine that a report was made with
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'system': platform.system(), 'cpus': os.cpu_count(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options]'
+    p = OptionParser(usage)
+    p.add_option('-n', '--sizes', dest='sizes', default='1e5', help='Number of points in each cloud (separated by commas)')
+    p.add_option('-o', '--output', dest='output', help='Path of the JSON report')
+    p.add_option('-b', '--baseline', dest='baseline', help='Previous report to compare against')
+    p.add_option('--time_tolerance', dest='time_tolerance', type='float', default=1.25, help='Allowed slowdown relative to the baseline')
+    p.add_option('--error_tolerance', dest='error_tolerance', type='float', default=0.01, help='Allowed increase in the error (m)')
+    p.add_option('--tile_size', dest='tile_size', type='float', help='Run the vertical offset and dewarp stages in tiles of this size')
+    p.add_option('-d', '--working_dir', dest='working_dir', help='Directory for the synthetic clouds')
+    p.add_option('-s', '--seed', dest='seed', type='int', default=0, help='Random seed for the synthetic data')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    parser = optparse_init()
+    options,args = parser.parse_args(args=sys.argv[1:])
+    start_trace(options.trace)
+    sizes = [int(float(size)) for size in options.sizes.split(',')]
+    output = options.output if options.output != None else time.strftime('benchmark_%Y%m%d_%H%M%S.json')
+    if options.baseline != None and not os.path.exists(options.baseline):
+        print('Error: ' + options.baseline + ' does not exist!')
+        sys.exit(1)
+
+    # Create a working directory (unless specified)
+    working_dir = options.working_dir if options.working_dir != None else tempfile.mkdtemp()
+    os.makedirs(working_dir, exist_ok=True)
+
+    report = {'environment': environment(), 'distortion': distortion, 'seed': options.seed, 'tile_size': options.tile_size,
+              'results': []}
+    try:
+        for npoints in sizes:
+            report['results'] += run_size(npoints, working_dir, options.seed, options.tile_size)
+    finally:
+        if options.working_dir == None:
+            shutil.rmtree(working_dir, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for r in report['results']:
+        line = str(r['points']) + ' points, ' + r['stage'] + ':'
+        if 'seconds' in r:
+            line += ' ' + str(round(r['seconds'], 2)) + ' s'
+            if r['peak_memory_mb'] is not None:
+                line += ', ' + str(round(r['peak_memory_mb'])) + ' MB'
+        if r['error'] is not None:
+            line += ', ground RMS error ' + str(round(r['error']['rms_z'], 4)) + ' m (z), ' + str(round(r['error']['rms_xy'], 4)) + ' m (xy)'
+        print(line)
+    print('Wrote ' + output)
+
+    # If specified, compare with the baseline report
+    if options.baseline != None:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, options.time_tolerance, options.error_tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if len(regressions) > 0:
+            sys.exit(1)
@@ -0,0 +1,181 @@
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import spsolve
+from polynomial import biweights
+
+# Smoothing (penalized) cubic B-spline surface models, used to describe local warps in SfM point clouds that a low order
+# polynomial (see polynomial.py) can not capture.  The surface is defined by a coarse grid of control points (coefficients)
+# spaced `spacing` map units apart, starting one spacing before the origin, so that each location only depends on the 4 x 4
+# control points around it.  The fit is a P-spline: least squares plus a penalty on the second differences of the
+# coefficients (along both axes), which keeps the surface smooth and fills in gaps in the data.  As each data point only
+# depends on 16 control points, the normal equations are sparse (and are accumulated as one dense 16 x 16 block per spline
+# cell), so the cost of a fit grows linearly with the number of data points (and only mildly with the number of control
+# points).
+#
+# Usage (from another script):
+#   from bspline import spline_shape, splinefit2d, splineval2d, splinegrid2d
+#   shape = spline_shape(width, height, spacing)             # Number of control points (rows, columns) for a domain
+#   C = splinefit2d(x, y, z, shape, spacing)                 # Fit (x, y relative to the lower left corner of the domain)
+#   z = splineval2d(x, y, C, spacing)                        # Evaluate it at (x, y)
+#   zz = splinegrid2d(xs, ys, C, spacing)                    # Evaluate it on the grid defined by the 1D vectors xs and ys
+#
+# Options:
+#   smoothing: Weight of the roughness penalty, relative to the data (larger values give smoother surfaces)
+#   robust: Fit with iteratively reweighted least squares (using Tukey's biweight, as polyfit2d does), starting from an
+#       ordinary fit or, if given, an initial set of coefficients
+#
+# Note that this requires the scipy library
+
+# Default spacing of the control points (in map units) and smoothing
+spacing = 100.0
+smoothing = 0.01
+
+# Number of data points used at a time when accumulating the normal equations
+chunk_size = 1000000
+
+# Function to compute the number of control points (rows, columns) of a spline covering a width x height domain
+def spline_shape(width, height, spacing=spacing):
+    return (int(np.ceil(height / spacing)) + 3, int(np.ceil(width / spacing)) + 3)
+
+# Function to compute the index of the first of the 4 control points that each coordinate depends on (along one axis of a
+# spline with n control points), and the weight of each of the 4 (uniform cubic B-spline basis functions)
+def basis(u, n):
+    u = np.asarray(u, dtype=np.float64)
+    i = np.clip(np.floor(u).astype(np.int64), 0, n - 4)
+    t = u - i
+    w = np.column_stack(((1 - t)**3, 3*t**3 - 6*t**2 + 4, -3*t**3 + 3*t**2 + 3*t + 1, t**3)) / 6
+    return (i, w)
+
+# Function to build the sparse matrix of the second differences of the coefficients (along both axes), whose product with
+# its transpose is the roughness penalty
+def roughness_penalty(shape):
+    (ny, nx) = shape
+    def second_differences(n):
+        return sparse.diags([np.ones(n-2), -2*np.ones(n-2), np.ones(n-2)], [0, 1, 2], shape=(n-2, n))
+    Dx = sparse.kron(sparse.identity(ny), second_differences(nx))
+    Dy = sparse.kron(second_differences(ny), sparse.identity(nx))
+    return (Dx.T @ Dx + Dy.T @ Dy).tocsr()
+
+# Class that accumulates the (sparse) normal equations (B'WB and B'Wz) of a spline fit, so that they can be built up from
+# chunks of data
+class SplineNormalEquations:
+    """Normal equations of a penalized cubic B-spline least squares fit"""
+
+    def __init__(self, shape, spacing=spacing):
+        self.shape = tuple(shape)
+        self.spacing = float(spacing)
+        size = self.shape[0] * self.shape[1]
+        self.BtB = sparse.csr_matrix((size, size))
+        self.Btz = np.zeros(size)
+        self.n = 0
+
+    def local_basis(self, x, y):
+        """Index of the first control point (row * columns + column) that each data point depends on, and the weights of
+        the 16 control points it depends on"""
+        (ny, nx) = self.shape
+        (ix, wx) = basis(np.asarray(x) / self.spacing, nx)
+        (iy, wy) = basis(np.asarray(y) / self.spacing, ny)
+        return (iy * nx + ix, (wy[:, :, None] * wx[:, None, :]).reshape(-1, 16))
+
+    def add(self, x, y, z, weights=None):
+        """Add data points (with optional weights) to the normal equations"""
+        (ny, nx) = self.shape
+        offsets = (np.arange(4)[:, None] * nx + np.arange(4)[None, :]).ravel()
+        for start in range(0, np.size(x), chunk_size):
+            (first, V) = self.local_basis(x[start:start+chunk_size], y[start:start+chunk_size])
+            zc = np.asarray(z[start:start+chunk_size], dtype=np.float64)
+            VW = V if weights is None else V * np.asarray(weights[start:start+chunk_size], dtype=np.float64)[:, None]
+
+            # Data points that depend on the same control points add up to one dense 16 x 16 block of B'WB
+            order = np.argsort(first, kind='stable')
+            (first, V, VW, zc) = (first[order], V[order], VW[order], zc[order])
+            bounds = np.flatnonzero(np.concatenate(([True], first[1:] != first[:-1], [True])))
+            blocks = np.empty((len(bounds) - 1, 16, 16))
+            rhs = np.empty((len(bounds) - 1, 16))
+            for k in range(len(bounds) - 1):
+                (s, e) = (bounds[k], bounds[k+1])
+                blocks[k] = V[s:e].T @ VW[s:e]
+                rhs[k] = VW[s:e].T @ zc[s:e]
+            index = first[bounds[:-1]][:, None] + offsets[None, :]
+            rows = np.repeat(index, 16, axis=1).ravel()
+            cols = np.tile(index, (1, 16)).ravel()
+            self.BtB = self.BtB + sparse.csr_matrix((blocks.ravel(), (rows, cols)), shape=self.BtB.shape)
+            np.add.at(self.Btz, index.ravel(), rhs.ravel())
+            self.n += zc.size
+
+    def merge(self, other):
+        """Add the normal equations accumulated by another instance (with the same shape and spacing)"""
+        self.BtB = self.BtB + other.BtB
+        self.Btz += other.Btz
+        self.n += other.n
+
+    def solve(self, smoothing=smoothing):
+        """Solve the penalized normal equations, returning the coefficients as a (rows, columns) array"""
+        P = roughness_penalty(self.shape)
+        # (the smoothing is relative to the size of the data term, so it does not depend on the number of data points)
+        lam = smoothing * max(self.BtB.diagonal().sum(), 1.0) / P.diagonal().sum()
+        # (the system is symmetric, for which a minimum degree ordering of A'+A gives a much sparser factorization)
+        c = spsolve((self.BtB + lam * P).tocsc(), self.Btz, permc_spec='MMD_AT_PLUS_A')
+        return c.reshape(self.shape)
+
+# Function to fit a smoothing spline to (x, y, z) data (with x and y relative to the lower left corner of the domain)
+def splinefit2d(x, y, z, shape, spacing=spacing, smoothing=smoothing, robust=False, iterations=20, tol=1e-6,
+                weights=None, initial=None):
+    x = np.asarray(x).reshape(-1)
+    y = np.asarray(y).reshape(-1)
+    z = np.asarray(z).reshape(-1)
+
+    if robust and initial is not None:
+        C = np.asarray(initial, dtype=np.float64)
+    else:
+        neq = SplineNormalEquations(shape, spacing)
+        neq.add(x, y, z, weights)
+        C = neq.solve(smoothing)
+
+    # Iteratively reweighted least squares (down-weighting points with large residuals)
+    if robust:
+        fit = splineval2d(x, y, C, spacing)
+        for it in range(iterations):
+            w = biweights(z - fit)
+            if weights is not None:
+                w = w * weights
+            neq = SplineNormalEquations(shape, spacing)
+            neq.add(x, y, z, w)
+            C = neq.solve(smoothing)
+            new_fit = splineval2d(x, y, C, spacing)
+            converged = np.max(np.abs(new_fit - fit)) < tol
+            fit = new_fit
+            if converged:
+                break
+    return C
+
+# Function to evaluate a spline at a set of points (with x and y relative to the lower left corner of the domain)
+def splineval2d(x, y, C, spacing=spacing):
+    C = np.asarray(C, dtype=np.float64)
+    (ny, nx) = C.shape
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    (ix, wx) = basis(x.reshape(-1) / spacing, nx)
+    (iy, wy) = basis(y.reshape(-1) / spacing, ny)
+    z = np.zeros(len(ix))
+    for b in range(4):
+        for a in range(4):
+            z += C[iy + b, ix + a] * wy[:, b] * wx[:, a]
+    return z.reshape(x.shape)
+
+# Function to build the (dense) matrix of the weights of each control point (along one axis) at a set of coordinates
+def basis_matrix(u, n):
+    (i, w) = basis(u, n)
+    M = np.zeros((len(i), n))
+    for k in range(4):
+        M[np.arange(len(i)), i + k] = w[:, k]
+    return M
+
+# Function to evaluate a spline on the grid defined by the 1D coordinate vectors xs (columns) and ys (rows), as a separable
+# product (the result has shape (len(ys), len(xs)))
+def splinegrid2d(xs, ys, C, spacing=spacing, dtype=np.float32):
+    C = np.asarray(C, dtype=np.float64)
+    (ny, nx) = C.shape
+    X = basis_matrix(np.asarray(xs, dtype=np.float64) / spacing, nx)
+    Y = basis_matrix(np.asarray(ys, dtype=np.float64) / spacing, ny)
+    return (Y @ C).astype(dtype) @ X.T.astype(dtype)
@@ -0,0 +1,132 @@
+import json
+import numpy as np
+from polynomial import polyval2d
+from bspline import splineval2d
+from icp_engine import transform_points
+
+# Composition of the analytic corrections estimated by the processing steps (vertical offsets, rigid transformations from
+# ICP and polynomial or spline dewarping models), so that they can be estimated one after another on a "virtual" view of the points
+# (the input points with the earlier corrections applied on the fly) and then applied to the full clouds in a single pass.
+#
+# A chain is an ordered list of steps, each of which is one of:
+#   {'type': 'clip', 'extent': [ulx, lry, lrx, uly]}                     <- Drop the points outside of the extent
+#   {'type': 'matrix', 'matrix': 4x4 matrix}                             <- Move the points by a rigid transformation
+#   {'type': 'offset', 'offset': offset}                                 <- Subtract a constant from z
+#   {'type': 'polynomial', 'coefficients': m, 'origin': [x0, y0]}        <- Subtract polyval2d(x - x0, y - y0, m) from z
+#   {'type': 'spline', 'coefficients': C, 'origin': [x0, y0], 'spacing': s}
+#                                                   <- Subtract splineval2d(x - x0, y - y0, C, s) from z (see bspline.py)
+# where each step works on the coordinates produced by the step before it.
+#
+# Usage (from another script):
+#   from correction_chain import CorrectionChain
+#   chain = CorrectionChain.load(<chain file>)      # (an empty chain if the file does not exist)
+#   chain.add_offset(vcorr)
+#   (pts, keep) = chain.apply(pts)                  # pts is a structured array of points (see point_io.py)
+#   (xmin, ymin, xmax, ymax) = chain.bounds(header.mins, header.maxs)    # Bounds of the corrected points of a cloud
+#   chain.save(<chain file>)
+
+# Class describing a chain of corrections
+class CorrectionChain:
+    """An ordered list of corrections that are applied one after another"""
+
+    def __init__(self, steps=None):
+        self.steps = list(steps) if steps is not None else []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add_clip(self, extent):
+        self.steps.append({'type': 'clip', 'extent': [float(v) for v in extent]})
+
+    def add_matrix(self, matrix):
+        self.steps.append({'type': 'matrix', 'matrix': np.asarray(matrix, dtype=np.float64).tolist()})
+
+    def add_offset(self, offset):
+        self.steps.append({'type': 'offset', 'offset': float(offset)})
+
+    def add_polynomial(self, coefficients, origin):
+        self.steps.append({'type': 'polynomial', 'coefficients': np.asarray(coefficients, dtype=np.float64).tolist(),
+                           'origin': [float(v) for v in origin]})
+
+    def add_spline(self, coefficients, origin, spacing):
+        self.steps.append({'type': 'spline', 'coefficients': np.asarray(coefficients, dtype=np.float64).tolist(),
+                           'origin': [float(v) for v in origin], 'spacing': float(spacing)})
+
+    def extend(self, other):
+        self.steps.extend(other.steps)
+
+    def apply(self, pts):
+        """Apply the chain to a structured array of points (in place), returning the corrected points that remain and a
+        mask of which of the input points they are"""
+        keep = np.ones(len(pts), dtype=bool)
+        for step in self.steps:
+            if step['type'] == 'clip':
+                (ulx, lry, lrx, uly) = step['extent']
+                inside = (pts['x'] >= ulx) & (pts['x'] <= lrx) & (pts['y'] >= lry) & (pts['y'] <= uly)
+                keep[np.nonzero(keep)[0][~inside]] = False
+                pts = pts[inside]
+            elif step['type'] == 'matrix':
+                xyz = transform_points(np.column_stack((pts['x'], pts['y'], pts['z'])), np.asarray(step['matrix']))
+                (pts['x'], pts['y'], pts['z']) = (xyz[:, 0], xyz[:, 1], xyz[:, 2])
+            elif step['type'] == 'offset':
+                pts['z'] -= step['offset']
+            elif step['type'] == 'polynomial':
+                (x0, y0) = step['origin']
+                pts['z'] -= polyval2d(pts['x'] - x0, pts['y'] - y0, np.asarray(step['coefficients']))
+            elif step['type'] == 'spline':
+                (x0, y0) = step['origin']
+                pts['z'] -= splineval2d(pts['x'] - x0, pts['y'] - y0, np.asarray(step['coefficients']), step['spacing'])
+            else:
+                raise ValueError('Unknown correction step: ' + str(step['type']))
+        return (pts, keep)
+
+    def bounds(self, mins, maxs):
+        """Bounds (xmin, ymin, xmax, ymax) of where the chain moves the points inside the box from mins to maxs (x, y, z, e.g.
+        from the header of a cloud), without reading the points: a box that contains all of the corrected points"""
+        (lo, hi) = (np.array(mins[:3], dtype=np.float64), np.array(maxs[:3], dtype=np.float64))
+        for step in self.steps:
+            if step['type'] == 'clip':
+                (ulx, lry, lrx, uly) = step['extent']
+                (lo[:2], hi[:2]) = (np.maximum(lo[:2], (ulx, lry)), np.minimum(hi[:2], (lrx, uly)))
+            elif step['type'] == 'matrix':
+                corners = np.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+                corners = transform_points(corners, np.asarray(step['matrix']))
+                (lo, hi) = (corners.min(axis=0), corners.max(axis=0))
+            elif step['type'] == 'offset':
+                (lo[2], hi[2]) = (lo[2] - step['offset'], hi[2] - step['offset'])
+            # (polynomial and spline steps only move points up or down, by small amounts, and the z range only matters for
+            # the rotations of later matrix steps, so it is left as it is)
+        return (lo[0], lo[1], hi[0], hi[1])
+
+    def to_dict(self):
+        return {'steps': self.steps}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                return cls(json.load(f)['steps'])
+        except FileNotFoundError:
+            return cls()
+
+    @classmethod
+    def from_arguments(cls, offset=0.0, coefficients=None, origin=(0.0, 0.0), matrix=None, extent=None):
+        """Build the chain for a single correction (as described by the arguments of apply_correction)"""
+        chain = cls()
+        if extent is not None:
+            chain.add_clip(extent)
+        if matrix is not None:
+            chain.add_matrix(matrix)
+        if offset != 0:
+            chain.add_offset(offset)
+        if coefficients is not None:
+            chain.add_polynomial(coefficients, origin)
+        return chain
+
+# Function to name the sidecar file that describes the correction applied to an output cloud
+def sidecar_file(outcloud):
+    return outcloud[:-4] + '_correction.json'
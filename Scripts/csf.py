@@ -0,0 +1,164 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import ndimage
+
+# NumPy implementation of the Cloth Simulation Filter (CSF; Zhang et al., 2016) for ground filtering, used in place of
+# lidR's csf() (see Filter_CSF.py).  The point cloud is turned upside down and a cloth (a grid of particles connected by
+# springs) is dropped onto it under gravity.  Particles stop when they hit the (inverted) surface, and the springs keep the
+# cloth from sagging into gaps between ground points (e.g. under trees).  Points that end up close to the cloth are ground.
+#
+# Usage (from another script):
+#   from csf import csf
+#   ground = csf(x, y, z, sloop_smooth=True, class_threshold=0.01)     # Boolean mask of the ground points
+#
+# Options (the same parameters, and defaults, as lidR's csf()):
+#   sloop_smooth: When steep slopes exist, set this to True to reduce errors during post-processing
+#   class_threshold: The distance to the simulated cloth to classify a point as ground
+#   cloth_resolution: The distance between particles of the cloth
+#   rigidness: The rigidness of the cloth (1 to 3, stiffer cloths span wider gaps)
+#   iterations: Maximum number of iterations of the simulation
+#   time_step: Time step of the simulation
+#   workers: Number of threads used to update the cloth (it is updated in blocks of rows, in parallel)
+#
+# The whole cloth is updated at once with array operations.  The springs are satisfied in four independent sets (pairs of
+# particles starting on even or odd columns, then rows), so the update of each set can be split into blocks of rows (or
+# row pairs) that are processed in parallel without touching the same particles.
+
+# Parameters of the simulation (as in the reference CSF implementation)
+gravity = 0.2
+damping = 0.01
+stop_threshold = 0.005      # Stop once no particle moves more than this in an iteration
+slope_threshold = 0.3       # Maximum height difference between neighbouring particles for post-processing (sloop_smooth)
+
+# Minimum number of rows in each block of rows processed by a thread
+block_rows = 64
+
+# Function to compute how far a spring pulls a pair of particles together (as a fraction of the distance between them) when
+# both particles can move, and when only one of them can
+def spring_factors(rigidness):
+    return (0.5 * (1 - 0.4**rigidness), 1 - 0.7**rigidness)
+
+# Function to split a range of rows into blocks for the threads
+def row_blocks(nrows, workers, step=1):
+    nblocks = max(1, min(workers, nrows // max(block_rows, step)))
+    bounds = np.linspace(0, nrows // step, nblocks + 1).astype(int) * step
+    return [(bounds[k], bounds[k+1]) for k in range(nblocks) if bounds[k+1] > bounds[k]]
+
+# Function to satisfy one set of springs (between pairs of particles along an axis, starting at an even or odd index) in a
+# block of rows
+def satisfy_springs(h, movable, axis, parity, rows, factors):
+    (r0, r1) = rows
+    if axis == 1:
+        a = (slice(r0, r1), slice(parity, h.shape[1] - 1, 2))
+        b = (slice(r0, r1), slice(parity + 1, h.shape[1], 2))
+    else:
+        a = (slice(r0 + parity, r1 + parity - 1, 2), slice(None))
+        b = (slice(r0 + parity + 1, r1 + parity, 2), slice(None))
+    ha = h[a]
+    hb = h[b][:ha.shape[0], :ha.shape[1]]
+    ma = movable[a][:ha.shape[0], :ha.shape[1]]
+    mb = movable[b][:ha.shape[0], :ha.shape[1]]
+    d = hb - ha
+    both = ma & mb
+    move_a = np.where(both, factors[0], np.where(ma, factors[1], 0.0)) * d
+    move_b = np.where(both, factors[0], np.where(mb, factors[1], 0.0)) * d
+    h[a][:ha.shape[0], :ha.shape[1]] += move_a
+    h[b][:ha.shape[0], :ha.shape[1]] -= move_b
+
+# Function to run the cloth simulation, returning the height of each particle (in inverted coordinates) and whether it is
+# still movable
+def simulate_cloth(height_values, rigidness=1, iterations=500, time_step=0.65, workers=None):
+    if workers is None:
+        workers = os.cpu_count()
+    factors = spring_factors(rigidness)
+    (nrows, ncols) = height_values.shape
+    h = np.full(height_values.shape, np.max(height_values) + 0.05)
+    previous = h.copy()
+    movable = np.ones(h.shape, dtype=bool)
+    displacement = gravity * time_step**2
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for iteration in range(iterations):
+            # Move the particles under gravity (with damping)
+            current = h.copy()
+            h[movable] += (h[movable] - previous[movable]) * (1 - damping) - displacement
+            previous = current
+
+            # Satisfy the springs between neighbouring particles, one independent set at a time
+            for parity in (0, 1):
+                list(pool.map(lambda rows: satisfy_springs(h, movable, 1, parity, rows, factors), row_blocks(nrows, workers)))
+            for parity in (0, 1):
+                list(pool.map(lambda rows: satisfy_springs(h, movable, 0, parity, rows, factors),
+                              row_blocks(nrows - parity, workers, step=2)))
+
+            # Stop the particles that have reached the surface
+            collided = movable & (h < height_values)
+            h[collided] = height_values[collided]
+            movable &= ~collided
+
+            # Stop once the cloth no longer moves
+            if np.max(np.abs(h - current)) < stop_threshold:
+                break
+    return (h, movable)
+
+# Function to post-process the cloth on steep slopes: movable particles that are next to particles that have reached the
+# surface are moved onto the surface too, if the surface there is close to the height of their neighbour
+def smooth_slopes(h, movable, height_values):
+    movable = movable.copy()
+    changed = True
+    while changed:
+        changed = False
+        for (dr, dc) in ((0, 1), (0, -1), (1, 0), (-1, 0)):
+            neighbour_h = np.roll(h, (dr, dc), axis=(0, 1))
+            neighbour_fixed = ~np.roll(movable, (dr, dc), axis=(0, 1))
+            # (don't wrap around the edges of the cloth)
+            if dr == 1: neighbour_fixed[0, :] = False
+            if dr == -1: neighbour_fixed[-1, :] = False
+            if dc == 1: neighbour_fixed[:, 0] = False
+            if dc == -1: neighbour_fixed[:, -1] = False
+            snap = movable & neighbour_fixed & (np.abs(height_values - neighbour_h) < slope_threshold)
+            if np.any(snap):
+                h[snap] = height_values[snap]
+                movable &= ~snap
+                changed = True
+    return h
+
+# Function to classify the ground points of a point cloud with the Cloth Simulation Filter
+def csf(x, y, z, sloop_smooth=False, class_threshold=0.5, cloth_resolution=0.5, rigidness=1, iterations=500,
+        time_step=0.65, workers=None):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    zi = -np.asarray(z, dtype=np.float64)      # Turn the cloud upside down
+    if zi.size == 0:
+        return np.zeros(0, dtype=bool)
+
+    # Lay out the cloth (with a margin of one particle around the cloud)
+    x0 = x.min() - cloth_resolution
+    y0 = y.min() - cloth_resolution
+    ncols = int(np.ceil((x.max() - x0) / cloth_resolution)) + 2
+    nrows = int(np.ceil((y.max() - y0) / cloth_resolution)) + 2
+
+    # Find the height of the (inverted) surface under each particle: the highest inverted point of those closest to it
+    # (particles without any points take the value of the closest particle that has them)
+    col = np.rint((x - x0) / cloth_resolution).astype(np.int64)
+    row = np.rint((y - y0) / cloth_resolution).astype(np.int64)
+    height_values = np.full(nrows * ncols, -np.inf)
+    np.maximum.at(height_values, row * ncols + col, zi)
+    height_values = height_values.reshape(nrows, ncols)
+    empty = np.isinf(height_values)
+    if np.any(empty):
+        (_, (nr, nc)) = ndimage.distance_transform_edt(empty, return_indices=True)
+        height_values = height_values[nr, nc]
+
+    (h, movable) = simulate_cloth(height_values, rigidness, iterations, time_step, workers)
+    if sloop_smooth:
+        h = smooth_slopes(h, movable, height_values)
+
+    # Interpolate the cloth height at each point (bilinearly), and classify the points that are close to it as ground
+    u = np.clip((x - x0) / cloth_resolution, 0, ncols - 1.000001)
+    v = np.clip((y - y0) / cloth_resolution, 0, nrows - 1.000001)
+    (c, r) = (np.floor(u).astype(np.int64), np.floor(v).astype(np.int64))
+    (fu, fv) = (u - c, v - r)
+    cloth = (h[r, c] * (1 - fu) * (1 - fv) + h[r, c+1] * fu * (1 - fv) + h[r+1, c] * (1 - fu) * fv + h[r+1, c+1] * fu * fv)
+    return np.abs(cloth - zi) < class_threshold
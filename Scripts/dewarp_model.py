@@ -1,338 +1,307 @@
-import sys, os, shutil
-import subprocess
-from osgeo import ogr, osr, gdal
-from osgeo.gdalconst import *
-import tempfile
-import itertools
-import numpy as np
-sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
-from GeoRefPars import GeoRefPars
-
-# This script 'flattens' a Structure from Motion point (SfM) point cloud using a pre-existing bare-earth point cloud, and optionally, a first guess 
-# difference map (in case the SfM data includes change from the original surface, e.g. when there is snow on the ground).  The code uses a low-order 
-# polynomial fit remove general distortion in the SfM point cloud (e.g. caused by tilting or gentle warping).
-#
-#Usage: python dewarp_model.py <options> <Input Cloud> <Refernce Cloud> <Order> <Suffix>
-#
-# Input Cloud: Path to input ground point cloud
-# Refernce Cloud: Path to the reference ground point cloud
-# Order: Order of polynomial correcton
-# Suffix: suffix to be added to the outputted las file (Warning, if set to "None", will overwrite the input file!)
-# Options: 
-# -a, --additional_clouds: Specfies additional clouds (separated by commas) to perform the same adjustment for (for example, 
-#       to adjust a point cloud containing canopy points using the same adjustment that is applied to the ground point cloud)
-# -d, --difference_map: incorporate a first guess differnece map to add to the reference ground surface before applying the 
-#       polynomial corrections
-# -r, --output_raster: Output a raster representing the final computed difference between the corrected input cloud and the 
-#       reference cloud
-
-
-# Read the georeferencing information and fusion parameters
-(crs, fusion_parameters, cellsize) = GeoRefPars()
-
-# Function to fit a polynomial model to a 2D raster
-def polyfit2d(x, y, z, order):
-    ncols = (order + 1)**2
-    G = np.zeros((x.size, ncols))
-    ij = itertools.product(range(order+1), range(order+1))
-    for k, (i,j) in enumerate(ij):
-        G[:,k] = x**i * y**j
-    m, _, _, _ = np.linalg.lstsq(G, z,rcond=None)
-    return m
-
-# Function to evaluate a polynomial model on a 2D raster
-def polyval2d(x, y, m):
-    order = int(np.sqrt(len(m))) - 1
-    ij = itertools.product(range(order+1), range(order+1))
-    z = np.zeros_like(x)
-    for a, (i,j) in zip(m, ij):
-        z += a * x**i * y**j
-    return z
-	
-# Optional parameters
-def optparse_init():
-    """Prepare the option parser for input (argv)"""
-
-    from optparse import OptionParser, OptionGroup
-    usage = 'Usage: %prog [options] input_file(s) [output]'
-    p = OptionParser(usage)
-    p.add_option('-d', '--difference_map', dest='difference_map', help='First guess snow depth map to add to the ground model') 
-    p.add_option('-a', '--additional_clouds', dest='additional_clouds', help='Additional Clouds to apply the correction to')
-    p.add_option('-r', '--output_raster', dest='output_raster', action='store_true')      # Output additional rasters showing shift and difference (1 m resolution)
-    return p
-
-if __name__ == '__main__':
-
-    # Parse the command line arguments      
-    argv = gdal.GeneralCmdLineProcessor( sys.argv ) 
-    parser = optparse_init()
-    options,args = parser.parse_args(args=argv[1:])
-    incloud_ground = args[0]        # Input` ground point cloud
-    ref_cloud_ground = args[1]      # Bare earth ground surface file
-    order = int(args[2])            # Order of polynomial fit
-    out_suffix = args[3]        	# Output file prefix (for saved files) 
-    difference_map = options.difference_map
-    additional_clouds = options.additional_clouds
-    output_raster = options.output_raster
-    
-    # Check for the existance of the input and reference clouds
-    path_errors = False
-    if not os.path.exists(incloud_ground):
-        print('Error: ' + incloud_ground + ' does not exist!')
-        path_errors = True
-    if not os.path.exists(ref_cloud_ground):
-        print('Error: ' + ref_cloud_ground + ' does not exist!')
-        path_errors = True
-    if difference_map != None:
-        if not os.path.exists(difference_map):
-            print('Error: ' + difference_map + ' does not exist!')
-            path_errors = True
-    if additional_clouds != None:
-        AdditionalClouds = additional_clouds.split(',')
-        for incloud in AdditionalClouds:
-            if not os.path.exists(incloud):
-                print('Error: ' + incloud + ' does not exist!')
-                path_errors = True   
-    if path_errors == True:
-        sys.exit()
-    
-    # Create a temporary working directory`
-    working_dir = tempfile.mktemp()
-    # working_dir = 'Working'
-    if not os.path.exists(working_dir):
-        os.makedirs(working_dir)
-    
-    # Create Surface files for the SFM ground point cloud in the temporary directory (using Fusion's GridSurfaceCreate program)
-    cmd = 'GridSurfaceCreate "' + working_dir + '/surf.dtm" ' + str(cellsize) + ' ' + fusion_parameters + ' "' + incloud_ground + '"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-        
-    # Convert from dtm format to asc format (so it can be read by gdal)
-    cmd = 'DTM2ASCII "' + working_dir + '/surf.dtm" "' + working_dir + '/surf.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Assign georeferencing information using a gdal virtual raster layer
-    cmd = 'gdalbuildvrt -a_srs "EPSG:' + str(crs) + '" "' + working_dir + '/surf.vrt" "' + working_dir + '/surf.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-        
-    # Open the dataset
-    inDs = gdal.Open(working_dir + '/surf.vrt')
-    if inDs is None:
-        print('Could not open ' + working_dir + '/surf.vrt')
-        sys.exit(1)
-        
-    # Get raster characteristics
-    wkt = inDs.GetProjection()
-    s_srs = osr.SpatialReference()
-    s_srs.ImportFromWkt(wkt)
-    width = inDs.RasterXSize
-    height = inDs.RasterYSize
-    gt = inDs.GetGeoTransform()
-    ulx = gt[0]
-    lry = gt[3] + width*gt[4] + height*gt[5] 
-    lrx = gt[0] + width*gt[1] + height*gt[2]
-    uly = gt[3] 
-    dx = gt[1]
-    dy = -gt[5]
-    
-    # Read the ground surface file
-    band = inDs.GetRasterBand(inDs.RasterCount)
-    pc_ground_z = band.ReadAsArray()
-    pc_ground_z[pc_ground_z == band.GetNoDataValue()] = np.nan
-    
-    # Create Surface files for the reference point cloud in the temporary directory (using Fusion's GridSurfaceCreate program)
-    cmd = 'GridSurfaceCreate "' + working_dir + '/surf_reference.dtm" ' + str(cellsize) + ' ' + fusion_parameters + ' "' + ref_cloud_ground + '"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-        
-    # Convert from dtm format to asc format (so it can be read by gdal)   
-    cmd = 'DTM2ASCII "' + working_dir + '/surf_reference.dtm" "' + working_dir + '/surf_reference.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Assign georeferencing information using a gdal virtual raster layer
-    tr = str(dx) + ' ' + str(dy)
-    te = str(ulx) + ' ' + str(lry) + ' ' + str(lrx) + ' ' + str(uly)
-    cmd = 'gdalbuildvrt -tr ' + tr + ' -te ' + te + ' -a_srs "EPSG:' + str(crs) + '" "' + working_dir + '/surf_reference.vrt" "' + working_dir + '/surf_reference.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Open the dataset
-    inDs2 = gdal.Open(working_dir + '/surf_reference.vrt')
-    if inDs2 is None:
-        print('Could not open ' + working_dir + '/surf_reference.vrt')
-        sys.exit(1)
-        
-    # Read the reference surface file
-    band = inDs2.GetRasterBand(inDs2.RasterCount)    
-    reference_z = band.ReadAsArray()
-    reference_z[reference_z == band.GetNoDataValue()] = np.nan
-    inDs2 = None
-    
-    # If specified, load the first guess difference map
-    if difference_map != None:
-        # Use gdal virtual raster layer to make sure that the extents / cellsize for the first guess difference map match the other data
-        cmd = 'gdalbuildvrt -tr ' + tr + ' -te ' + te + ' -a_srs "EPSG:' + str(crs) + '" "' + working_dir + '/difference_map.vrt" "' + difference_map + '"'
-        print(cmd)
-        subprocess.call(cmd, shell=True)
-    
-        # Open the dataset
-        inDs2 = gdal.Open(working_dir + '/difference_map.vrt')
-        if inDs2 is None:
-            print('Could not open ' + working_dir + '/difference_map.vrt')
-            sys.exit(1)
-            
-        # Read the first guess difference map
-        band = inDs2.GetRasterBand(inDs2.RasterCount)    
-        difference = band.ReadAsArray()
-        difference[difference == band.GetNoDataValue()] = np.nan
-        inDs2 = None
-    
-    # Find the difference between the surfaces
-    xx = np.linspace(ulx,lrx, width)
-    yy = np.linspace(uly, lry, height)
-    xx, yy = np.meshgrid(xx, yy)
-    
-    # Compute the actual corrections needed
-    # If specified, add the first guess difference map
-    if difference_map != None:
-        zz = pc_ground_z - (reference_z + difference / 100)
-    else:
-        zz = pc_ground_z - reference_z
-        
-    xx = np.asarray(xx).reshape(-1)
-    yy = np.asarray(yy).reshape(-1)
-    zz = np.asarray(zz).reshape(-1)
-    ii = np.isnan(zz)
-    xx = xx[~ii]
-    yy = yy[~ii]
-    zz = zz[~ii]
-    
-    # Fit a 2d polynomial to model this difference (this will clamp the new surface to the existing ground model)
-    m = polyfit2d(xx-ulx,yy-lry,zz,order)
-
-    # Evaluate it on the original grid...
-    xx = np.linspace(ulx, lrx, width)
-    yy = np.linspace(uly, lry, height)
-    xx, yy = np.meshgrid(xx, yy)
-    zz = polyval2d(xx-ulx, yy-lry, m)
-    
-    # Compute the correction factor map
-    # Note that ClipData program expects correction to be entirely positive, so we need a workaround to ensure that this condition is satisfied
-    # We do so by adding a vertical offset to the correction factor map, and we will subtract this vertical offset using a "bias_elev" in ClipData
-    vcorr = np.min(zz)-1
-    corr = zz-vcorr
-    
-    # Output this correction factor map
-    # Open the dataset
-    driver = gdal.GetDriverByName("GTiff")
-    outDs = driver.Create(working_dir + "/correction.tif", width, height, 1, GDT_Float32)
-    if outDs is None:
-        print('Could not create ' + working_dir + '/correction.tif')
-        sys.exit(1)
-        
-    # Write the data
-    outBand = outDs.GetRasterBand(1).WriteArray(corr, 0, 0)
-    outDs.SetGeoTransform(inDs.GetGeoTransform())
-    t_srs = osr.SpatialReference()
-    t_srs.ImportFromEPSG(crs)
-    outDs.SetProjection(t_srs.ExportToWkt())
-    outDs = None
-    inDs = None
-    print('Created ' + working_dir + '/correction.tif')
-    
-    # Convert the correction factor map to fusion compatible dataset
-    # First, through a .asc file
-    cmd = 'gdal_translate -of AAIGrid "' + working_dir + '/correction.tif" "' + working_dir + '/correction.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Then, create a .dtm file from it
-    cmd = 'ASCII2DTM "' + working_dir + '/correction.dtm" ' + fusion_parameters + ' "' + working_dir + '/correction.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    # Convert the correction factor map to a format that can be operated on by FUSION
-    cmd = 'ASCII2DTM "' + working_dir + '/correction.dtm" ' + fusion_parameters + ' "' + working_dir + '/correction.asc"'
-    print(cmd)
-    subprocess.call(cmd, shell=True)
-    
-    
-    # Name the output cloud (depending on whether a suffix to be added)
-    incloud_ground_i = incloud_ground   # Need this for naming the output raster below
-    if out_suffix == 'None':
-        # If the outcloud and incloud are the same, rename the input file (because FUSION won't overwrite files)
-        outcloud = incloud_ground[:-4] + '.laz'
-        os.rename(incloud_ground,incloud_ground[:-4] + '_tmp.laz')
-        incloud_ground = incloud_ground[:-4] + '_tmp.laz'
-    else: 
-        outcloud = incloud_ground[:-4] + '_' + out_suffix + '.laz'
-        
-    # Perform the correction (using FUSION's ClipData program)
-    cmd = 'ClipData /height /dtm:"' + working_dir + '/correction.dtm" /biaselev:' + str(-vcorr) + ' "' + incloud_ground + '" "' + outcloud + '" ' + str(ulx+1) + ' ' + str(lry+1) + ' ' + str(lrx-1) + ' ' + str(uly-1)
-    print(cmd)
-    subprocess.call(cmd, shell=True)    
-    
-    # If the input cloud is to be overwritten, then remove the renamed (from above) input cloud
-    if out_suffix == 'None':
-        os.remove(incloud_ground)
-    
-    # Apply the same correction to any additional point clouds
-    if additional_clouds != None:
-        AdditionalClouds = additional_clouds.split(',')
-        
-        for incloud in AdditionalClouds:
-            # If necissary, apply a suffix to these additional clouds
-            if out_suffix == 'None':
-                outcloud = incloud[:-4] + '.laz'
-                os.rename(incloud,incloud[:-4] + '_tmp.laz')
-                incloud = incloud[:-4] + '_tmp.laz'
-            else: 
-                outcloud = incloud[:-4] + '_' + out_suffix + '.laz'
-                
-            # Apply the same transformation to each additional cloud
-            cmd = 'clipdata /height /dtm:"' + working_dir + '/correction.dtm" /biaselev:' + str(-vcorr) + ' "' + incloud + '" "' + outcloud + '" ' + str(ulx+1) + ' ' + str(lry+1) + ' ' + str(lrx-1) + ' ' + str(uly-1)
-            print(cmd)
-            subprocess.call(cmd, shell=True)  
-            
-            # If the input cloud is to be overwritten, then remove the renamed (from above) input cloud
-            if out_suffix == 'None':
-                os.remove(incloud)
-    
-    # If specified, output the difference raster
-    if output_raster == True: 
-    
-        # Compute the difference between the input cloud (minus the correction)
-        diff = (pc_ground_z - zz)-reference_z 
-    
-        # Name the output raster (depending on whether a suffix to be added)
-        if out_suffix == "None":
-            outraster_change = incloud_ground_i[:-4] + '_diff.tif'
-        else:
-            outraster_change = incloud_ground_i[:-4] + '_' + out_suffix + '_diff.tif'
-        
-        # Write the difference raster (using the same georeferencing information as the temporary correction file)
-        inFile = working_dir + '/correction.tif'
-        ds = gdal.Open(inFile)
-        band = ds.GetRasterBand(1)
-        arr = band.ReadAsArray()
-        [cols, rows] = arr.shape
-        
-        # Write the data
-        driver = gdal.GetDriverByName("GTiff")
-        outdata = driver.Create(outraster_change, rows, cols, 1, gdal.GDT_Float32)
-        outdata.SetGeoTransform(ds.GetGeoTransform())
-        outdata.SetProjection(ds.GetProjection())
-        outdata.GetRasterBand(1).WriteArray(diff*100)   # Convert to centimeters
-        outdata.GetRasterBand(1).SetNoDataValue(-9999)
-        outdata.FlushCache()
-        outdata = None
-        ds=None
-    
-    # Remove the temporary directory (including any orphaned files)
-    if os.path.exists(working_dir):
-      shutil.rmtree(working_dir)
-        
-        
+import sys, os, shutil
+from osgeo import ogr, osr, gdal
+from osgeo.gdalconst import *
+import tempfile
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from grid_surface import coarsen_surface, read_difference_map, create_raster, finish_raster
+from surface_cache import grid_with_reference
+from tiling import tile_clouds, tiled_polyfit, tile_residual, write_tiled_raster
+from polynomial import polyfit2d, polygrid2d
+import bspline
+from bspline import spline_shape, splinefit2d, splinegrid2d
+from apply_correction import apply_correction_to_clouds, report_results
+from correction_chain import CorrectionChain
+from tracing import start_trace, stage
+
+# This script 'flattens' a Structure from Motion point (SfM) point cloud using a pre-existing bare-earth point cloud, and optionally, a first guess 
+# difference map (in case the SfM data includes change from the original surface, e.g. when there is snow on the ground).  The code uses a low-order 
+# polynomial fit remove general distortion in the SfM point cloud (e.g. caused by tilting or gentle warping), or a smoothing spline
+# (see bspline.py) for more local warping that a low-order polynomial can not follow.
+#
+#Usage: python dewarp_model.py <options> <Input Cloud> <Refernce Cloud> <Order> <Suffix>
+#
+# Input Cloud: Path to input ground point cloud
+# Refernce Cloud: Path to the reference ground point cloud
+# Order: Order of polynomial correcton, or "spline" for a smoothing spline correction (see --spacing and --smoothing)
+# Suffix: suffix to be added to the outputted las file (Warning, if set to "None", will overwrite the input file!)
+# Options: 
+# -a, --additional_clouds: Specfies additional clouds (separated by commas) to perform the same adjustment for (for example, 
+#       to adjust a point cloud containing canopy points using the same adjustment that is applied to the ground point cloud)
+# -d, --difference_map: incorporate a first guess differnece map to add to the reference ground surface before applying the 
+#       polynomial corrections
+# -r, --output_raster: Output a raster representing the final computed difference between the corrected input cloud and the 
+#       reference cloud (in cm, as a tiled, compressed GeoTIFF with overviews)
+# -R, --robust: Fit the polynomial with iteratively reweighted least squares, so that outlying cells (e.g. debris left on the
+#       ground surface) do not skew the fit
+# -p, --pyramid: Number of levels of a coarse-to-fine robust fit (with -R).  The polynomial is first fit on a grid coarsened
+#       by a factor of 2**(levels-1), and the fit on each finer grid starts from the fit on the previous one, so that only a
+#       few iterations are needed at full resolution (defaults to 1, a single fit at the cellsize)
+# --spacing: Spacing of the control points of a spline correction (in map units; larger spacings give smoother corrections,
+#       defaults to 100)
+# --smoothing: Weight of the roughness penalty of a spline correction, relative to the data (defaults to 0.01)
+# --no_cache: Always grid the reference cloud (by default, gridded reference surfaces are kept in a cache, see surface_cache.py)
+# -c, --chain: Correction chain file (see correction_chain.py). If given, the input cloud is read with the corrections already in
+#       the chain applied, the estimated correction is added to the chain, and no clouds are written (use ApplyCorrections.py to
+#       apply all of the corrections in the chain at once)
+# --tile_size: Process the domain in square tiles of this size (in map units), in parallel, so that it never has to be gridded
+#       as a whole (for domains that are too large to grid in memory, see tiling.py; cannot be combined with -R or a spline)
+# -w, --workers: Number of clouds to correct (or tiles to process) at the same time (the input cloud and any additional clouds
+#       are corrected in parallel; defaults to the number of cores)
+# -f, --format: Format of the output clouds: laz, las or npc (an uncompressed, memory-mapped format for intermediate clouds,
+#       see npc.py).  Defaults to npc for .npc input clouds and laz otherwise
+# --trace: Write a trace of the time, memory and points processed by each step to this file (JSON lines, or Chrome trace
+#       format if it ends in .json; see tracing.py)
+
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Number of iterations of the robust fit at full resolution when fitting coarse to fine
+refine_iterations = 2
+
+# Function to describe a correction model (for messages)
+def describe_model(order, spacing=bspline.spacing):
+    if order == 'spline':
+        return 'spline (' + ('%g' % spacing) + ' map unit spacing)'
+    return 'order ' + str(order) + ' polynomial'
+
+# Function to fit a polynomial (or, if the order is 'spline', a smoothing spline) correction to the difference between an SfM
+# ground surface and a reference ground surface (optionally plus a first guess difference map, in cm), returning the
+# coefficients and the correction evaluated on the grid.  With more than one level, a robust fit is done coarse to fine (each
+# level halving the size of the cells of the previous one)
+def fit_correction(pc_ground_z, reference_z, gt, order, difference=None, robust=False, levels=1, spacing=bspline.spacing,
+                   smoothing=bspline.smoothing):
+    (height, width) = pc_ground_z.shape
+    ulx = gt[0]
+    lry = gt[3] + width*gt[4] + height*gt[5] 
+    lrx = gt[0] + width*gt[1] + height*gt[2]
+    uly = gt[3] 
+    
+    # Compute the actual corrections needed
+    # If specified, add the first guess difference map
+    if difference is not None:
+        zz = pc_ground_z - (reference_z + difference / 100)
+    else:
+        zz = pc_ground_z - reference_z
+        
+    # Find the coordinates of the cells where the difference is defined (without building full size coordinate grids)
+    xs = np.linspace(ulx, lrx, width)
+    ys = np.linspace(uly, lry, height)
+    
+    # The spline's control points cover the whole grid
+    if order == 'spline':
+        shape = spline_shape(lrx - ulx, uly - lry, spacing)
+        def fit(x, y, z, robust, initial, iterations=20):
+            return splinefit2d(x, y, z, shape, spacing, smoothing, robust=robust, initial=initial, iterations=iterations)
+    else:
+        def fit(x, y, z, robust, initial, iterations=20):
+            return polyfit2d(x, y, z, order, robust=robust, initial=initial, iterations=iterations)
+    
+    # If fitting coarse to fine, fit the polynomial on the coarser grids first (the coordinates of each coarse cell are the
+    # mean coordinates of the cells it covers)
+    m = None
+    if robust:
+        for factor in [2**k for k in range(levels - 1, 0, -1)]:
+            zc = coarsen_surface(zz, factor)
+            xc = coarsen_surface(xs[None, :], factor)[0]
+            yc = coarsen_surface(ys[:, None], factor)[:, 0]
+            (rows, cols) = np.nonzero(~np.isnan(zc))
+            m = fit(xc[cols]-ulx, yc[rows]-lry, zc[rows, cols], robust=True, initial=m)
+    (rows, cols) = np.nonzero(~np.isnan(zz))
+    
+    # Fit a 2d polynomial to model this difference (this will clamp the new surface to the existing ground model).  Starting
+    # from the fit on the coarser grids, only a few iterations are needed to refine it
+    m = fit(xs[cols]-ulx, ys[rows]-lry, zz[rows, cols], robust=robust, initial=m,
+            iterations=20 if m is None else refine_iterations)
+    del rows, cols
+    
+    # Evaluate it on the original grid...
+    if order == 'spline':
+        zz = splinegrid2d(xs-ulx, ys-lry, m, spacing)
+    else:
+        zz = polygrid2d(xs-ulx, ys-lry, m)
+    return (m, zz)
+
+# Function to write a difference raster (converted to centimeters)
+def write_difference_raster(outraster, diff, gt, projection):
+    (cols, rows) = diff.shape
+    outdata = create_raster(outraster, rows, cols, gt, projection)
+    diff = diff*100     # Convert to centimeters
+    diff[np.isnan(diff)] = -9999
+    outdata.GetRasterBand(1).WriteArray(diff)
+    finish_raster(outdata)
+    outdata = None
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] input_file(s) [output]'
+    p = OptionParser(usage)
+    p.add_option('-d', '--difference_map', dest='difference_map', help='First guess snow depth map to add to the ground model') 
+    p.add_option('-a', '--additional_clouds', dest='additional_clouds', help='Additional Clouds to apply the correction to')
+    p.add_option('--no_cache', dest='no_cache', action='store_true', help='Do not use the cache of gridded reference surfaces')
+    p.add_option('-c', '--chain', dest='chain', help='Correction chain file to add the correction to (instead of correcting the clouds)')
+    p.add_option('--tile_size', dest='tile_size', type='float', help='Process the domain in tiles of this size (in map units)')
+    p.add_option('-w', '--workers', dest='workers', type='int', help='Number of clouds to correct (or tiles to process) at the same time (defaults to the number of cores)')
+    p.add_option('-r', '--output_raster', dest='output_raster', action='store_true')      # Output additional rasters showing shift and difference (1 m resolution)
+    p.add_option('-R', '--robust', dest='robust', action='store_true', help='Use a robust (iteratively reweighted) polynomial fit')
+    p.add_option('--spacing', dest='spacing', type='float', default=bspline.spacing, help='Spacing of the control points of a spline correction (in map units)')
+    p.add_option('--smoothing', dest='smoothing', type='float', default=bspline.smoothing, help='Weight of the roughness penalty of a spline correction')
+    p.add_option('-p', '--pyramid', dest='pyramid', type='int', default=1, help='Number of levels of a coarse-to-fine robust fit')
+    p.add_option('-f', '--format', dest='format', type='choice', choices=['laz', 'las', 'npc'], help='Format of the output clouds (laz, las or npc)')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments      
+    argv = gdal.GeneralCmdLineProcessor( sys.argv ) 
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    start_trace(options.trace)
+    incloud_ground = args[0]        # Input` ground point cloud
+    ref_cloud_ground = args[1]      # Bare earth ground surface file
+    order = args[2]                 # Order of polynomial fit (or 'spline')
+    out_suffix = args[3]        	# Output file prefix (for saved files) 
+    difference_map = options.difference_map
+    additional_clouds = options.additional_clouds
+    output_raster = options.output_raster
+    
+    # Check for the existance of the input and reference clouds
+    path_errors = False
+    if not os.path.exists(incloud_ground):
+        print('Error: ' + incloud_ground + ' does not exist!')
+        path_errors = True
+    if not os.path.exists(ref_cloud_ground):
+        print('Error: ' + ref_cloud_ground + ' does not exist!')
+        path_errors = True
+    if difference_map != None:
+        if not os.path.exists(difference_map):
+            print('Error: ' + difference_map + ' does not exist!')
+            path_errors = True
+    if additional_clouds != None:
+        AdditionalClouds = additional_clouds.split(',')
+        for incloud in AdditionalClouds:
+            if not os.path.exists(incloud):
+                print('Error: ' + incloud + ' does not exist!')
+                path_errors = True   
+    if path_errors == True:
+        sys.exit()
+    if order.lower() == 'spline':
+        order = 'spline'
+    else:
+        try:
+            order = int(order)
+        except ValueError:
+            print('Error: the order must be a whole number or "spline"')
+            sys.exit(1)
+    if options.tile_size != None and order == 'spline':
+        print('Error: a spline correction can not be used with --tile_size')
+        sys.exit(1)
+    if options.tile_size != None and options.robust:
+        print('Error: a robust fit (-R) can not be used with --tile_size')
+        sys.exit(1)
+    if options.pyramid > 1 and not options.robust:
+        print('Error: a coarse-to-fine fit (-p) only applies to a robust fit (-R)')
+        sys.exit(1)
+    
+    # If specified, load the chain of corrections estimated so far (the input cloud is read with these applied)
+    chain = None
+    if options.chain != None:
+        chain = CorrectionChain.load(options.chain)
+    
+    # Name the output raster (depending on whether a suffix to be added)
+    if out_suffix == "None":
+        outraster_change = incloud_ground[:-4] + '_diff.tif'
+    else:
+        outraster_change = incloud_ground[:-4] + '_' + out_suffix + '_diff.tif'
+    t_srs = osr.SpatialReference()
+    t_srs.ImportFromEPSG(crs)
+
+    # If specified, process the domain in tiles (the polynomial is fit to the normal equations assembled from each tile)
+    if options.tile_size != None:
+        tile_dir = tempfile.mkdtemp()
+        try:
+            tiling = tile_clouds(incloud_ground, ref_cloud_ground, tile_dir, options.tile_size, cellsize, chain)
+            (ulx, lry, lrx, uly) = tiling['extent']
+            with stage('tiled_polyfit', order=order, tiles=len(tiling['tiles'])):
+                m = tiled_polyfit(tiling, tile_dir, order, difference_map, options.workers)
+
+            # If specified, stitch the difference raster together from the tiles (converted to centimeters) while they are
+            # still on disk
+            if output_raster == True:
+                write_tiled_raster(outraster_change, tiling, tile_dir, tile_residual, t_srs.ExportToWkt(), scale=100,
+                                   workers=options.workers, coefficients=m)
+        finally:
+            shutil.rmtree(tile_dir, ignore_errors=True)
+    
+    else:
+        # Grid the SFM ground point cloud (on its own extent) and the reference ground point cloud on the same grid, at the same
+        # time (using the surface cache for the reference, unless disabled)
+        (pc_ground_z, reference_z, gt) = grid_with_reference(incloud_ground, ref_cloud_ground, cellsize, chain,
+                                                             not options.no_cache)
+            
+        # Get raster characteristics
+        (height, width) = pc_ground_z.shape
+        ulx = gt[0]
+        lry = gt[3] + width*gt[4] + height*gt[5] 
+        lrx = gt[0] + width*gt[1] + height*gt[2]
+        uly = gt[3] 
+        dx = gt[1]
+        dy = -gt[5]
+        
+        # If specified, load the first guess difference map (on the same grid as the other data)
+        difference = None
+        if difference_map != None:
+            difference = read_difference_map(difference_map, (ulx, lry, lrx, uly), dx, dy)
+        
+        # Fit a 2d polynomial (or spline) to model the difference between the surfaces and evaluate it on the original grid
+        with stage('fit_correction', order=order, robust=bool(options.robust), levels=options.pyramid) as record:
+            (m, zz) = fit_correction(pc_ground_z, reference_z, gt, order, difference, robust=options.robust,
+                                     levels=options.pyramid, spacing=options.spacing, smoothing=options.smoothing)
+            record['cells'] = int(pc_ground_z.size)
+    
+    # If using a correction chain, add the polynomial (or spline) correction to it (points within 1 cell of the edge are dropped)
+    model = describe_model(order, options.spacing)
+    if chain != None:
+        chain.add_clip((ulx+1, lry+1, lrx-1, uly-1))
+        if order == 'spline':
+            chain.add_spline(m, (ulx, lry), options.spacing)
+        else:
+            chain.add_polynomial(m, (ulx, lry))
+        chain.save(options.chain)
+        print('Added the ' + model + ' correction to ' + options.chain)
+        
+    # Otherwise, perform the correction on the input cloud and any additional point clouds (all at the same time)
+    # The polynomial is evaluated at each point, and points within 1 cell of the edge are dropped
+    else:
+        clouds = [incloud_ground]
+        if additional_clouds != None:
+            clouds += additional_clouds.split(',')
+        print('Applying the ' + model + ' correction to ' + ', '.join(clouds))
+        if order == 'spline':
+            correction = CorrectionChain()
+            correction.add_clip((ulx+1, lry+1, lrx-1, uly-1))
+            correction.add_spline(m, (ulx, lry), options.spacing)
+            correction = {'chain': correction}
+        else:
+            correction = {'coefficients': m, 'origin': (ulx, lry), 'extent': (ulx+1, lry+1, lrx-1, uly-1)}
+        results = apply_correction_to_clouds(clouds, out_suffix, workers=options.workers, output_format=options.format,
+                                             **correction)
+        if not report_results(results):
+            sys.exit(1)
+    
+    # If specified, output the difference raster (in tiled mode, it was written from the tiles above)
+    if output_raster == True and options.tile_size == None: 
+    
+        # Compute the difference between the input cloud (minus the correction)
+        diff = (pc_ground_z - zz)-reference_z 
+    
+        # Write the difference raster (on the grid of the SFM surface)
+        write_difference_raster(outraster_change, diff, gt, t_srs.ExportToWkt())
+        
+        
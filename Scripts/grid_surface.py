@@ -0,0 +1,186 @@
+import sys, os
+from osgeo import gdal
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from point_io import cloud_bounds, read_chunks
+from spatial_index import indexed_chunks
+from tracing import stage
+
+# Native replacement for the FUSION GridSurfaceCreate -> DTM2ASCII -> gdalbuildvrt round trip.  Points are read directly
+# from a LAS/LAZ file (in chunks, see point_io.py) and binned into a NumPy surface with vectorized binning, where the value of each cell is
+# the average elevation of the points that fall in it (as with GridSurfaceCreate).  The surface is returned in memory along
+# with a GDAL style geotransform, so no temporary files are needed.
+#
+# Usage (from another script):
+#   from grid_surface import grid_surface
+#   (z, gt) = grid_surface(<cloud>)                          # Grid a cloud on its own extent
+#   (z2, gt2) = grid_surface(<cloud2>, extent=extent)        # Grid a second cloud on the same grid (ulx, lry, lrx, uly)
+#   (z3, gt3) = crop_surface(z, gt, extent)                  # Cut a (cellsize aligned) extent out of an existing surface
+#   z4 = coarsen_surface(z, 4)                               # Average blocks of 4 x 4 cells into a coarser surface
+#   d = read_difference_map(<raster>, extent, dx, dy)        # Read a raster (e.g. a first guess difference map) on a grid
+#   outdata = create_raster(<raster>, width, height, gt, projection)     # Write a surface to a GeoTIFF (see finish_raster)
+#
+# Grids are always aligned to multiples of the cellsize, so grids of different clouds (with the same cellsize) line up
+# exactly.  Cells that do not contain any points are set to NaN.  When a cloud is gridded on a given extent, only the part of
+# it inside the extent is read if it has a spatial index (see spatial_index.py).
+#
+# The GeoTIFF rasters of the scripts are read and written (with GDAL) on the same grids with read_difference_map,
+# create_raster and finish_raster.
+#
+# Note that this requires the laspy library (and the lazrs or laszip backend to read .laz files) and GDAL
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Creation options of output rasters, and the size below which no more overviews are added to them
+raster_options = ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER']
+overview_size = 256
+
+# Function to compute an extent (ulx, lry, lrx, uly), aligned to multiples of the cellsize, that encloses the given bounds
+def aligned_extent(xmin, ymin, xmax, ymax, cellsize=cellsize):
+    ulx = np.floor(xmin / cellsize) * cellsize
+    lry = np.floor(ymin / cellsize) * cellsize
+    lrx = (np.floor(xmax / cellsize) + 1) * cellsize
+    uly = (np.floor(ymax / cellsize) + 1) * cellsize
+    return (float(ulx), float(lry), float(lrx), float(uly))
+
+# Function to compute the extent (ulx, lry, lrx, uly) covered by a raster with the given geotransform and shape
+def grid_extent(gt, shape):
+    (height, width) = shape
+    ulx = gt[0]
+    lry = gt[3] + width*gt[4] + height*gt[5]
+    lrx = gt[0] + width*gt[1] + height*gt[2]
+    uly = gt[3]
+    return (ulx, lry, lrx, uly)
+
+# Function to cut a (cellsize aligned) extent (ulx, lry, lrx, uly) out of a gridded surface (cells outside of the surface are
+# set to NaN), which gives the same result as gridding the cloud directly on that extent
+def crop_surface(z, gt, extent):
+    (ulx, lry, lrx, uly) = extent
+    cellsize = gt[1]
+    width = int(round((lrx - ulx) / cellsize))
+    height = int(round((uly - lry) / cellsize))
+    col0 = int(round((ulx - gt[0]) / cellsize))
+    row0 = int(round((gt[3] - uly) / cellsize))
+    out = np.full((height, width), np.nan, dtype=z.dtype)
+    (r0, r1) = (max(row0, 0), min(row0 + height, z.shape[0]))
+    (c0, c1) = (max(col0, 0), min(col0 + width, z.shape[1]))
+    if r1 > r0 and c1 > c0:
+        out[r0-row0:r1-row0, c0-col0:c1-col0] = z[r0:r1, c0:c1]
+    return (out, (ulx, cellsize, 0.0, uly, 0.0, -cellsize))
+
+# Function to coarsen a gridded surface by an integer factor (each coarse cell is the mean of the cells that are not NaN in
+# the block of factor x factor cells it covers, and NaN if there are none).  Partial blocks at the edges are averaged over
+# the cells they do cover.
+def coarsen_surface(z, factor):
+    (height, width) = z.shape
+    (h, w) = (-(-height // factor), -(-width // factor))
+    padded = np.full((h * factor, w * factor), np.nan)
+    padded[:height, :width] = z
+    blocks = padded.reshape(h, factor, w, factor)
+    valid = ~np.isnan(blocks)
+    sums = np.where(valid, blocks, 0).sum(axis=(1, 3))
+    counts = valid.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+# Class that accumulates points into a gridded surface (the average elevation of the points in each cell)
+class SurfaceGrid:
+    """Running sums and counts of point elevations on a regular grid"""
+
+    def __init__(self, extent, cellsize=cellsize):
+        (self.ulx, self.lry, self.lrx, self.uly) = extent
+        self.cellsize = cellsize
+        self.width = int(round((self.lrx - self.ulx) / cellsize))
+        self.height = int(round((self.uly - self.lry) / cellsize))
+        self.sum = np.zeros(self.width * self.height)
+        self.count = np.zeros(self.width * self.height, dtype=np.int64)
+
+    def add(self, x, y, z):
+        """Bin a set of points into the grid (points outside of the grid are ignored)"""
+        col = np.floor((np.asarray(x) - self.ulx) / self.cellsize).astype(np.int64)
+        row = np.floor((self.uly - np.asarray(y)) / self.cellsize).astype(np.int64)
+        inside = (col >= 0) & (col < self.width) & (row >= 0) & (row < self.height)
+        idx = row[inside] * self.width + col[inside]
+        self.sum += np.bincount(idx, weights=np.asarray(z)[inside], minlength=self.sum.size)
+        self.count += np.bincount(idx, minlength=self.count.size)
+
+    def surface(self):
+        """Return the gridded surface (NaN where there are no points)"""
+        z = np.full(self.sum.size, np.nan)
+        has_points = self.count > 0
+        z[has_points] = self.sum[has_points] / self.count[has_points]
+        return z.reshape(self.height, self.width)
+
+    def geotransform(self):
+        """Return the GDAL geotransform of the grid"""
+        return (self.ulx, self.cellsize, 0.0, self.uly, 0.0, -self.cellsize)
+
+# Function to grid a point cloud into a surface (if a chain of corrections is given, the points are corrected first)
+def grid_surface(cloud, cellsize=cellsize, extent=None, chain=None):
+    # By default, use the (cellsize aligned) extent of the cloud itself
+    if extent is None:
+        if chain is not None and len(chain) > 0:
+            extent = corrected_extent(cloud, chain, cellsize)
+        else:
+            extent = aligned_extent(*cloud_bounds(cloud), cellsize=cellsize)
+    with stage('grid_surface', cloud=cloud, cellsize=cellsize) as record:
+        record['points'] = 0
+        grid = SurfaceGrid(extent, cellsize)
+        chunks = read_chunks(cloud) if chain is not None else indexed_chunks(cloud, extent)
+        for pts in chunks:
+            record['points'] += len(pts)
+            if chain is not None:
+                (pts, _) = chain.apply(pts)
+            grid.add(pts['x'], pts['y'], pts['z'])
+        return (grid.surface(), grid.geotransform())
+
+# Function to find the (cellsize aligned) extent of a point cloud after a chain of corrections has been applied to it
+def corrected_extent(cloud, chain, cellsize=cellsize):
+    bounds = [np.inf, np.inf, -np.inf, -np.inf]
+    for pts in read_chunks(cloud):
+        (pts, _) = chain.apply(pts)
+        if len(pts) > 0:
+            bounds = [min(bounds[0], pts['x'].min()), min(bounds[1], pts['y'].min()),
+                      max(bounds[2], pts['x'].max()), max(bounds[3], pts['y'].max())]
+    return aligned_extent(*bounds, cellsize=cellsize)
+
+# Function to read a first guess difference map on a given grid (extent (ulx, lry, lrx, uly) and cell size (dx, dy), in the
+# coordinate system with the EPSG code crs)
+def read_difference_map(difference_map, extent, dx, dy, crs=crs):
+    (ulx, lry, lrx, uly) = extent
+    
+    # Use gdal virtual raster layer to make sure that the extents / cellsize for the first guess difference map match the other data
+    # (the virtual raster is only kept in memory)
+    inDs2 = gdal.BuildVRT('', [difference_map], xRes=dx, yRes=dy, outputBounds=(ulx, lry, lrx, uly), outputSRS='EPSG:' + str(crs))
+    if inDs2 is None:
+        raise IOError('Could not open ' + difference_map)
+        
+    # Read the first guess difference map
+    band = inDs2.GetRasterBand(inDs2.RasterCount)    
+    difference = band.ReadAsArray().astype(np.float64)
+    difference[difference == band.GetNoDataValue()] = np.nan
+    inDs2 = None
+    return difference
+
+# Function to create an output raster (a tiled, compressed GeoTIFF)
+def create_raster(outraster, width, height, gt, projection, bands=1):
+    driver = gdal.GetDriverByName("GTiff")
+    outdata = driver.Create(outraster, width, height, bands, gdal.GDT_Float32, options=raster_options)
+    if outdata is None:
+        raise IOError('Could not create ' + outraster)
+    outdata.SetGeoTransform(gt)
+    outdata.SetProjection(projection)
+    for band in range(1, bands + 1):
+        outdata.GetRasterBand(band).SetNoDataValue(-9999)
+    return outdata
+
+# Function to add overviews to an output raster (halving the resolution until the raster fits in one block) and close it
+def finish_raster(outdata):
+    levels = []
+    while max(outdata.RasterXSize, outdata.RasterYSize) // 2**len(levels) > overview_size:
+        levels.append(2**(len(levels) + 1))
+    if len(levels) > 0:
+        outdata.BuildOverviews('AVERAGE', levels)
+    outdata.FlushCache()
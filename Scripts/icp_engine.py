@@ -0,0 +1,162 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from thinning import voxel_thin
+
+# In-process Iterative Closest Point (ICP) registration, used in place of CloudCompare's command line ICP.  Nearest
+# neighbours are found with a KD-tree, and the correspondence search is run in parallel across all cores.  Both
+# point-to-point (as used by CloudCompare) and point-to-plane matching are supported.
+#
+# Usage (from another script):
+#   from icp_engine import icp, transform_points
+#   (T, rms, iterations) = icp(<source points>, <reference points>)     # points are (n, 3) arrays of x, y, z
+#   moved = transform_points(<source points>, T)                         # T is a 4x4 rigid transformation matrix
+#   (T, rms, iterations) = pyramid_icp(<source points>, <reference points>, pyramid_levels(3))
+#
+# Options:
+#   mode: 'point_to_point' or 'point_to_plane'
+#   max_iterations: Maximum number of iterations
+#   tolerance: Stop once the RMS distance improves by less than this between iterations
+#   farthest_removal: Ignore correspondences that are farther than rejection_sigma standard deviations above the
+#       mean distance at each iteration (similar to CloudCompare's -FARTHEST_REMOVAL)
+#   max_points: Number of (randomly sampled) source points used to estimate the transformation
+#   initial: Initial 4x4 transformation to start from
+#   workers: Number of threads used for the correspondence search (-1 to use all cores)
+#
+# pyramid_icp registers the clouds coarse to fine: first on heavily voxel thinned copies of both clouds (see thinning.py),
+# then on less and less thinned copies, each level starting from the transformation found by the previous one.  The coarse
+# levels are cheap, and as thinning smooths out the fine detail of the canopy, they converge from further away than a
+# single full resolution registration does, leaving only a few (expensive) iterations for the full resolution level.
+#
+# Note that this requires the scipy library
+
+# Default parameters (similar to CloudCompare's defaults)
+max_iterations = 100
+tolerance = 1e-5
+rejection_sigma = 3.0
+max_points = 50000
+normal_neighbours = 10
+
+# Voxel size of the finest thinned level of a coarse-to-fine pyramid (the voxel size doubles with each coarser level)
+pyramid_voxel_size = 1.0
+
+# Function to apply a 4x4 transformation matrix to an (n, 3) array of points
+def transform_points(points, T):
+    return points @ T[:3, :3].T + T[:3, 3]
+
+# Function to find the rigid transformation that best maps one set of points onto another (in a least squares sense)
+def point_to_point_transform(src, dst):
+    src_mean = src.mean(axis=0)
+    dst_mean = dst.mean(axis=0)
+    H = (src - src_mean).T @ (dst - dst_mean)
+    U, _, Vt = np.linalg.svd(H)
+    R = Vt.T @ U.T
+    # Make sure the result is a rotation (and not a reflection)
+    if np.linalg.det(R) < 0:
+        Vt[2, :] *= -1
+        R = Vt.T @ U.T
+    T = np.eye(4)
+    T[:3, :3] = R
+    T[:3, 3] = dst_mean - R @ src_mean
+    return T
+
+# Function to find the (small angle) rigid transformation that minimizes the distances from one set of points to the
+# planes (defined by their normals) through another set of points
+def point_to_plane_transform(src, dst, normals):
+    A = np.hstack((np.cross(src, normals), normals))
+    b = np.einsum('ij,ij->i', dst - src, normals)
+    x, _, _, _ = np.linalg.lstsq(A, b, rcond=None)
+    (a, be, g) = x[:3]
+    Rx = np.array([[1, 0, 0], [0, np.cos(a), -np.sin(a)], [0, np.sin(a), np.cos(a)]])
+    Ry = np.array([[np.cos(be), 0, np.sin(be)], [0, 1, 0], [-np.sin(be), 0, np.cos(be)]])
+    Rz = np.array([[np.cos(g), -np.sin(g), 0], [np.sin(g), np.cos(g), 0], [0, 0, 1]])
+    T = np.eye(4)
+    T[:3, :3] = Rz @ Ry @ Rx
+    T[:3, 3] = x[3:]
+    return T
+
+# Function to estimate the normal of each point from the covariance of its nearest neighbours
+def point_normals(points, tree, k=normal_neighbours, workers=-1, chunk_size=100000):
+    normals = np.empty_like(points)
+    for start in range(0, len(points), chunk_size):
+        _, idx = tree.query(points[start:start+chunk_size], k=k, workers=workers)
+        nbrs = points[idx] - points[idx].mean(axis=1, keepdims=True)
+        cov = np.einsum('nki,nkj->nij', nbrs, nbrs)
+        _, vecs = np.linalg.eigh(cov)
+        normals[start:start+chunk_size] = vecs[:, :, 0]     # The eigenvector with the smallest eigenvalue
+    return normals
+
+# Function to register a source point cloud to a reference point cloud
+def icp(source, reference, mode='point_to_point', max_iterations=max_iterations, tolerance=tolerance,
+        farthest_removal=True, max_points=max_points, initial=None, workers=-1, seed=None):
+
+    if mode not in ('point_to_point', 'point_to_plane'):
+        raise ValueError('Unknown ICP mode: ' + str(mode))
+
+    # Work in coordinates local to the reference cloud (to avoid precision problems with large projected coordinates)
+    center = reference.mean(axis=0)
+    ref = reference - center
+    src = source - center
+
+    # Randomly sample the source points used to estimate the transformation
+    if max_points is not None and len(src) > max_points:
+        rng = np.random.default_rng(seed)
+        src = src[rng.choice(len(src), max_points, replace=False)]
+
+    # Convert the initial transformation to local coordinates
+    T = np.eye(4)
+    if initial is not None:
+        T[:3, :3] = initial[:3, :3]
+        T[:3, 3] = transform_points(center[None, :], initial)[0] - center
+
+    tree = cKDTree(ref)
+    if mode == 'point_to_plane':
+        normals = point_normals(ref, tree, workers=workers)
+
+    prev_rms = np.inf
+    rms = np.inf
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        moved = transform_points(src, T)
+
+        # Find the closest reference point to each source point (in parallel)
+        dist, idx = tree.query(moved, workers=workers)
+
+        # Remove the farthest correspondences
+        keep = np.isfinite(dist)
+        if farthest_removal:
+            keep &= dist <= dist.mean() + rejection_sigma * dist.std()
+        rms = np.sqrt(np.mean(dist[keep]**2))
+
+        # Stop once the RMS distance no longer improves
+        if prev_rms - rms < tolerance:
+            break
+        prev_rms = rms
+
+        # Update the transformation
+        if mode == 'point_to_point':
+            dT = point_to_point_transform(moved[keep], ref[idx[keep]])
+        else:
+            dT = point_to_plane_transform(moved[keep], ref[idx[keep]], normals[idx[keep]])
+        T = dT @ T
+
+    # Convert the transformation back to the original coordinates
+    shift = np.eye(4)
+    shift[:3, 3] = center
+    unshift = np.eye(4)
+    unshift[:3, 3] = -center
+    return (shift @ T @ unshift, rms, iteration)
+
+# Function to list the voxel sizes of the levels of a coarse-to-fine pyramid, from the coarsest to the finest (the last level
+# is at full resolution, which is None)
+def pyramid_levels(levels, voxel_size=pyramid_voxel_size):
+    return [voxel_size * 2**(levels - 2 - k) for k in range(levels - 1)] + [None]
+
+# Function to register a source point cloud to a reference point cloud coarse to fine (voxel_sizes lists the voxel size
+# that both clouds are thinned to at each level, None for full resolution), returning the total number of iterations
+def pyramid_icp(source, reference, voxel_sizes, initial=None, **args):
+    T = initial
+    (rms, total) = (np.inf, 0)
+    for voxel_size in voxel_sizes:
+        (T, rms, iterations) = icp(voxel_thin(source, voxel_size), voxel_thin(reference, voxel_size), initial=T, **args)
+        total += iterations
+    return (T, rms, total)
@@ -0,0 +1,153 @@
+import sys, os
+import io
+import copy
+import json
+import base64
+import struct
+import numpy as np
+import laspy
+
+# Uncompressed, memory-mapped point cloud format (.npc) for intermediate clouds, so that the clouds handed from one
+# processing step to the next do not have to be compressed and decompressed (LAZ) each time.  The points are stored exactly
+# as the readers in point_io.py hand them out (structured arrays with the fields x, y, z and classification), so they are
+# read by memory-mapping the file, without decoding or copying them.  The original LAS point records (with all of the other
+# point attributes) and the LAS header (including its VLRs) are stored alongside them, so an .npc cloud can be converted
+# back to LAS/LAZ without losing anything.
+#
+# Usage (from another script, although point_io.py reads and writes .npc clouds automatically based on their extension):
+#   from npc import NpcReader, NpcWriter
+#   reader = NpcReader(<cloud>)
+#   for (pts, records) in reader.chunks(chunk_size):           # Memory-mapped (copy on write) arrays
+#       ...
+#
+# Usage (to convert a cloud between LAS/LAZ and .npc): python npc.py <Input Cloud> <Output Cloud>
+#
+# Layout of an .npc file:
+#   magic | chunk 1 | chunk 2 | ... | footer (JSON) | length of the footer (8 bytes, little endian) | magic
+# where each chunk is a block of point arrays followed by a block of the matching raw LAS point records (each aligned to 64
+# bytes), and the footer describes the chunks, the bounds of the cloud, the array types and the LAS header.  The footer is
+# written last, so a cloud can be written in chunks without knowing the number of points up front.
+#
+# Note that .npc files take nearly twice the space of LAS files (and several times that of LAZ files), so they are meant for
+# intermediate clouds that are deleted once the final (LAZ) clouds have been written
+
+# Magic number at the start and end of .npc files
+magic = b'NPC\x00\x01\x00\x00\x00'
+
+# Alignment (in bytes) of the arrays in the file
+alignment = 64
+
+# Function to check whether a cloud is in the .npc format (from its extension)
+def npc_file(cloud):
+    return str(cloud).lower().endswith('.npc')
+
+# Function to serialize a LAS header (without any points)
+def header_bytes(header):
+    header = copy.deepcopy(header)
+    buf = io.BytesIO()
+    with laspy.open(buf, mode='w', header=header, closefd=False):
+        pass
+    return buf.getvalue()
+
+# Class to write an .npc file in chunks
+class NpcWriter:
+    """Write chunks of points (and the matching LAS point records) to an .npc file"""
+
+    def __init__(self, cloud, header):
+        self.header = header
+        self.file = open(cloud, 'wb')
+        self.file.write(magic)
+        self.chunks = []
+        self.npoints = 0
+        self.mins = np.full(3, np.inf)
+        self.maxs = np.full(3, -np.inf)
+        self.point_dtype = None
+
+    def pad(self):
+        position = self.file.tell()
+        if position % alignment != 0:
+            self.file.write(b'\0' * (alignment - position % alignment))
+        return self.file.tell()
+
+    def write(self, pts, records):
+        """Write a structured array of points and the matching laspy point records"""
+        if len(pts) == 0:
+            return
+        if self.point_dtype is None:
+            self.point_dtype = pts.dtype
+        chunk = {'count': len(pts), 'points': self.pad()}
+        np.ascontiguousarray(pts, dtype=self.point_dtype).tofile(self.file)
+        chunk['records'] = self.pad()
+        np.ascontiguousarray(records.array).tofile(self.file)
+        self.chunks.append(chunk)
+        self.npoints += len(pts)
+        for (k, axis) in enumerate(('x', 'y', 'z')):
+            self.mins[k] = min(self.mins[k], pts[axis].min())
+            self.maxs[k] = max(self.maxs[k], pts[axis].max())
+
+    def close(self):
+        if self.npoints == 0:
+            (self.mins, self.maxs) = (np.zeros(3), np.zeros(3))
+        footer = {'count': self.npoints, 'mins': self.mins.tolist(), 'maxs': self.maxs.tolist(), 'chunks': self.chunks,
+                  'point_dtype': None if self.point_dtype is None else self.point_dtype.descr,
+                  'las_header': base64.b64encode(header_bytes(self.header)).decode()}
+        footer = json.dumps(footer).encode()
+        self.file.write(footer)
+        self.file.write(struct.pack('<Q', len(footer)))
+        self.file.write(magic)
+        self.file.close()
+
+# Class to read an .npc file
+class NpcReader:
+    """Read the points (and LAS point records) of an .npc file as memory-mapped arrays"""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+        with open(cloud, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(cloud + ' is not an .npc file')
+            f.seek(-len(magic) - 8, os.SEEK_END)
+            (length,) = struct.unpack('<Q', f.read(8))
+            if f.read(len(magic)) != magic:
+                raise ValueError(cloud + ' is incomplete (it was not closed after it was written)')
+            f.seek(-len(magic) - 8 - length, os.SEEK_END)
+            footer = json.loads(f.read(length).decode())
+        self.chunk_list = footer['chunks']
+        self.point_dtype = np.dtype([tuple(field) for field in footer['point_dtype']]) if footer['point_dtype'] else None
+
+        # Rebuild the LAS header (with the number of points and the bounds of the cloud)
+        with laspy.open(io.BytesIO(base64.b64decode(footer['las_header']))) as reader:
+            self.header = reader.header
+        self.header.point_count = footer['count']
+        self.header.mins = np.array(footer['mins'])
+        self.header.maxs = np.array(footer['maxs'])
+        self.record_dtype = self.header.point_format.dtype()
+
+    def chunks(self, chunk_size=None):
+        """Yield (points, laspy records) pairs of at most chunk_size points (changes to them are not written to the file)"""
+        for chunk in self.chunk_list:
+            pts = np.memmap(self.cloud, dtype=self.point_dtype, mode='c', offset=chunk['points'], shape=(chunk['count'],))
+            records = np.memmap(self.cloud, dtype=self.record_dtype, mode='c', offset=chunk['records'], shape=(chunk['count'],))
+            step = chunk['count'] if chunk_size is None else chunk_size
+            for start in range(0, chunk['count'], step):
+                yield (pts[start:start+step], laspy.ScaleAwarePointRecord(records[start:start+step], self.header.point_format,
+                                                                         self.header.scales, self.header.offsets))
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    if len(sys.argv) < 3:
+        print('Usage: python npc.py <Input Cloud> <Output Cloud>')
+        sys.exit(1)
+    (incloud, outcloud) = sys.argv[1:3]
+    if not os.path.exists(incloud):
+        print('Error: ' + incloud + ' does not exist!')
+        sys.exit(1)
+
+    # Copy the points (and all of their attributes) from one format to the other
+    sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+    from point_io import read_header, read_chunks, ChunkWriter
+    with ChunkWriter(outcloud, read_header(incloud)) as writer:
+        for (pts, records) in read_chunks(incloud, records=True):
+            writer.write(pts, records)
+    print('Wrote ' + str(writer.npoints) + ' points to ' + outcloud)
@@ -0,0 +1,334 @@
+import sys, os
+import json
+import time
+from osgeo import gdal, osr
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from point_io import read_cloud, write_cloud, to_structured
+from spatial_index import build_index, indexed_points
+from grid_surface import SurfaceGrid, aligned_extent, grid_extent
+from surface_cache import cached_grid_surface
+from apply_correction import output_cloud
+from correction_chain import CorrectionChain, sidecar_file
+import icp_engine
+import vertical_offset
+import tracing
+from RemoveVerticalOffset import estimate_vertical_offset
+from Filter_CSF import filter_ground
+from grid_surface import read_difference_map, finish_raster
+from dewarp_model import fit_correction, write_difference_raster
+import snow_depth
+import bspline
+import thinning
+
+# Runs the whole snow-on SfM correction workflow (see CorrectSnowOnSfMData.bat) in a single process, from a declarative
+# (JSON) configuration.  The ground and canopy clouds are read once, passed from stage to stage in memory, and only written
+# at the end (intermediate clouds are only written if requested).  The stages do the same thing as the stand-alone scripts:
+#   ground_filter: Cloth Simulation Filter ground filtering (Filter_CSF.py)
+#   thin: Estimate the corrections of the following stages on thinned copies of the clouds (see thinning.py).  The corrections
+#       are only applied to the full density clouds when they are needed (by the snow_depth stage and for writing clouds)
+#   vertical_offset: Remove the vertical offset between the SfM and reference ground clouds (RemoveVerticalOffset.py; add
+#       "method": "sample" to estimate it from a sample of the points instead of the gridded surfaces, see vertical_offset.py)
+#   icp: Match the SfM canopy cloud to the reference canopy cloud (ICP.py)
+#   dewarp: Remove tilting / warping with a polynomial correction (dewarp_model.py)
+#   snow_depth: Write snow depth rasters at several resolutions from the corrected ground cloud (snow_depth.py)
+#
+# Usage: python pipeline.py <Config File>
+#
+# Config File: Path to a JSON file such as the following (relative paths are relative to the config file):
+#   {
+#     "ground_cloud": "Data/SnowOnSfMData/SnowOnGround.laz",        <- Input SfM ground cloud
+#     "canopy_cloud": "Data/SnowOnSfMData/SnowOnCanopy.laz",        <- Input SfM canopy cloud
+#     "reference_ground": "Data/SnowOffSfMData/SnowOffGround_filtered.laz",
+#     "reference_canopy": "Data/SnowOffSfMData/SnowOffCanopy.laz",
+#     "output_suffix": "corrected",                                 <- Suffix for the output clouds ("None" overwrites them)
+#     "write_intermediates": false,                                 <- Write the clouds after each stage (optional)
+#     "trace": "pipeline_trace.jsonl",                              <- Write a trace of each stage (optional, see tracing.py)
+#     "index_references": true,                                     <- Build (once) and use spatial indexes of the reference
+#                                                                      clouds (optional, see spatial_index.py)
+#     "stages": [
+#       {"stage": "ground_filter", "sloop_smooth": true, "class_threshold": 0.01},
+#       {"stage": "thin", "method": "density", "density": 16},      <- Or "method": "voxel", "voxel_size": 0.25 (optional)
+#       {"stage": "vertical_offset"},
+#       {"stage": "icp", "mode": "point_to_point", "pyramid": 3},    <- "pyramid": coarse-to-fine levels (ICP.py -p)
+#       {"stage": "dewarp", "order": 1, "difference_map": "Data/FirstGuessSnowDepth/FirstGuess.tif"},
+#       {"stage": "dewarp", "order": 2, "difference_map": "Data/FirstGuessSnowDepth/FirstGuess.tif",
+#        "output_raster": "Data/SnowOnSfMData/SnowOnGround_diff.tif"},
+#       {"stage": "dewarp", "order": "spline", "spacing": 100, "smoothing": 0.01},   <- Smoothing spline (see bspline.py)
+#       {"stage": "snow_depth", "output_prefix": "Data/SnowOnSfMData/SnowDepth", "resolutions": [0.5, 1, 5, 10]}
+#     ]
+#   }
+# The crs, cellsize and fusion_parameters from GeoRefPars() can be overridden with keys of the same names (the crs is that of
+# the output rasters and of the first guess difference maps, and the cached reference surfaces are kept apart by crs and
+# fusion parameters, see surface_cache.py), and "threads" limits the number of threads used for the nearest neighbour searches
+# (all cores by default).
+#
+# The corrections estimated by the stages are recorded in a chain of corrections (see correction_chain.py), which is written
+# next to each output cloud (<output cloud>_correction.json), so the same corrections can be applied to other clouds later
+# (with ApplyCorrections.py).
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Function to resolve a path from the config file
+def config_path(config, key, base_dir):
+    path = config.get(key)
+    if path is None or os.path.isabs(path):
+        return path
+    return os.path.join(base_dir, path)
+
+# Function to grid the reference ground cloud (through the surface cache, keyed on the crs and fusion parameters of the run)
+def reference_surface(state, cellsize, extent):
+    return cached_grid_surface(state['reference_ground'], cellsize, extent=extent, crs=state['crs'],
+                               fusion_parameters=state['fusion_parameters'])
+
+# Function to grid an in-memory cloud
+def grid_cloud(las, cellsize, extent=None):
+    x = np.asarray(las.x)
+    y = np.asarray(las.y)
+    if extent is None:
+        extent = aligned_extent(x.min(), y.min(), x.max(), y.max(), cellsize)
+    grid = SurfaceGrid(extent, cellsize)
+    grid.add(x, y, np.asarray(las.z))
+    return (grid.surface(), grid.geotransform())
+
+# Function to apply a chain of corrections to a dictionary of in-memory clouds
+def apply_chain(clouds, chain):
+    for name in ('ground', 'canopy'):
+        (pts, keep) = chain.apply(to_structured(clouds[name].points))
+        las = clouds[name][keep]
+        (las.x, las.y, las.z) = (pts['x'], pts['y'], pts['z'])
+        clouds[name] = las
+
+# Function to apply a chain of corrections to the in-memory clouds (and record it in the pipeline's chain).  After a thin
+# stage, only the thinned clouds are corrected, and the correction is kept until the full density clouds are needed
+def correct_clouds(state, chain):
+    apply_chain(state, chain)
+    state['chain'].extend(chain)
+    if 'full' in state:
+        state['pending'].extend(chain)
+
+# Function to get the (corrected) full density clouds
+def full_clouds(state):
+    if 'full' not in state:
+        return {'ground': state['ground'], 'canopy': state['canopy']}
+    if len(state['pending']) > 0:
+        apply_chain(state['full'], state['pending'])
+        state['pending'] = CorrectionChain()
+    return state['full']
+
+# Ground filtering stage (the ground points are kept in memory and handed straight to the next stage)
+def ground_filter_stage(state, stage):
+    npoints = len(state['ground'].points)
+    state['ground'] = filter_ground(state['ground'], stage.get('sloop_smooth', True), stage.get('class_threshold', 0.01),
+                                    cloth_resolution=stage.get('cloth_resolution', 0.5), rigidness=stage.get('rigidness', 1),
+                                    workers=state['threads'] if state['threads'] > 0 else None)
+    print('Classified ' + str(len(state['ground'].points)) + ' of ' + str(npoints) + ' points as ground')
+    if state['write_intermediates']:
+        write_cloud(state['ground'], output_cloud(state['ground_path'], 'filtered'))
+    return {'points': len(state['ground'].points)}
+
+# Thinning stage (the clouds that the following stages estimate their corrections on are thinned from the full density ones)
+def thin_stage(state, stage):
+    state['full'] = full_clouds(state)
+    state['pending'] = CorrectionChain()
+    result = {'method': stage.get('method', 'density')}
+    for name in ('ground', 'canopy'):
+        las = state['full'][name]
+        keep = thinning.thin_index(np.column_stack((las.x, las.y, las.z)), result['method'],
+                                   stage.get('voxel_size', thinning.voxel_size), stage.get('density', thinning.density))
+        state[name] = las[keep]
+        print('Thinned the ' + name + ' cloud to ' + str(len(keep)) + ' of ' + str(len(las.points)) + ' points')
+        result[name + '_points'] = len(keep)
+    return result
+
+# Vertical offset stage
+def vertical_offset_stage(state, stage):
+    (sfm_z, gt) = grid_cloud(state['ground'], state['cellsize'])
+    extent = grid_extent(gt, sfm_z.shape)
+    if stage.get('method', 'grid') == 'sample':
+        # Robust estimate from a sample of the (in memory) SfM ground points, see vertical_offset.py
+        ground = state['ground']
+        rng = np.random.default_rng(stage.get('seed'))
+        index = rng.permutation(len(ground.points))[:stage.get('max_samples', vertical_offset.max_samples)]
+        samples = np.column_stack((np.asarray(ground.x)[index], np.asarray(ground.y)[index], np.asarray(ground.z)[index]))
+        (vcorr, info) = vertical_offset.estimate_from_samples(samples, state['reference_ground'],
+                                                              stage.get('tolerance', vertical_offset.tolerance),
+                                                              state['cellsize'], stage.get('estimator', 'median'))
+        if info['samples'] == 0:
+            raise ValueError('None of the sampled points are near the reference cloud')
+    else:
+        (lidar_z, _) = reference_surface(state, state['cellsize'], extent)
+        vcorr = estimate_vertical_offset(sfm_z, lidar_z)
+    print('Vertical offset: ' + str(-vcorr))
+
+    # Apply the offset (dropping points outside of the SFM surface, as RemoveVerticalOffset.py does)
+    chain = CorrectionChain()
+    chain.add_clip(extent)
+    chain.add_offset(vcorr)
+    correct_clouds(state, chain)
+    return {'offset': float(-vcorr)}
+
+# ICP stage
+def icp_stage(state, stage):
+    canopy = state['canopy']
+    source = np.column_stack((canopy.x, canopy.y, canopy.z))
+    margin = stage.get('search_margin', 10)
+    extent = (source[:, 0].min() - margin, source[:, 1].min() - margin, source[:, 0].max() + margin, source[:, 1].max() + margin)
+    reference = indexed_points(state['reference_canopy'], extent)
+    levels = icp_engine.pyramid_levels(stage.get('pyramid', 1), stage.get('voxel_size', icp_engine.pyramid_voxel_size))
+    (T, rms, iterations) = icp_engine.pyramid_icp(source, reference, levels, mode=stage.get('mode', 'point_to_point'),
+                                                  max_iterations=stage.get('iterations', icp_engine.max_iterations),
+                                                  tolerance=stage.get('tolerance', icp_engine.tolerance),
+                                                  max_points=stage.get('max_points', icp_engine.max_points),
+                                                  workers=state['threads'])
+    print('ICP RMS: ' + str(rms) + ' after ' + str(iterations) + ' iterations')
+
+    chain = CorrectionChain()
+    chain.add_matrix(T)
+    correct_clouds(state, chain)
+    return {'rms': float(rms), 'iterations': iterations, 'matrix': T.tolist()}
+
+# Dewarp stage
+def dewarp_stage(state, stage):
+    order = 'spline' if str(stage['order']).lower() == 'spline' else int(stage['order'])
+    spacing = float(stage.get('spacing', bspline.spacing))
+    (pc_ground_z, gt) = grid_cloud(state['ground'], state['cellsize'])
+    (ulx, lry, lrx, uly) = extent = grid_extent(gt, pc_ground_z.shape)
+    (reference_z, _) = reference_surface(state, state['cellsize'], extent)
+
+    # If specified, load the first guess difference map
+    difference = None
+    if stage.get('difference_map') is not None:
+        difference = read_difference_map(config_path(stage, 'difference_map', state['base_dir']), extent, gt[1], -gt[5],
+                                         state['crs'])
+    (m, zz) = fit_correction(pc_ground_z, reference_z, gt, order, difference, robust=stage.get('robust', False),
+                             levels=stage.get('pyramid', 1), spacing=spacing,
+                             smoothing=float(stage.get('smoothing', bspline.smoothing)))
+
+    # Apply the correction (dropping points within 1 cell of the edge, as dewarp_model.py does)
+    chain = CorrectionChain()
+    chain.add_clip((ulx+1, lry+1, lrx-1, uly-1))
+    if order == 'spline':
+        chain.add_spline(m, (ulx, lry), spacing)
+    else:
+        chain.add_polynomial(m, (ulx, lry))
+    correct_clouds(state, chain)
+
+    # If specified, output the difference raster
+    if stage.get('output_raster') is not None:
+        t_srs = osr.SpatialReference()
+        t_srs.ImportFromEPSG(state['crs'])
+        write_difference_raster(config_path(stage, 'output_raster', state['base_dir']), (pc_ground_z - zz) - reference_z, gt,
+                                t_srs.ExportToWkt())
+    if order == 'spline':
+        return {'order': order, 'spacing': spacing, 'control_points': list(m.shape), 'origin': [ulx, lry]}
+    return {'order': order, 'coefficients': m.tolist(), 'origin': [ulx, lry]}
+
+# Snow depth stage (the statistics of every resolution are computed from the in-memory ground cloud, relative to the
+# reference surface on the finest grid)
+def snow_depth_stage(state, stage):
+    (resolutions, factors) = snow_depth.resolution_factors(stage.get('resolutions', snow_depth.resolutions))
+    ground = full_clouds(state)['ground']
+    (x, y, z) = (np.asarray(ground.x), np.asarray(ground.y), np.asarray(ground.z))
+    extent = aligned_extent(x.min(), y.min(), x.max(), y.max(), snow_depth.block_size(resolutions, factors))
+    (reference_z, gt) = reference_surface(state, resolutions[0], extent)
+    (rows, cols, depth) = snow_depth.point_depths(x, y, z, reference_z, gt)
+
+    t_srs = osr.SpatialReference()
+    t_srs.ImportFromEPSG(state['crs'])
+    out_prefix = config_path(stage, 'output_prefix', state['base_dir'])
+    outdata = snow_depth.create_products(out_prefix, extent, resolutions, t_srs.ExportToWkt())
+    for (ds, f) in zip(outdata, factors):
+        snow_depth.write_statistics(ds, snow_depth.depth_statistics(rows, cols, depth, reference_z.shape[0],
+                                                                    reference_z.shape[1], f))
+        finish_raster(ds)
+    outdata = None
+    return {'points': len(depth), 'rasters': [snow_depth.product_file(out_prefix, r) for r in resolutions]}
+
+# Available stages
+stages = {'ground_filter': ground_filter_stage, 'thin': thin_stage, 'vertical_offset': vertical_offset_stage, 'icp': icp_stage, 'dewarp': dewarp_stage,
+          'snow_depth': snow_depth_stage}
+
+# Function to run the pipeline described by a config (dictionary), returning a summary of each stage
+def run_pipeline(config, base_dir='.'):
+    state = {'base_dir': base_dir,
+             'crs': config.get('crs', crs),
+             'cellsize': config.get('cellsize', cellsize),
+             'fusion_parameters': config.get('fusion_parameters', fusion_parameters),
+             'ground_path': config_path(config, 'ground_cloud', base_dir),
+             'canopy_path': config_path(config, 'canopy_cloud', base_dir),
+             'reference_ground': config_path(config, 'reference_ground', base_dir),
+             'reference_canopy': config_path(config, 'reference_canopy', base_dir),
+             'write_intermediates': config.get('write_intermediates', False),
+             'threads': config.get('threads', -1),
+             'chain': CorrectionChain()}
+    out_suffix = config.get('output_suffix', 'corrected')
+    for stage in config['stages']:
+        if stage.get('stage') not in stages:
+            raise ValueError('Unknown stage: ' + str(stage.get('stage')))
+    names = [stage['stage'] for stage in config['stages']]
+    if 'thin' in names and 'ground_filter' in names[names.index('thin'):]:
+        raise ValueError('The ground_filter stage must come before the thin stage (it filters the full density clouds)')
+
+    tracing.start_trace(config_path(config, 'trace', base_dir))
+
+    # If requested, build the spatial indexes of the reference clouds (if they are not already up to date)
+    if config.get('index_references', False):
+        for name in ('reference_ground', 'reference_canopy'):
+            with tracing.stage('build_index', cloud=state[name]):
+                build_index(state[name])
+
+    # Read the input clouds (once)
+    with tracing.stage('read_clouds') as record:
+        state['ground'] = read_cloud(state['ground_path'])
+        state['canopy'] = read_cloud(state['canopy_path'])
+        record['points'] = len(state['ground'].points) + len(state['canopy'].points)
+
+    summary = []
+    for (k, stage) in enumerate(config['stages']):
+        print('Stage ' + str(k+1) + ': ' + stage['stage'])
+        start = time.time()
+        with tracing.stage(stage['stage'], index=k+1) as record:
+            record['points'] = len(state['ground'].points) + len(state['canopy'].points)
+            result = stages[stage['stage']](state, stage)
+        result.update({'stage': stage['stage'], 'seconds': time.time() - start})
+        summary.append(result)
+
+        # If requested, write the intermediate clouds
+        if state['write_intermediates'] and stage['stage'] not in ('ground_filter', 'thin', 'snow_depth'):
+            clouds = full_clouds(state)
+            for name in ('ground', 'canopy'):
+                write_cloud(clouds[name], output_cloud(state[name + '_path'], out_suffix + '_' + str(k+1) + '_' + stage['stage']))
+
+    # Write the output clouds (at full density, along with the chain of corrections that was applied to them)
+    with tracing.stage('apply_corrections') as record:
+        clouds = full_clouds(state)
+        record['points'] = len(clouds['ground'].points) + len(clouds['canopy'].points)
+    for name in ('ground', 'canopy'):
+        outcloud = output_cloud(state[name + '_path'], out_suffix)
+        print('Writing ' + outcloud)
+        with tracing.stage('write_cloud', cloud=outcloud) as record:
+            write_cloud(clouds[name], outcloud)
+            record['points'] = len(clouds[name].points)
+        state['chain'].save(sidecar_file(outcloud))
+    return summary
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    argv = gdal.GeneralCmdLineProcessor( sys.argv )
+    if len(argv) < 2:
+        print('Usage: python pipeline.py <Config File>')
+        sys.exit(1)
+    config_file = argv[1]
+    if not os.path.exists(config_file):
+        print('Error: ' + config_file + ' does not exist!')
+        sys.exit(1)
+
+    with open(config_file) as f:
+        config = json.load(f)
+    summary = run_pipeline(config, os.path.dirname(os.path.abspath(config_file)))
+    for result in summary:
+        print(result['stage'] + ': ' + str(round(result['seconds'], 2)) + ' s')
@@ -0,0 +1,195 @@
+import copy
+import numpy as np
+import laspy
+from npc import npc_file, NpcReader, NpcWriter
+
+# Chunked, bounded-memory point cloud I/O shared by the processing scripts.  Points are read from LAS/LAZ files in fixed-size
+# chunks and handed out as structured NumPy arrays with the fields x, y, z and classification, so the peak memory used by a
+# stage depends on the chunk size and not on the size of the cloud.  A matching chunked writer writes points back out using
+# the header (including the point format, scale/offset and VLRs) of a template cloud.
+#
+# Clouds are read and written as LAS/LAZ or, if their path ends in .npc, in an uncompressed memory-mapped format for
+# intermediate clouds (see npc.py), from which the points are handed out without decoding or copying them.
+#
+# Usage (from another script):
+#   from point_io import read_header, read_chunks, read_points, ChunkWriter
+#   for pts in read_chunks(<cloud>):                      # pts['x'], pts['y'], pts['z'], pts['classification']
+#       ...
+#   xyz = read_points(<cloud>, max_points=100000)         # (n, 3) array of a random sample of the points
+#   pts = read_runs(<cloud>, starts, 16)                  # Only the 16 points from each of the (sorted) indexes in starts
+#   (pts, run) = read_runs(<cloud>, starts, 16, return_runs=True)      # (and which of the runs each point is from)
+#   las = read_cloud(<cloud>)                             # Whole cloud in memory (only for clouds that fit in memory)
+#   with ChunkWriter(<output cloud>, read_header(<cloud>)) as writer:
+#       for (pts, records) in read_chunks(<cloud>, records=True):
+#           pts['z'] += 1
+#           writer.write(pts, records)                    # Passing the records preserves all other point attributes
+#
+# Note that this requires the laspy library (and the lazrs or laszip backend to read and write .laz files)
+
+# Number of points to read at a time
+chunk_size = 1000000
+
+# Number of points in each compressed chunk of a LAZ file (the default of LAStools and laspy)
+laz_chunk_size = 50000
+
+# Largest gap (in points) between runs of points in a LAS file that is read through instead of seeking (see read_runs)
+las_span_gap = 4096
+
+# Fields of the structured arrays handed out by the reader
+point_dtype = np.dtype([('x', np.float64), ('y', np.float64), ('z', np.float64), ('classification', np.uint8)])
+
+# Function to read the header of a point cloud
+def read_header(cloud):
+    if npc_file(cloud):
+        return NpcReader(cloud).header
+    with laspy.open(cloud) as reader:
+        return reader.header
+
+# Function to get the bounds (xmin, ymin, xmax, ymax) of a point cloud from its header
+def cloud_bounds(cloud):
+    header = read_header(cloud)
+    return (header.mins[0], header.mins[1], header.maxs[0], header.maxs[1])
+
+# Function to convert laspy point records to a structured array
+def to_structured(records):
+    pts = np.empty(len(records), dtype=point_dtype)
+    pts['x'] = records.x
+    pts['y'] = records.y
+    pts['z'] = records.z
+    pts['classification'] = records.classification
+    return pts
+
+# Function to iterate over a point cloud in fixed-size chunks
+def read_chunks(cloud, chunk_size=chunk_size, records=False):
+    """Yield structured arrays of points (or (points, laspy records) pairs if records is True)"""
+    if npc_file(cloud):
+        for (pts, chunk) in NpcReader(cloud).chunks(chunk_size):
+            yield (pts, chunk) if records else pts
+        return
+    with laspy.open(cloud) as reader:
+        for chunk in reader.chunk_iterator(chunk_size):
+            if records:
+                yield (to_structured(chunk), chunk)
+            else:
+                yield to_structured(chunk)
+
+# Function to read the x, y, z coordinates of a point cloud into an (n, 3) array, optionally only keeping the points inside
+# an extent (xmin, ymin, xmax, ymax) and a random sample of (approximately) max_points points.  If a chain of corrections
+# (see correction_chain.py) is given, the points are corrected as they are read.
+def read_points(cloud, extent=None, max_points=None, seed=None, chain=None):
+    fraction = 1.0
+    if max_points is not None:
+        fraction = min(1.0, max_points / max(1, read_header(cloud).point_count))
+    rng = np.random.default_rng(seed)
+    xyz = []
+    for pts in read_chunks(cloud):
+        if chain is not None:
+            (pts, _) = chain.apply(pts)
+        keep = np.ones(len(pts), dtype=bool)
+        if extent is not None:
+            (xmin, ymin, xmax, ymax) = extent
+            keep &= (pts['x'] >= xmin) & (pts['x'] <= xmax) & (pts['y'] >= ymin) & (pts['y'] <= ymax)
+        if fraction < 1.0:
+            keep &= rng.random(len(pts)) < fraction
+        xyz.append(np.column_stack((pts['x'][keep], pts['y'][keep], pts['z'][keep])))
+    if len(xyz) == 0:
+        return np.empty((0, 3))
+    return np.concatenate(xyz)
+
+# Function to read runs of `length` consecutive points, starting at each of a (sorted) list of point indexes, into a single
+# structured array.  Only the parts of the cloud around the runs are read: runs that are close to each other are read as one
+# span (keeping only the points of the runs), and the reader seeks from one span to the next.  Seeking in a LAZ file means
+# decompressing from the start of the compressed chunk it lands in, so runs up to a chunk apart are read through instead.
+# With return_runs, the (position in starts of the) run each point is from is returned as well.
+def read_runs(cloud, starts, length, return_runs=False):
+    starts = np.asarray(starts, dtype=np.int64)
+    (pieces, runs) = ([], [])
+    if npc_file(cloud):
+        offset = 0
+        for (pts, _) in NpcReader(cloud).chunks():
+            for (i, start) in enumerate(starts):
+                (a, b) = (max(start, offset), min(start + length, offset + len(pts)))
+                if a < b:
+                    pieces.append(np.array(pts[a-offset:b-offset]))
+                    runs.append(np.full(b - a, i))
+            offset += len(pts)
+    else:
+        with laspy.open(cloud) as reader:
+            compressed = reader.header.are_points_compressed
+            gap = laz_chunk_size if compressed else las_span_gap
+            position = 0
+            k = 0
+            while k < len(starts):
+                j = k + 1
+                while j < len(starts) and starts[j] - starts[j-1] <= gap and starts[j] - starts[k] < chunk_size:
+                    j += 1
+                first = int(starts[k])
+                if not (compressed and position <= first <= position + gap):
+                    reader.seek(first)
+                    position = first
+                pts = to_structured(reader.read_points(int(starts[j-1]) + length - position))
+                index = (starts[k:j, None] - position + np.arange(length)[None, :]).ravel()
+                valid = (index >= 0) & (index < len(pts))
+                pieces.append(pts[index[valid]])
+                runs.append(np.repeat(np.arange(k, j), length)[valid])
+                position += len(pts)
+                k = j
+    if len(pieces) == 0:
+        (pieces, runs) = ([np.empty(0, dtype=point_dtype)], [np.empty(0, dtype=np.int64)])
+    if return_runs:
+        return (np.concatenate(pieces), np.concatenate(runs))
+    return np.concatenate(pieces)
+
+# Function to read a whole point cloud into memory (as a laspy LasData object, which keeps all of the point attributes)
+def read_cloud(cloud):
+    if npc_file(cloud):
+        reader = NpcReader(cloud)
+        records = [np.array(chunk.array) for (_, chunk) in reader.chunks()]
+        records = np.concatenate(records) if len(records) > 0 else np.zeros(0, dtype=reader.record_dtype)
+        las = laspy.LasData(copy.deepcopy(reader.header))
+        las.points = laspy.ScaleAwarePointRecord(records, reader.header.point_format, reader.header.scales, reader.header.offsets)
+        return las
+    return laspy.read(cloud)
+
+# Function to write a whole (in memory) point cloud
+def write_cloud(las, cloud):
+    if npc_file(cloud):
+        with ChunkWriter(cloud, las.header) as writer:
+            writer.write(to_structured(las.points), las.points)
+        return
+    las.write(cloud, do_compress=cloud.lower().endswith('.laz'))
+
+# Class to write a point cloud in chunks
+class ChunkWriter:
+    """Write chunks of points to a LAS/LAZ file (compressed if the file name ends in .laz) or an .npc file using a template
+    header"""
+
+    def __init__(self, cloud, header):
+        if npc_file(cloud):
+            self.writer = NpcWriter(cloud, header)
+        else:
+            self.writer = laspy.open(cloud, mode='w', header=header, do_compress=cloud.lower().endswith('.laz'))
+        self.npoints = 0
+
+    def write(self, pts, records=None):
+        """Write a structured array of points; other attributes are taken from the matching records (if given)"""
+        if records is None:
+            records = laspy.ScaleAwarePointRecord.zeros(len(pts), header=self.writer.header)
+        records.x = pts['x']
+        records.y = pts['y']
+        records.z = pts['z']
+        records.classification = pts['classification']
+        if isinstance(self.writer, NpcWriter):
+            self.writer.write(pts, records)
+        else:
+            self.writer.write_points(records)
+        self.npoints += len(pts)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
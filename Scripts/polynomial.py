@@ -0,0 +1,146 @@
+import itertools
+import numpy as np
+
+# Two dimensional polynomial surface models, used to describe smooth (e.g. tilting or gentle warping) distortion in SfM
+# point clouds.  Coefficients are ordered as itertools.product(range(order+1), range(order+1)), i.e. the k'th coefficient
+# multiplies x**i * y**j
+#
+# Usage (from another script):
+#   from polynomial import polyfit2d, polyval2d, polygrid2d
+#   m = polyfit2d(x, y, z, order)       # Fit a polynomial model to (x, y, z) data
+#   z = polyval2d(x, y, m)              # Evaluate it at (x, y), which can be grids or individual points
+#   zz = polygrid2d(xs, ys, m)          # Evaluate it on the grid defined by the 1D coordinate vectors xs and ys
+#
+# Fitting accumulates the normal equations chunk by chunk (see PolyNormalEquations), so memory grows with the number of
+# coefficients rather than with the number of data points.  Coordinates are internally scaled to about [-1, 1] to keep the
+# normal equations well conditioned.  With robust=True, the fit is done with iteratively reweighted least squares (using
+# Tukey's biweight), so that outliers (e.g. cells with debris on the ground) do not skew the fit, starting from an ordinary
+# least squares fit or, if given, an initial set of coefficients (e.g. from a fit to a coarser grid).  Evaluation uses Horner's
+# scheme (polyval2d) or a separable outer product (polygrid2d), neither of which allocates an array per term.
+
+# Number of data points used at a time when accumulating the normal equations
+chunk_size = 1000000
+
+# Tuning constant for Tukey's biweight (in units of the robust standard deviation of the residuals)
+biweight_c = 4.685
+
+# Function to list the (i, j) powers of the terms of a polynomial model of a given order
+def poly_terms(order):
+    return list(itertools.product(range(order+1), range(order+1)))
+
+# Function to compute the polynomial order from a set of coefficients
+def poly_order(m):
+    return int(round(np.sqrt(len(m)))) - 1
+
+# Class that accumulates the normal equations (G'WG and G'Wz) of a polynomial fit, so that they can be built up from
+# chunks of data (or from statistics computed separately, e.g. on different tiles, that are added together)
+class PolyNormalEquations:
+    """Normal equations of a 2D polynomial least squares fit, in coordinates scaled by (sx, sy)"""
+
+    def __init__(self, order, scale=(1.0, 1.0)):
+        self.order = order
+        self.terms = poly_terms(order)
+        self.scale = (float(scale[0]) or 1.0, float(scale[1]) or 1.0)
+        self.GtG = np.zeros((len(self.terms), len(self.terms)))
+        self.Gtz = np.zeros(len(self.terms))
+        self.n = 0
+
+    def design(self, x, y):
+        """Design matrix of the scaled coordinates"""
+        u = np.asarray(x, dtype=np.float64) / self.scale[0]
+        v = np.asarray(y, dtype=np.float64) / self.scale[1]
+        G = np.empty((u.size, len(self.terms)))
+        for k, (i,j) in enumerate(self.terms):
+            G[:,k] = u**i * v**j
+        return G
+
+    def add(self, x, y, z, weights=None):
+        """Add data points (with optional weights) to the normal equations"""
+        for start in range(0, np.size(x), chunk_size):
+            G = self.design(x[start:start+chunk_size], y[start:start+chunk_size])
+            zc = np.asarray(z[start:start+chunk_size], dtype=np.float64)
+            if weights is not None:
+                w = np.asarray(weights[start:start+chunk_size], dtype=np.float64)
+                self.GtG += G.T @ (G * w[:, None])
+                self.Gtz += G.T @ (zc * w)
+            else:
+                self.GtG += G.T @ G
+                self.Gtz += G.T @ zc
+            self.n += zc.size
+
+    def merge(self, other):
+        """Add the normal equations accumulated by another instance (with the same order and scale)"""
+        self.GtG += other.GtG
+        self.Gtz += other.Gtz
+        self.n += other.n
+
+    def solve(self):
+        """Solve the normal equations, returning coefficients for the unscaled coordinates"""
+        a, _, _, _ = np.linalg.lstsq(self.GtG, self.Gtz, rcond=None)
+        return np.array([a[k] / (self.scale[0]**i * self.scale[1]**j) for k, (i,j) in enumerate(self.terms)])
+
+# Function to compute Tukey's biweight weights from a set of residuals
+def biweights(residuals):
+    mad = np.median(np.abs(residuals - np.median(residuals)))
+    sigma = 1.4826 * mad
+    if sigma == 0:
+        return np.ones_like(residuals)
+    r = residuals / (biweight_c * sigma)
+    return np.where(np.abs(r) < 1, (1 - r**2)**2, 0.0)
+
+# Function to fit a polynomial model to (x, y, z) data (e.g. the cells of a 2D raster)
+def polyfit2d(x, y, z, order, robust=False, iterations=20, tol=1e-6, weights=None, initial=None):
+    x = np.asarray(x).reshape(-1)
+    y = np.asarray(y).reshape(-1)
+    z = np.asarray(z).reshape(-1)
+    scale = (np.max(np.abs(x)) if x.size else 1.0, np.max(np.abs(y)) if y.size else 1.0)
+
+    if robust and initial is not None:
+        m = np.asarray(initial, dtype=np.float64)
+    else:
+        neq = PolyNormalEquations(order, scale)
+        neq.add(x, y, z, weights)
+        m = neq.solve()
+
+    # Iteratively reweighted least squares (down-weighting points with large residuals)
+    if robust:
+        fit = polyval2d(x, y, m)
+        for it in range(iterations):
+            w = biweights(z - fit)
+            if weights is not None:
+                w = w * weights
+            neq = PolyNormalEquations(order, scale)
+            neq.add(x, y, z, w)
+            m = neq.solve()
+            new_fit = polyval2d(x, y, m)
+            converged = np.max(np.abs(new_fit - fit)) < tol
+            fit = new_fit
+            if converged:
+                break
+    return m
+
+# Function to evaluate a polynomial model at a set of points (or on a 2D raster), using Horner's scheme
+def polyval2d(x, y, m, dtype=np.float64):
+    order = poly_order(m)
+    M = np.asarray(m, dtype=dtype).reshape(order+1, order+1)
+    x = np.asarray(x, dtype=dtype)
+    y = np.asarray(y, dtype=dtype)
+    z = np.zeros(np.broadcast(x, y).shape, dtype=dtype)
+    for i in range(order, -1, -1):
+        # Evaluate the polynomial in y that multiplies x**i
+        c = np.full(z.shape, M[i, order], dtype=dtype)
+        for j in range(order-1, -1, -1):
+            c *= y
+            c += M[i, j]
+        z *= x
+        z += c
+    return z
+
+# Function to evaluate a polynomial model on the grid defined by the 1D coordinate vectors xs (columns) and ys (rows),
+# as a separable outer product (the result has shape (len(ys), len(xs)))
+def polygrid2d(xs, ys, m, dtype=np.float32):
+    order = poly_order(m)
+    M = np.asarray(m, dtype=np.float64).reshape(order+1, order+1)
+    X = np.vander(np.asarray(xs, dtype=np.float64), order+1, increasing=True)     # X[c, i] = xs[c]**i
+    Y = np.vander(np.asarray(ys, dtype=np.float64), order+1, increasing=True)     # Y[r, j] = ys[r]**j
+    return (Y @ M.T).astype(dtype) @ X.T.astype(dtype)
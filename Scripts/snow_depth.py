@@ -0,0 +1,227 @@
+import sys, os, shutil
+import tempfile
+from osgeo import gdal, osr
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from grid_surface import aligned_extent, create_raster, finish_raster
+from point_io import read_header, cloud_bounds
+import tiling
+from tiling import make_tiles, split_cloud, grid_tile, tile_file, tile_dtype, map_tiles
+from correction_chain import CorrectionChain
+from tracing import start_trace, stage
+
+# Computes snow depth products from a corrected snow-on ground cloud and a (snow-off) reference ground cloud.  The snow depth
+# of each snow-on point is its elevation minus the reference surface (the mean elevation of the reference points) in the
+# cell of the finest resolution it falls in, and for each resolution a raster is written with the count, mean, median and
+# standard deviation of the snow depths of the points in each cell.  All of the resolutions are computed from a single read
+# of each cloud: both clouds are split into tiles (see tiling.py) in one streaming pass, and then the statistics of every
+# resolution are computed tile by tile (in parallel), so no full-domain grid is ever held in memory.
+#
+# Usage: python snow_depth.py <options> <Snow-on Ground Cloud> <Reference Ground Cloud> <Output Prefix>
+#
+# Snow-on Ground Cloud: Path to the corrected snow-on ground point cloud
+# Reference Ground Cloud: Path to the reference (snow-off) ground point cloud
+# Output Prefix: Prefix of the output rasters, which are named <Output Prefix>_<resolution>m.tif and have four bands: the
+#       number of points, and the mean, median and standard deviation of their snow depths (in cm)
+# Options:
+# -s, --resolutions: Resolutions (in map units, separated by commas) of the output rasters, each of which must be a whole
+#       multiple of the finest one (defaults to 0.5,1,5,10)
+# -c, --chain: Correction chain file (see correction_chain.py), which is applied to the snow-on cloud as it is read (e.g. to
+#       make the products straight from the uncorrected cloud)
+# --tile_size: Size of the tiles the domain is processed in (in map units, rounded up to a multiple of the block size, see
+#       below; defaults to 1000)
+# -w, --workers: Number of tiles to process at the same time (defaults to the number of cores)
+# --trace: Write a trace of the time, memory and points processed by each step to this file (JSON lines, or Chrome trace
+#       format if it ends in .json; see tracing.py)
+#
+# Points that fall in cells of the finest resolution without any reference points are left out.  The domain and the tiles
+# are aligned to multiples of a block size, the smallest size that is a whole multiple of every resolution (the coarsest
+# resolution, unless some resolution is not a multiple of the finer ones, e.g. 1,3,4 give blocks of 12), so every tile
+# is made of whole cells of each resolution and the cells of the finest resolution nest exactly inside those of the others.
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Default resolutions of the products
+resolutions = [0.5, 1, 5, 10]
+
+# Names of the bands of the output rasters
+band_names = ['count', 'mean', 'median', 'std']
+
+# Function to check a list of resolutions, returning them sorted along with the factor of each relative to the finest one
+def resolution_factors(resolutions):
+    resolutions = sorted(float(r) for r in resolutions)
+    factors = [int(round(r / resolutions[0])) for r in resolutions]
+    for (r, f) in zip(resolutions, factors):
+        if abs(r - f * resolutions[0]) > 1e-6 * r:
+            raise ValueError('Resolution ' + str(r) + ' is not a whole multiple of ' + str(resolutions[0]))
+    return (resolutions, factors)
+
+# Function to compute the block size of a (checked) list of resolutions (the smallest size that is a whole multiple of all of them)
+def block_size(resolutions, factors):
+    return resolutions[0] * int(np.lcm.reduce(factors))
+
+# Function to name the output raster of one resolution
+def product_file(out_prefix, resolution):
+    return out_prefix + '_' + ('%g' % resolution) + 'm.tif'
+
+# Function to compute the count, mean, median and standard deviation of the snow depths of the points in each cell of a grid
+# coarsened by a factor (rows and cols are the cells of the points on the finest grid, of size height x width), returning a
+# (4, height/factor, width/factor) array (NaN where there are no points)
+def depth_statistics(rows, cols, depth, height, width, factor):
+    (h, w) = (-(-height // factor), -(-width // factor))
+    key = (rows // factor) * w + cols // factor
+    order = np.lexsort((depth, key))
+    (key, depth) = (key[order], depth[order])
+    count = np.bincount(key, minlength=h*w)
+    stats = np.full((4, h*w), np.nan)
+    stats[0] = count
+    has_points = count > 0
+    if np.any(has_points):
+        mean = np.bincount(key, weights=depth, minlength=h*w)[has_points] / count[has_points]
+        stats[1, has_points] = mean
+        # (the points of each cell are sorted by depth, so the median is the middle one, or the mean of the middle two)
+        start = np.concatenate(([0], np.cumsum(count)[:-1]))[has_points]
+        n = count[has_points]
+        stats[2, has_points] = (depth[start + (n - 1) // 2] + depth[start + n // 2]) / 2
+        squares = np.bincount(key, weights=(depth - np.repeat(mean, n))**2, minlength=h*w)[has_points]
+        stats[3, has_points] = np.sqrt(squares / n)
+    return stats.reshape(4, h, w)
+
+# Function to compute the snow depth of the points of a cloud (relative to a reference surface on the finest grid, with
+# the given geotransform), returning the cells of the points that are over the reference surface and their snow depths
+def point_depths(x, y, z, reference_z, gt):
+    rows = np.floor((gt[3] - y) / -gt[5]).astype(np.int64)
+    cols = np.floor((x - gt[0]) / gt[1]).astype(np.int64)
+    inside = (rows >= 0) & (rows < reference_z.shape[0]) & (cols >= 0) & (cols < reference_z.shape[1])
+    (rows, cols) = (rows[inside], cols[inside])
+    depth = z[inside] - reference_z[rows, cols]
+    valid = ~np.isnan(depth)
+    return (rows[valid], cols[valid], depth[valid])
+
+# Function to compute the statistics of every resolution on one tile (runs in a worker process)
+def tile_depth_statistics(tiling, tile_dir, tile, factors=None):
+    (r0, c0, r1, c1) = tile['core']
+    reference_z = grid_tile(tiling, tile_dir, 'reference', tile)
+    (rows, cols, depth) = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+    path = tile_file(tile_dir, 'sfm', tile)
+    if os.path.exists(path):
+        records = np.fromfile(path, dtype=tile_dtype)
+        (rows, cols) = (records['row'] - r0, records['col'] - c0)
+        depth = records['z'] - reference_z[rows, cols]
+        valid = ~np.isnan(depth)
+        (rows, cols, depth) = (rows[valid], cols[valid], depth[valid])
+    return [depth_statistics(rows, cols, depth, r1 - r0, c1 - c0, f) for f in factors]
+
+# Function to create the output rasters of a set of resolutions (on a domain aligned to their block size)
+def create_products(out_prefix, extent, resolutions, projection):
+    (ulx, lry, lrx, uly) = extent
+    outdata = []
+    for r in resolutions:
+        width = int(round((lrx - ulx) / r))
+        height = int(round((uly - lry) / r))
+        ds = create_raster(product_file(out_prefix, r), width, height, (ulx, r, 0.0, uly, 0.0, -r), projection, len(band_names))
+        for (k, name) in enumerate(band_names):
+            ds.GetRasterBand(k+1).SetDescription(name)
+        outdata.append(ds)
+    return outdata
+
+# Function to write the statistics of one resolution (or of one tile of it) to an output raster (in cm)
+def write_statistics(ds, stats, xoff=0, yoff=0):
+    for k in range(len(band_names)):
+        band = stats[k] * (100 if k > 0 else 1)
+        band[np.isnan(band)] = -9999
+        ds.GetRasterBand(k+1).WriteArray(band, int(xoff), int(yoff))
+
+# Function to write the snow depth products of a snow-on and a reference ground cloud (reading each cloud once), returning
+# the names of the rasters written
+def snow_depth_products(incloud, ref_cloud, out_prefix, resolutions=resolutions, chain=None, tile_size=tiling.tile_size,
+                        workers=None, crs=crs):
+    (resolutions, factors) = resolution_factors(resolutions)
+    t_srs = osr.SpatialReference()
+    t_srs.ImportFromEPSG(crs)
+
+    # Split the domain (aligned to the block size) into tiles made up of whole cells of every resolution (with a chain, the
+    # domain covers the bounds of the cloud moved through the chain, so the cloud is not read to find it)
+    block = block_size(resolutions, factors)
+    if chain is not None and len(chain) > 0:
+        header = read_header(incloud)
+        extent = aligned_extent(*chain.bounds(header.mins, header.maxs), cellsize=block)
+    else:
+        extent = aligned_extent(*cloud_bounds(incloud), cellsize=block)
+    tile_size = np.ceil(tile_size / block) * block
+    tiles = make_tiles(extent, tile_size, resolutions[0])
+    print('Splitting the domain into ' + str(len(tiles['tiles'])) + ' tiles')
+
+    tile_dir = tempfile.mkdtemp()
+    try:
+        for (cloud, name) in ((incloud, 'sfm'), (ref_cloud, 'reference')):
+            with stage('split_cloud', cloud=cloud, tiles=len(tiles['tiles'])) as record:
+                record['points'] = split_cloud(cloud, tiles, tile_dir, name, chain=chain if name == 'sfm' else None)
+
+        # Compute the statistics of each tile and write them to the rasters of each resolution
+        outdata = create_products(out_prefix, extent, resolutions, t_srs.ExportToWkt())
+        for (tile, stats) in map_tiles(tile_depth_statistics, tiles, tile_dir, workers, factors=factors):
+            for (ds, f, s) in zip(outdata, factors, stats):
+                write_statistics(ds, s, tile['core'][1] // f, tile['core'][0] // f)
+        for ds in outdata:
+            finish_raster(ds)
+        outdata = None
+    finally:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+    return [product_file(out_prefix, r) for r in resolutions]
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] input_file(s) [output]'
+    p = OptionParser(usage)
+    p.add_option('-s', '--resolutions', dest='resolutions', default=','.join('%g' % r for r in resolutions), help='Resolutions of the output rasters (separated by commas)')
+    p.add_option('-c', '--chain', dest='chain', help='Correction chain file to apply to the snow-on cloud as it is read')
+    p.add_option('--tile_size', dest='tile_size', type='float', default=tiling.tile_size, help='Size of the tiles the domain is processed in (in map units)')
+    p.add_option('-w', '--workers', dest='workers', type='int', help='Number of tiles to process at the same time (defaults to the number of cores)')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    argv = gdal.GeneralCmdLineProcessor( sys.argv )
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    start_trace(options.trace)
+    if len(args) < 3:
+        parser.print_help()
+        sys.exit(1)
+    incloud_ground = args[0]        # Snow-on ground point cloud
+    ref_cloud_ground = args[1]      # Reference ground point cloud
+    out_prefix = args[2]            # Prefix of the output rasters
+
+    # Check for the existance of the input and reference clouds
+    path_errors = False
+    for cloud in (incloud_ground, ref_cloud_ground):
+        if not os.path.exists(cloud):
+            print('Error: ' + cloud + ' does not exist!')
+            path_errors = True
+    if path_errors == True:
+        sys.exit()
+    try:
+        product_resolutions = [float(r) for r in options.resolutions.split(',')]
+        resolution_factors(product_resolutions)
+    except ValueError as e:
+        print('Error: ' + str(e))
+        sys.exit(1)
+
+    # If specified, load the chain of corrections (the snow-on cloud is read with these applied)
+    chain = None
+    if options.chain != None:
+        chain = CorrectionChain.load(options.chain)
+
+    with stage('snow_depth_products', resolutions=options.resolutions):
+        outrasters = snow_depth_products(incloud_ground, ref_cloud_ground, out_prefix, product_resolutions, chain,
+                                         options.tile_size, options.workers)
+    for outraster in outrasters:
+        print('Wrote ' + outraster)
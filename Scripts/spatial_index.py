@@ -0,0 +1,278 @@
+import sys, os
+import json
+import struct
+import shutil
+import tempfile
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from point_io import read_header, read_chunks, point_dtype, chunk_size
+
+# Persistent spatial index for reference clouds that are used over and over again (e.g. the snow-off clouds that every
+# snow-on flight of a season is registered to).  The index is built once and stored next to the cloud (<cloud>.idx): a
+# copy of the points, sorted into square buckets, along with the offset of each bucket in the file.  Later runs memory-map
+# the index and only read the buckets that overlap the extent they need, instead of decoding and filtering the whole cloud.
+#
+# Usage (to build the index of one or more clouds): python spatial_index.py <options> <Cloud> [<Cloud> ...]
+#
+# Options:
+# -b, --bucket_size: Size of the buckets (in map units; by default chosen so that buckets hold about 65536 points)
+# --force: Rebuild the index even if it is up to date
+#
+# Usage (from another script):
+#   from spatial_index import indexed_chunks, indexed_points
+#   for pts in indexed_chunks(<cloud>, extent):               # Only the points inside the extent (xmin, ymin, xmax, ymax)
+#       ...
+#   xyz = indexed_points(<cloud>, extent)                     # Same as read_points(<cloud>, extent=extent)
+#   index = open_index(<cloud>)                               # None if the cloud has no (up to date) index
+#   for pts in index.near(xy, margin):                        # Points in the buckets around a set of (x, y) locations
+# Both use the index if there is an up to date one, and otherwise read the cloud itself (so building an index only ever
+# makes things faster).  The index records the size and modification time of the cloud it was built from, and is ignored
+# if the cloud changes.
+#
+# Layout of an index file (as with .npc files, see npc.py):
+#   magic | bucket offsets (int64) | points | footer (JSON) | length of the footer (8 bytes, little endian) | magic
+# The buckets are stored row by row (from the bottom of the cloud up), so the buckets of one row of an extent are
+# contiguous in the file and are read with a single slice.
+#
+# Note that an index takes about as much space as an uncompressed (LAS) copy of the x, y, z and classification of the points
+
+# Magic number at the start and end of index files
+magic = b'SIDX\x01\x00\x00\x00'
+
+# Alignment (in bytes) of the arrays in the file
+alignment = 64
+
+# Number of points per bucket that the default bucket size aims for
+bucket_points = 65536
+
+# Function to name the index of a cloud
+def index_file(cloud):
+    return cloud + '.idx'
+
+# Function to round a file position up to the alignment
+def aligned(position):
+    return (position + alignment - 1) // alignment * alignment
+
+# Function to describe the cloud an index was built from (to tell whether the index is out of date)
+def source_stamp(cloud):
+    stat = os.stat(cloud)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+# Class to query an index file
+class SpatialIndex:
+    """Memory-mapped, bucketed copy of the points of a cloud"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(path + ' is not a spatial index')
+            f.seek(-len(magic) - 8, os.SEEK_END)
+            (length,) = struct.unpack('<Q', f.read(8))
+            if f.read(len(magic)) != magic:
+                raise ValueError(path + ' is incomplete')
+            f.seek(-len(magic) - 8 - length, os.SEEK_END)
+            self.footer = json.loads(f.read(length).decode())
+        self.bucket_size = self.footer['bucket_size']
+        (self.x0, self.y0) = self.footer['origin']
+        (self.ncols, self.nrows) = (self.footer['ncols'], self.footer['nrows'])
+        self.offsets = np.memmap(path, dtype=np.int64, mode='r', offset=self.footer['offsets'],
+                                 shape=(self.ncols * self.nrows + 1,))
+        self.points = None
+        if self.footer['count'] > 0:
+            self.points = np.memmap(path, dtype=np.dtype([tuple(field) for field in self.footer['point_dtype']]), mode='r',
+                                    offset=self.footer['points'], shape=(self.footer['count'],))
+
+    def up_to_date(self, cloud):
+        """Check whether the index was built from the current version of a cloud"""
+        return self.footer['source'] == source_stamp(cloud)
+
+    def chunks(self, extent=None, chunk_size=chunk_size):
+        """Yield structured arrays of the points inside an extent (xmin, ymin, xmax, ymax), reading only the buckets that
+        overlap it"""
+        if self.points is None:
+            return
+        if extent is None:
+            (c0, r0, c1, r1) = (0, 0, self.ncols - 1, self.nrows - 1)
+        else:
+            (xmin, ymin, xmax, ymax) = extent
+            c0 = max(0, int(np.floor((xmin - self.x0) / self.bucket_size)))
+            r0 = max(0, int(np.floor((ymin - self.y0) / self.bucket_size)))
+            c1 = min(self.ncols - 1, int(np.floor((xmax - self.x0) / self.bucket_size)))
+            r1 = min(self.nrows - 1, int(np.floor((ymax - self.y0) / self.bucket_size)))
+        for r in range(r0, r1 + 1):
+            (start, stop) = (int(self.offsets[r*self.ncols + c0]), int(self.offsets[r*self.ncols + c1 + 1]))
+            for s in range(start, stop, chunk_size):
+                pts = self.points[s:min(s + chunk_size, stop)]
+                if extent is not None:
+                    pts = pts[(pts['x'] >= xmin) & (pts['x'] <= xmax) & (pts['y'] >= ymin) & (pts['y'] <= ymax)]
+                else:
+                    pts = np.array(pts)
+                if len(pts) > 0:
+                    yield pts
+
+    def near(self, xy, margin=0.0, chunk_size=chunk_size):
+        """Yield structured arrays of the points in the buckets within margin of any of a set of (x, y) locations (an (n, 2)
+        array), reading only those buckets"""
+        if self.points is None or len(xy) == 0:
+            return
+        reach = int(np.ceil(margin / self.bucket_size))
+        c = np.floor((xy[:, 0] - self.x0) / self.bucket_size).astype(np.int64)
+        r = np.floor((xy[:, 1] - self.y0) / self.bucket_size).astype(np.int64)
+        buckets = []
+        for dr in range(-reach, reach + 1):
+            for dc in range(-reach, reach + 1):
+                inside = (c + dc >= 0) & (c + dc < self.ncols) & (r + dr >= 0) & (r + dr < self.nrows)
+                buckets.append((r[inside] + dr) * self.ncols + c[inside] + dc)
+        buckets = np.unique(np.concatenate(buckets))
+        if len(buckets) == 0:
+            return
+
+        # Neighbouring buckets are contiguous in the file, so each run of them is read as one slice
+        breaks = np.flatnonzero(np.diff(buckets) != 1)
+        for (first, last) in zip(buckets[np.concatenate(([0], breaks + 1))], buckets[np.concatenate((breaks, [-1]))]):
+            (start, stop) = (int(self.offsets[first]), int(self.offsets[last + 1]))
+            for s in range(start, stop, chunk_size):
+                yield np.array(self.points[s:min(s + chunk_size, stop)])
+
+# Function to build the index of a cloud (unless it already has an up to date one), returning the path of the index
+def build_index(cloud, bucket_size=None, force=False):
+    path = index_file(cloud)
+    if not force and open_index(cloud, quiet=True) is not None:
+        return path
+
+    # Lay out the buckets over the bounds of the cloud
+    header = read_header(cloud)
+    npoints = header.point_count
+    (xmin, ymin) = (header.mins[0], header.mins[1])
+    (xmax, ymax) = (header.maxs[0], header.maxs[1])
+    if bucket_size is None:
+        area = max((xmax - xmin) * (ymax - ymin), 1.0)
+        bucket_size = float(np.sqrt(area * bucket_points / max(npoints, 1)))
+    (x0, y0) = (float(np.floor(xmin / bucket_size) * bucket_size), float(np.floor(ymin / bucket_size) * bucket_size))
+    ncols = int(np.floor((xmax - x0) / bucket_size)) + 1
+    nrows = int(np.floor((ymax - y0) / bucket_size)) + 1
+    nbuckets = ncols * nrows
+
+    def bucket(pts):
+        c = np.clip(np.floor((pts['x'] - x0) / bucket_size).astype(np.int64), 0, ncols - 1)
+        r = np.clip(np.floor((pts['y'] - y0) / bucket_size).astype(np.int64), 0, nrows - 1)
+        return r * ncols + c
+
+    # First pass: count the points in each bucket
+    counts = np.zeros(nbuckets, dtype=np.int64)
+    for pts in read_chunks(cloud):
+        counts += np.bincount(bucket(pts), minlength=nbuckets)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    npoints = int(offsets[-1])
+
+    # Second pass: write each point into its bucket (in a temporary file, moved into place once it is complete)
+    offsets_position = aligned(len(magic))
+    points_position = aligned(offsets_position + offsets.nbytes)
+    end = points_position + npoints * point_dtype.itemsize
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(magic)
+            f.seek(offsets_position)
+            offsets.tofile(f)
+            f.truncate(end)
+        if npoints > 0:
+            out = np.memmap(tmp, dtype=point_dtype, mode='r+', offset=points_position, shape=(npoints,))
+            cursor = offsets[:-1].copy()
+            for pts in read_chunks(cloud):
+                key = bucket(pts)
+                order = np.argsort(key, kind='stable')
+                key = key[order]
+                first = np.searchsorted(key, key, side='left')
+                out[cursor[key] + np.arange(len(key)) - first] = pts[order]
+                cursor += np.bincount(key, minlength=nbuckets)
+            out.flush()
+            del out
+
+        footer = {'count': npoints, 'bucket_size': bucket_size, 'origin': [x0, y0], 'ncols': ncols, 'nrows': nrows,
+                  'offsets': offsets_position, 'points': points_position, 'point_dtype': point_dtype.descr,
+                  'mins': list(header.mins), 'maxs': list(header.maxs), 'source': source_stamp(cloud)}
+        footer = json.dumps(footer).encode()
+        with open(tmp, 'ab') as f:
+            f.write(footer)
+            f.write(struct.pack('<Q', len(footer)))
+            f.write(magic)
+        shutil.copymode(cloud, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+# Function to open the index of a cloud (returns None if there is no index, or it is out of date)
+def open_index(cloud, quiet=False):
+    path = index_file(cloud)
+    if not os.path.exists(path):
+        return None
+    try:
+        index = SpatialIndex(path)
+    except (OSError, ValueError, KeyError):
+        if not quiet:
+            print('Warning: could not read ' + path + ', reading ' + cloud + ' instead')
+        return None
+    if not index.up_to_date(cloud):
+        if not quiet:
+            print('Warning: ' + path + ' is out of date (rebuild it with spatial_index.py), reading ' + cloud + ' instead')
+        return None
+    return index
+
+# Function to iterate over the points of a cloud inside an extent (xmin, ymin, xmax, ymax), using its index if it has one
+def indexed_chunks(cloud, extent, chunk_size=chunk_size):
+    """Yield structured arrays of the points inside the extent"""
+    index = open_index(cloud)
+    if index is not None:
+        yield from index.chunks(extent, chunk_size)
+        return
+    (xmin, ymin, xmax, ymax) = extent
+    for pts in read_chunks(cloud, chunk_size):
+        yield pts[(pts['x'] >= xmin) & (pts['x'] <= xmax) & (pts['y'] >= ymin) & (pts['y'] <= ymax)]
+
+# Function to read the x, y, z coordinates of the points of a cloud inside an extent into an (n, 3) array (using its index
+# if it has one)
+def indexed_points(cloud, extent):
+    xyz = [np.column_stack((pts['x'], pts['y'], pts['z'])) for pts in indexed_chunks(cloud, extent)]
+    if len(xyz) == 0:
+        return np.empty((0, 3))
+    return np.concatenate(xyz)
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] cloud(s)'
+    p = OptionParser(usage)
+    p.add_option('-b', '--bucket_size', dest='bucket_size', type='float', help='Size of the buckets (in map units)')
+    p.add_option('--force', dest='force', action='store_true', help='Rebuild the index even if it is up to date')
+    p.set_defaults(force=False)
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    p = optparse_init()
+    (options, args) = p.parse_args(args=sys.argv[1:])
+    if len(args) < 1:
+        p.print_help()
+        print('Usage: python spatial_index.py <options> <Cloud> [<Cloud> ...]')
+        sys.exit(1)
+    for cloud in args:
+        if not os.path.exists(cloud):
+            print('Error: ' + cloud + ' does not exist!')
+            sys.exit(1)
+
+    for cloud in args:
+        if not options.force and open_index(cloud, quiet=True) is not None:
+            print(index_file(cloud) + ' is up to date')
+            continue
+        print('Building ' + index_file(cloud))
+        index = SpatialIndex(build_index(cloud, options.bucket_size, force=True))
+        print('Indexed ' + str(index.footer['count']) + ' points in ' + str(index.ncols) + ' x ' + str(index.nrows) +
+              ' buckets of ' + str(round(index.bucket_size, 2)) + ' map units')
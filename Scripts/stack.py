@@ -0,0 +1,229 @@
+import sys, os
+import re
+import datetime
+from osgeo import gdal, osr
+import numpy as np
+import netCDF4
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from grid_surface import grid_surface, aligned_extent
+from surface_cache import cached_grid_surface
+from point_io import cloud_bounds
+from tracing import start_trace, stage
+
+# Stacks the corrected ground clouds of many flights over one site (e.g. the snow-on flights of a season) into a single data
+# cube of their differences from a shared reference ground cloud.  Each flight is gridded on a common grid (the cellsize from
+# GeoRefPars() and the extent of the cube), and its difference from the reference surface (in cm) is written as one time step
+# of a chunked, compressed NetCDF file with an unlimited time dimension.  New flights are appended to the end of the cube as
+# they arrive, without rewriting the time steps that are already in it.
+#
+# Usage: python stack.py <options> <Cube File> <Reference Ground Cloud> <Flight Ground Cloud> [<Flight Ground Cloud> ...]
+#
+# Cube File: Path to the NetCDF file (created if it does not exist, and appended to otherwise)
+# Reference Ground Cloud: Path to the reference (e.g. snow-off) ground point cloud
+# Flight Ground Cloud: Path to the corrected ground point cloud of a flight (in the order of the flights)
+# Options:
+# -d, --dates: Dates of the flights (YYYY-MM-DD, separated by commas).  By default, the date of each flight is taken from its
+#       path (the last date written as YYYYMMDD or YYYY-MM-DD in it)
+# -e, --extent: Extent of the cube (xmin,ymin,xmax,ymax), when it is created (defaults to the extent of the reference cloud)
+# --chunks: Size of the chunks of the cube (time,rows,columns; defaults to 8,128,128)
+# --replace: Replace the time steps of flights whose date is already in the cube (by default they are skipped)
+# --no_cache: Always grid the reference cloud (by default, gridded reference surfaces are kept in a cache, see surface_cache.py)
+# --trace: Write a trace of the time, memory and points processed by each step to this file (JSON lines, or Chrome trace
+#       format if it ends in .json; see tracing.py)
+#
+# The cube has the variables difference(time, y, x) (in cm, -9999 where either surface is missing), x and y (the coordinates
+# of the centres of the cells), time (days since 1970-01-01) and flight(time) (the path of the cloud of each flight), and the
+# coordinate system of the grid in the crs variable (which GDAL and most GIS software read).  The time series of one cell is
+# read with, for example:
+#   netCDF4.Dataset(<Cube File>)['difference'][:, row, col]
+# Chunks hold several time steps, so a time series is read from a few chunks instead of one per flight.  Flights must be
+# added in order (a flight older than the last one in the cube is refused), and only one process may write to a cube at a time.
+#
+# Note that this requires the netCDF4 library
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Units of the time coordinate, chunk size and compression level of the cube
+time_units = 'days since 1970-01-01 00:00:00'
+chunks = (8, 128, 128)
+compression_level = 4
+
+# Function to find the date of a flight from the path of its cloud (returns None if there is no date in the path)
+def flight_date(cloud):
+    dates = re.findall(r'(?<!\d)(\d{4})-?(\d{2})-?(\d{2})(?!\d)', cloud)
+    for (year, month, day) in reversed(dates):
+        try:
+            return datetime.datetime(int(year), int(month), int(day))
+        except ValueError:
+            continue
+    return None
+
+# Function to create an (empty) cube on a grid with the given extent (ulx, lry, lrx, uly) and cellsize
+def create_cube(cube, extent, cellsize=cellsize, crs=crs, reference=None, chunks=chunks):
+    (ulx, lry, lrx, uly) = extent
+    width = int(round((lrx - ulx) / cellsize))
+    height = int(round((uly - lry) / cellsize))
+    t_srs = osr.SpatialReference()
+    t_srs.ImportFromEPSG(crs)
+
+    ds = netCDF4.Dataset(cube, 'w', format='NETCDF4')
+    ds.Conventions = 'CF-1.8'
+    ds.title = 'Differences between corrected SfM ground surfaces and a reference ground surface'
+    if reference is not None:
+        ds.reference_cloud = reference
+    ds.createDimension('time', None)
+    ds.createDimension('y', height)
+    ds.createDimension('x', width)
+
+    var = ds.createVariable('time', 'f8', ('time',))
+    (var.units, var.calendar, var.standard_name) = (time_units, 'standard', 'time')
+    var = ds.createVariable('y', 'f8', ('y',))
+    (var.units, var.standard_name) = ('m', 'projection_y_coordinate')
+    var[:] = uly - (np.arange(height) + 0.5) * cellsize
+    var = ds.createVariable('x', 'f8', ('x',))
+    (var.units, var.standard_name) = ('m', 'projection_x_coordinate')
+    var[:] = ulx + (np.arange(width) + 0.5) * cellsize
+    var = ds.createVariable('crs', 'i4')
+    var.crs_wkt = var.spatial_ref = t_srs.ExportToWkt()
+    var.GeoTransform = ' '.join(str(v) for v in (ulx, cellsize, 0.0, uly, 0.0, -cellsize))
+    var.epsg_code = 'EPSG:' + str(crs)
+    ds.createVariable('flight', str, ('time',))
+
+    var = ds.createVariable('difference', 'f4', ('time', 'y', 'x'), zlib=True, complevel=compression_level, shuffle=True,
+                            chunksizes=(chunks[0], min(chunks[1], height), min(chunks[2], width)), fill_value=-9999.0)
+    (var.units, var.grid_mapping) = ('cm', 'crs')
+    var.long_name = 'Corrected SfM ground surface minus reference ground surface'
+    return ds
+
+# Function to find the extent (ulx, lry, lrx, uly) and cellsize of the grid of a cube
+def cube_grid(ds):
+    x = ds['x'][:]
+    y = ds['y'][:]
+    cellsize = float(x[1] - x[0]) if len(x) > 1 else float(y[0] - y[1])
+    return ((float(x[0]) - cellsize/2, float(y[-1]) - cellsize/2, float(x[-1]) + cellsize/2, float(y[0]) + cellsize/2), cellsize)
+
+# Function to compute the difference (in cm) between the surface of a flight and the reference surface on the grid of a cube
+def flight_difference(cloud, reference_z, extent, cellsize=cellsize):
+    (z, _) = grid_surface(cloud, cellsize, extent=extent)
+    return ((z - reference_z) * 100).astype(np.float32)
+
+# Function to add the difference of one flight to a cube, returning the time step it was written to (or None if the date is
+# already in the cube and is not replaced).  The difference is only ever appended after the last time step (or written over
+# the time step of the same date), so the rest of the cube is left as it is
+def add_flight(ds, diff, date, flight, replace=False):
+    times = ds['time'][:]
+    t = float(netCDF4.date2num(date, time_units, calendar='standard'))
+    existing = np.flatnonzero(np.isclose(times, t))
+    if len(existing) > 0:
+        if not replace:
+            return None
+        index = int(existing[0])
+    elif len(times) > 0 and t < times[-1]:
+        raise ValueError(flight + ' (' + date.strftime('%Y-%m-%d') + ') is older than the last flight in the cube')
+    else:
+        index = len(times)
+    diff = np.where(np.isnan(diff), np.float32(-9999), diff)
+    ds['difference'][index, :, :] = diff
+    ds['time'][index] = t
+    ds['flight'][index] = flight
+    return index
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] cube reference_cloud flight_cloud(s)'
+    p = OptionParser(usage)
+    p.add_option('-d', '--dates', dest='dates', help='Dates of the flights (YYYY-MM-DD, separated by commas)')
+    p.add_option('-e', '--extent', dest='extent', help='Extent of the cube (xmin,ymin,xmax,ymax), when it is created')
+    p.add_option('--chunks', dest='chunks', default=','.join(str(c) for c in chunks), help='Size of the chunks of the cube (time,rows,columns)')
+    p.add_option('--replace', dest='replace', action='store_true', help='Replace the time steps of flights that are already in the cube')
+    p.add_option('--no_cache', dest='no_cache', action='store_true', help='Do not use the cache of gridded reference surfaces')
+    p.add_option('--trace', dest='trace', help='File to write a trace of each step to (see tracing.py)')
+    p.set_defaults(replace=False)
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    argv = gdal.GeneralCmdLineProcessor( sys.argv )
+    parser = optparse_init()
+    options,args = parser.parse_args(args=argv[1:])
+    start_trace(options.trace)
+    if len(args) < 3:
+        parser.print_help()
+        sys.exit(1)
+    cube = args[0]                  # NetCDF cube
+    ref_cloud_ground = args[1]      # Reference ground point cloud
+    flights = args[2:]              # Corrected ground point clouds of the flights
+
+    # Check for the existance of the clouds
+    path_errors = False
+    for cloud in [ref_cloud_ground] + flights:
+        if not os.path.exists(cloud):
+            print('Error: ' + cloud + ' does not exist!')
+            path_errors = True
+    if path_errors == True:
+        sys.exit()
+
+    # Find the date of each flight
+    if options.dates != None:
+        try:
+            dates = [datetime.datetime.strptime(d.strip(), '%Y-%m-%d') for d in options.dates.split(',')]
+        except ValueError:
+            print('Error: the dates must be given as YYYY-MM-DD')
+            sys.exit(1)
+        if len(dates) != len(flights):
+            print('Error: ' + str(len(dates)) + ' dates were given for ' + str(len(flights)) + ' flights')
+            sys.exit(1)
+    else:
+        dates = [flight_date(cloud) for cloud in flights]
+        for (cloud, date) in zip(flights, dates):
+            if date is None:
+                print('Error: there is no date in ' + cloud + ' (give the dates of the flights with -d)')
+                sys.exit(1)
+    if any(later < earlier for (earlier, later) in zip(dates[:-1], dates[1:])):
+        print('Error: the flights must be given in order')
+        sys.exit(1)
+
+    # Open the cube, or create it on the extent of the reference cloud (or the given extent)
+    if os.path.exists(cube):
+        ds = netCDF4.Dataset(cube, 'a')
+        (extent, grid_cellsize) = cube_grid(ds)
+        if abs(grid_cellsize - cellsize) > 1e-6 * cellsize:
+            print('Warning: using the cellsize of the cube (' + str(grid_cellsize) + ') instead of ' + str(cellsize))
+    else:
+        if options.extent != None:
+            extent = aligned_extent(*[float(v) for v in options.extent.split(',')], cellsize=cellsize)
+        else:
+            extent = aligned_extent(*cloud_bounds(ref_cloud_ground), cellsize=cellsize)
+        grid_cellsize = cellsize
+        ds = create_cube(cube, extent, cellsize, crs, ref_cloud_ground, [int(c) for c in options.chunks.split(',')])
+        print('Created ' + cube + ' (' + str(len(ds.dimensions['x'])) + ' x ' + str(len(ds.dimensions['y'])) + ' cells)')
+
+    try:
+        # Grid the reference ground point cloud on the grid of the cube (using the surface cache, unless disabled)
+        if options.no_cache:
+            (reference_z, _) = grid_surface(ref_cloud_ground, grid_cellsize, extent=extent)
+        else:
+            (reference_z, _) = cached_grid_surface(ref_cloud_ground, grid_cellsize, extent=extent)
+
+        # Add each flight to the cube (writing it to disk before moving on to the next one)
+        for (cloud, date) in zip(flights, dates):
+            with stage('add_flight', cloud=cloud):
+                diff = flight_difference(cloud, reference_z, extent, grid_cellsize)
+                try:
+                    index = add_flight(ds, diff, date, cloud, options.replace)
+                except ValueError as e:
+                    print('Error: ' + str(e))
+                    sys.exit(1)
+                ds.sync()
+            if index is None:
+                print('Skipped ' + cloud + ' (' + date.strftime('%Y-%m-%d') + ' is already in the cube)')
+            else:
+                print('Added ' + cloud + ' (' + date.strftime('%Y-%m-%d') + ') as time step ' + str(index + 1))
+    finally:
+        ds.close()
@@ -0,0 +1,187 @@
+import sys, os
+import time
+import json
+import hashlib
+import tempfile
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from grid_surface import grid_surface, crop_surface, aligned_extent, corrected_extent
+from point_io import cloud_bounds
+from task_graph import Task, run_graph
+
+# On-disk, content-addressed cache of gridded surfaces, so that a reference cloud that is used over and over again (e.g. the
+# snow-off ground cloud that every snow-on flight is compared to) only ever has to be gridded once.  A cloud is always
+# gridded (and cached) on its own full extent, and the requested extent is cut out of the cached surface afterwards, so
+# the same cache entry serves every input cloud that is compared to the reference.  A cloud whose full grid would have more
+# than a maximum number of cells (e.g. a watershed scale reference compared to a small flight) is not cached, and only the
+# requested extent is gridded, so the full grid is never held in memory.
+#
+# Usage (from another script):
+#   from surface_cache import cached_grid_surface
+#   (z, gt) = cached_grid_surface(<cloud>, extent=extent)      # Same result as grid_surface(<cloud>, extent=extent)
+#   (z, gt) = cached_grid_surface(<cloud>, extent=extent, crs=crs)   # For a site whose crs is not the one from GeoRefPars()
+#   (z, reference_z, gt) = grid_with_reference(<cloud>, <reference cloud>)   # Both on the grid of the cloud, at the same time
+#
+# Cache entries are keyed by the SHA-256 hash of the content of the cloud plus the gridding parameters (cellsize, fusion
+# parameters, extent and crs), so renaming or copying a cloud still hits the cache, while modifying it does not.  The
+# hash of each file is remembered (by path, size and modification time) so large clouds are not re-hashed on every run.
+# When the cache grows above its maximum size, the least recently used entries are removed.  Entries are written to a
+# temporary file and moved into place, so several processes can safely share the same cache.
+#
+# Environment variables:
+#   SFM_SURFACE_CACHE: Cache directory (defaults to ~/.cache/sfm-processing/surfaces)
+#   SFM_SURFACE_CACHE_SIZE: Maximum size of the cache in bytes (defaults to 10 GB)
+#   SFM_SURFACE_CACHE_CELLS: Maximum number of cells of a cached surface (defaults to 50 million, 400 MB)
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Cache location and size
+cache_dir = os.environ.get('SFM_SURFACE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sfm-processing', 'surfaces'))
+max_cache_size = int(os.environ.get('SFM_SURFACE_CACHE_SIZE', 10 * 1024**3))
+max_cached_cells = int(os.environ.get('SFM_SURFACE_CACHE_CELLS', 50 * 10**6))
+
+# Age (in seconds) after which an eviction lock is assumed to have been left behind by a process that died
+stale_lock_age = 600
+
+# Function to write a file atomically (by writing a temporary file and moving it into place)
+def atomic_write(path, write):
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+# Function to compute the SHA-256 hash of the content of a file (remembering it by path, size and modification time)
+def file_hash(path, cache_dir=cache_dir):
+    stat = os.stat(path)
+    realpath = os.path.realpath(path)
+    memo = os.path.join(cache_dir, 'hashes', hashlib.sha256(realpath.encode()).hexdigest() + '.json')
+    try:
+        with open(memo) as f:
+            entry = json.load(f)
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024**2), b''):
+            h.update(block)
+    digest = h.hexdigest()
+
+    os.makedirs(os.path.dirname(memo), exist_ok=True)
+    entry = {'path': realpath, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+    atomic_write(memo, lambda f: f.write(json.dumps(entry).encode()))
+    return digest
+
+# Function to compute the cache key of a gridded surface
+def cache_key(cloud, cellsize=cellsize, extent=None, crs=crs, fusion_parameters=fusion_parameters, cache_dir=cache_dir):
+    pars = {'cloud': file_hash(cloud, cache_dir), 'cellsize': cellsize, 'fusion_parameters': fusion_parameters,
+            'extent': list(extent) if extent is not None else None, 'crs': crs}
+    return hashlib.sha256(json.dumps(pars, sort_keys=True).encode()).hexdigest()
+
+# Function to load a surface from the cache (returns None if it is not there)
+def load_surface(key, cache_dir=cache_dir):
+    path = os.path.join(cache_dir, key + '.npz')
+    try:
+        with np.load(path) as data:
+            (z, gt) = (data['z'], tuple(data['gt']))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # Mark the entry as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return (z, gt)
+
+# Function to store a surface in the cache
+def store_surface(key, z, gt, cache_dir=cache_dir, max_size=max_cache_size):
+    os.makedirs(cache_dir, exist_ok=True)
+    atomic_write(os.path.join(cache_dir, key + '.npz'), lambda f: np.savez(f, z=z, gt=np.asarray(gt)))
+    evict(cache_dir, max_size)
+
+# Function to remove the least recently used surfaces until the cache is no larger than max_size
+def evict(cache_dir=cache_dir, max_size=max_cache_size):
+
+    # Only let one process evict at a time (others simply skip eviction)
+    lock = os.path.join(cache_dir, 'evict.lock')
+    try:
+        if time.time() - os.path.getmtime(lock) > stale_lock_age:
+            os.remove(lock)
+    except OSError:
+        pass
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return
+    os.close(fd)
+
+    try:
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(cache_dir, name))
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                except OSError:
+                    pass
+        total = sum(entry[1] for entry in entries)
+        for (_, size, name) in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+    finally:
+        try:
+            os.remove(lock)
+        except OSError:
+            pass
+
+# Function to grid a point cloud, using the cache if possible
+def cached_grid_surface(cloud, cellsize=cellsize, extent=None, cache_dir=cache_dir, crs=crs, fusion_parameters=fusion_parameters,
+                        max_cells=max_cached_cells):
+
+    # Grid (and cache) the cloud on its own full extent, unless its full grid is too large and only part of it is needed
+    full_extent = aligned_extent(*cloud_bounds(cloud), cellsize=cellsize)
+    (ulx, lry, lrx, uly) = full_extent
+    if extent is not None and round((lrx - ulx) / cellsize) * round((uly - lry) / cellsize) > max_cells:
+        print('Gridding ' + cloud + ' on the requested extent (its full grid is too large for the surface cache)')
+        return grid_surface(cloud, cellsize, extent=extent)
+    key = cache_key(cloud, cellsize, full_extent, crs, fusion_parameters, cache_dir)
+    surface = load_surface(key, cache_dir)
+    if surface is None:
+        print('Gridding ' + cloud + ' (not in the surface cache)')
+        surface = grid_surface(cloud, cellsize, extent=full_extent)
+        store_surface(key, surface[0], surface[1], cache_dir)
+    else:
+        print('Using the cached surface for ' + cloud)
+
+    # Cut out the requested extent
+    if extent is None:
+        return surface
+    return crop_surface(surface[0], surface[1], extent)
+
+# Function to grid a cloud (on its own extent, with a chain of corrections applied if one is given) and a reference cloud on
+# the same grid, returning both surfaces and the geotransform of the grid.  The two clouds are gridded at the same time (see
+# task_graph.py), and the reference cloud is taken from the cache unless use_cache is False
+def grid_with_reference(cloud, ref_cloud, cellsize=cellsize, chain=None, use_cache=True, workers=2):
+    if chain is not None and len(chain) > 0:
+        extent = corrected_extent(cloud, chain, cellsize)
+    else:
+        extent = aligned_extent(*cloud_bounds(cloud), cellsize=cellsize)
+    reference = cached_grid_surface if use_cache else grid_surface
+    results = run_graph([Task('surface', grid_surface, cloud, cellsize, extent=extent, chain=chain),
+                         Task('reference', reference, ref_cloud, cellsize, extent=extent)], workers)
+    return (results['surface'][0], results['reference'][0], results['surface'][1])
@@ -0,0 +1,137 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+
+# Runs a set of operations (tasks) that depend on each other as a graph: each task is started as soon as all of the tasks
+# it depends on have finished, with at most `workers` tasks running at the same time, so independent operations (e.g.
+# gridding the SfM and the reference cloud, or correcting several clouds) overlap instead of running one after another.
+#
+# Usage (from another script):
+#   from task_graph import Task, Result, run_graph
+#   tasks = [Task('sfm', grid_surface, <SfM cloud>, extent=extent),
+#            Task('reference', grid_surface, <reference cloud>, extent=extent),
+#            Task('difference', difference, Result('sfm'), Result('reference'))]
+#   results = run_graph(tasks, workers=2)            # results['difference'] is the return value of the last task
+#
+# A task depends on the tasks whose results it takes as arguments (Result(<name>), which is replaced by the result of that
+# task) and on the tasks listed in its after=[...] argument.
+#
+# Options:
+#   workers: Maximum number of tasks running at the same time (defaults to the number of cores)
+#   fail_fast: Stop as soon as a task fails (the tasks that are already running are waited for).  Otherwise the tasks that
+#       do not depend on the failed task are still run
+#   processes: Run the tasks in worker processes (for tasks that hold the GIL) instead of threads (the functions and their
+#       arguments must then be picklable)
+#
+# If any task fails, a TaskError is raised once the graph has stopped, with the error of each failed task and the results of
+# the tasks that did finish.  External programs run by the tasks should be run with tracing.run_command, which runs a list of
+# arguments (without a shell), checks the exit status and retries failed runs.
+
+# Class of a task of a graph
+class Task:
+    """An operation (a function and its arguments) to run once the tasks it depends on have finished"""
+
+    def __init__(self, name, function, *args, after=(), **kwargs):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.after = set(after)
+        for value in list(args) + list(kwargs.values()):
+            if isinstance(value, Result):
+                self.after.add(value.name)
+
+    def arguments(self, results):
+        """The arguments of the task, with the results of the tasks it depends on filled in"""
+        def fill(value):
+            return results[value.name] if isinstance(value, Result) else value
+        return ([fill(value) for value in self.args], {key: fill(value) for (key, value) in self.kwargs.items()})
+
+# Class to refer to the result of another task in the arguments of a task
+class Result:
+    """Placeholder for the result of the task with the given name"""
+
+    def __init__(self, name):
+        self.name = name
+
+# Error raised when tasks of a graph fail
+class TaskError(RuntimeError):
+    """One or more tasks of a graph failed (errors maps the names of the failed tasks to their errors)"""
+
+    def __init__(self, errors, results, skipped):
+        self.errors = errors
+        self.results = results
+        self.skipped = skipped
+        message = '; '.join(name + ': ' + str(error) for (name, error) in errors.items())
+        if len(skipped) > 0:
+            message += ' (not run: ' + ', '.join(sorted(skipped)) + ')'
+        RuntimeError.__init__(self, message)
+
+# Function to check the tasks of a graph (unique names, known dependencies and no cycles)
+def check_graph(tasks):
+    names = [task.name for task in tasks]
+    if len(set(names)) != len(names):
+        raise ValueError('Task names must be unique')
+    for task in tasks:
+        for name in task.after:
+            if name not in names:
+                raise ValueError('Task ' + str(task.name) + ' depends on an unknown task: ' + str(name))
+    # (repeatedly take out the tasks whose dependencies have all been taken out; whatever is left is in a cycle)
+    done = set()
+    remaining = list(tasks)
+    while len(remaining) > 0:
+        ready = [task for task in remaining if task.after <= done]
+        if len(ready) == 0:
+            raise ValueError('Tasks depend on each other in a cycle: ' + ', '.join(str(task.name) for task in remaining))
+        done.update(task.name for task in ready)
+        remaining = [task for task in remaining if task.name not in done]
+
+# Function to run the tasks of a graph, returning a dictionary of the result of each task
+def run_graph(tasks, workers=None, fail_fast=True, processes=False):
+    check_graph(tasks)
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(workers, len(tasks)))
+
+    results = {}
+    errors = {}
+    skipped = set()
+    pending = list(tasks)
+    running = {}
+    if processes:
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        while len(pending) > 0 or len(running) > 0:
+            # Tasks that depend on a failed task (or on a task that was not run) are not run
+            while True:
+                blocked = [task for task in pending if len(task.after & (set(errors) | skipped)) > 0]
+                if len(blocked) == 0:
+                    break
+                skipped.update(task.name for task in blocked)
+                pending = [task for task in pending if task not in blocked]
+
+            # Start the tasks whose dependencies have all finished (unless a task failed and failing fast)
+            if len(errors) == 0 or not fail_fast:
+                for task in [task for task in pending if task.after <= set(results)]:
+                    if len(running) >= workers:
+                        break
+                    (args, kwargs) = task.arguments(results)
+                    running[pool.submit(task.function, *args, **kwargs)] = task
+                    pending.remove(task)
+            if len(running) == 0:
+                break
+
+            # Wait for a task to finish
+            (finished, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                try:
+                    results[task.name] = future.result()
+                except Exception as e:
+                    errors[task.name] = e
+
+    if len(errors) > 0:
+        raise TaskError(errors, results, skipped | set(task.name for task in pending))
+    return results
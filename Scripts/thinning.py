@@ -0,0 +1,185 @@
+import sys, os
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+
+# Thinning of point clouds, used to run the expensive steps (e.g. ICP, see icp_engine.py) on a smaller, evenly spread set of
+# points.  Voxel thinning replaces all of the points in each cube (voxel) of a given size by their centroid, so dense parts
+# of a cloud are thinned much more than sparse parts, and the thinned cloud has at most one point per voxel.
+#
+# Clouds can also be thinned to a subset of their own points (keeping all of their attributes), either to one point per
+# voxel ('voxel'), or to a target density in points per square map unit ('density').  The density method keeps one point per
+# square cell of area 1 / density, so parts of the cloud that are already sparser than the target keep all of their points
+# and dense parts are thinned down to the target.  The point kept in each cell is the one closest to the centre of the cell,
+# which spreads the kept points out more evenly than keeping a random one (approximating Poisson disk sampling).  The cells of
+# the points are found by hashing their integer cell coordinates into a single 64 bit key, so a cloud is thinned in chunks
+# (only the candidate point of each cell is kept between chunks) and then written in a second pass.
+#
+# Usage (to thin one or more clouds): python thinning.py <options> <Cloud> [<Cloud> ...] <Suffix>
+#
+# Cloud: Path to a point cloud to thin
+# Suffix: Suffix to be added to the thinned clouds (which are written next to the input clouds)
+# Options:
+# -m, --method: voxel or density (defaults to density)
+# -v, --voxel_size: Size of the voxels (in map units, defaults to 0.25)
+# -d, --density: Target density (in points per square map unit, defaults to 16)
+# -f, --format: Format of the output clouds: laz, las or npc (see npc.py).  Defaults to npc for .npc input clouds and laz
+#       otherwise
+#
+# Usage (from another script):
+#   from thinning import voxel_thin, thin_index, thin_cloud
+#   thinned = voxel_thin(<points>, voxel_size)      # points are (n, 3) arrays of x, y, z
+#   keep = thin_index(<points>, 'density', density=16)             # Indices of the points to keep
+#   npoints = thin_cloud(<input cloud>, <output cloud>, 'voxel', voxel_size=0.25)
+#
+# Thinned clouds are meant for estimating the corrections (e.g. with the -c option of the scripts, see correction_chain.py),
+# which are then applied to the full density clouds (with ApplyCorrections.py)
+
+# Default voxel size and target density
+voxel_size = 0.25
+density = 16.0
+
+# Function to find the voxel that each point falls in (as an index into the unique voxels, which are also returned)
+def voxel_index(points, voxel_size):
+    ijk = np.floor((points - points.min(axis=0)) / voxel_size).astype(np.int64)
+    dims = ijk.max(axis=0) + 1
+    key = (ijk[:, 0] * dims[1] + ijk[:, 1]) * dims[2] + ijk[:, 2]
+    return np.unique(key, return_inverse=True)
+
+# Function to thin a set of points to (at most) one point per voxel, the centroid of the points in the voxel
+def voxel_thin(points, voxel_size):
+    if len(points) == 0 or voxel_size is None or voxel_size <= 0:
+        return points
+    (voxels, index) = voxel_index(points, voxel_size)
+    counts = np.bincount(index, minlength=len(voxels))
+    thinned = np.empty((len(voxels), points.shape[1]))
+    for k in range(points.shape[1]):
+        thinned[:, k] = np.bincount(index, weights=points[:, k], minlength=len(voxels)) / counts
+    return thinned
+
+# Function to describe a thinning method as the size of its cells and the number of coordinates (x, y or x, y, z) they are
+# defined on
+def thinning_cells(method='density', voxel_size=voxel_size, density=density):
+    if method == 'voxel':
+        return (float(voxel_size), 3)
+    elif method == 'density':
+        return (1 / np.sqrt(density), 2)
+    raise ValueError('Unknown thinning method: ' + str(method))
+
+# Class to pick the point closest to the centre of each cell of a grid (or voxel grid) anchored at an origin, from points
+# that are added a chunk at a time
+class CellSelector:
+    """Keeps the index of the point closest to the centre of each cell"""
+
+    def __init__(self, size, mins, maxs):
+        self.size = float(size)
+        self.origin = np.asarray(mins, dtype=np.float64)
+        self.dims = np.floor((np.asarray(maxs, dtype=np.float64) - self.origin) / self.size).astype(np.int64) + 1
+        if np.prod(self.dims.astype(np.float64)) >= 2.0**62:
+            raise ValueError('The cells are too small for the extent of the cloud (' + str(self.size) + ' map units)')
+        self.keys = np.empty(0, dtype=np.int64)
+        self.distance = np.empty(0)
+        self.index = np.empty(0, dtype=np.int64)
+        self.n = 0
+
+    def cell_keys(self, points):
+        """Key of the cell that each point falls in, and the squared distance of each point to the centre of its cell"""
+        u = (points - self.origin) / self.size
+        ijk = np.clip(np.floor(u).astype(np.int64), 0, self.dims - 1)
+        key = ijk[:, 0]
+        for k in range(1, points.shape[1]):
+            key = key * self.dims[k] + ijk[:, k]
+        return (key, np.sum((u - ijk - 0.5)**2, axis=1))
+
+    def add(self, points):
+        """Add a chunk of points (an (n, 2) or (n, 3) array, following the points added before)"""
+        (key, distance) = self.cell_keys(points)
+        keys = np.concatenate((self.keys, key))
+        distance = np.concatenate((self.distance, distance))
+        index = np.concatenate((self.index, self.n + np.arange(len(points), dtype=np.int64)))
+        self.n += len(points)
+
+        # Keep the closest point of each cell (the first of each key, after sorting by key and then distance)
+        order = np.lexsort((distance, keys))
+        keys = keys[order]
+        first = np.concatenate(([True], keys[1:] != keys[:-1])) if len(keys) > 0 else np.empty(0, dtype=bool)
+        (self.keys, self.distance, self.index) = (keys[first], distance[order][first], index[order][first])
+
+    def selected(self):
+        """Indices of the points that are kept (in increasing order)"""
+        return np.sort(self.index)
+
+# Function to find the points to keep when thinning a set of points (an (n, 3) array of x, y, z), returning their indices
+def thin_index(points, method='density', voxel_size=voxel_size, density=density):
+    if len(points) == 0:
+        return np.empty(0, dtype=np.int64)
+    (size, ndims) = thinning_cells(method, voxel_size, density)
+    points = np.asarray(points, dtype=np.float64)[:, :ndims]
+    selector = CellSelector(size, points.min(axis=0), points.max(axis=0))
+    selector.add(points)
+    return selector.selected()
+
+# Function to thin a point cloud (in two passes over it), writing the points that are kept (with all of their attributes)
+# to an output cloud, and returning the number of points written
+def thin_cloud(incloud, outcloud, method='density', voxel_size=voxel_size, density=density):
+    from point_io import read_header, read_chunks, ChunkWriter
+    (size, ndims) = thinning_cells(method, voxel_size, density)
+    header = read_header(incloud)
+    selector = CellSelector(size, header.mins[:ndims], header.maxs[:ndims])
+    for pts in read_chunks(incloud):
+        selector.add(np.column_stack((pts['x'], pts['y'], pts['z']))[:, :ndims])
+    keep = selector.selected()
+
+    # Write the points that are kept, chunk by chunk
+    start = 0
+    with ChunkWriter(outcloud, header) as writer:
+        for (pts, records) in read_chunks(incloud, records=True):
+            stop = start + len(pts)
+            (lo, hi) = np.searchsorted(keep, (start, stop))
+            if hi > lo:
+                index = keep[lo:hi] - start
+                writer.write(pts[index], records[index])
+            start = stop
+        return writer.npoints
+
+# Optional parameters
+def optparse_init():
+    """Prepare the option parser for input (argv)"""
+
+    from optparse import OptionParser, OptionGroup
+    usage = 'Usage: %prog [options] cloud(s) suffix'
+    p = OptionParser(usage)
+    p.add_option('-m', '--method', dest='method', type='choice', choices=['voxel', 'density'], default='density', help='Thinning method (voxel or density)')
+    p.add_option('-v', '--voxel_size', dest='voxel_size', type='float', default=voxel_size, help='Size of the voxels (in map units)')
+    p.add_option('-d', '--density', dest='density', type='float', default=density, help='Target density (in points per square map unit)')
+    p.add_option('-f', '--format', dest='format', type='choice', choices=['laz', 'las', 'npc'], help='Format of the output clouds (laz, las or npc)')
+    return p
+
+if __name__ == '__main__':
+
+    # Parse the command line arguments
+    p = optparse_init()
+    (options, args) = p.parse_args(args=sys.argv[1:])
+    if len(args) < 2:
+        p.print_help()
+        print('Usage: python thinning.py <options> <Cloud> [<Cloud> ...] <Suffix>')
+        sys.exit(1)
+    clouds = args[:-1]
+    out_suffix = args[-1]
+    if out_suffix == 'None':
+        print('Error: the thinned clouds can not replace the input clouds (give a suffix other than None)')
+        sys.exit(1)
+    for cloud in clouds:
+        if not os.path.exists(cloud):
+            print('Error: ' + cloud + ' does not exist!')
+            sys.exit(1)
+    if (options.method == 'voxel' and options.voxel_size <= 0) or (options.method == 'density' and options.density <= 0):
+        print('Error: the voxel size and density must be positive')
+        sys.exit(1)
+
+    from point_io import read_header
+    from apply_correction import output_cloud
+    for cloud in clouds:
+        outcloud = output_cloud(cloud, out_suffix, options.format)
+        npoints = thin_cloud(cloud, outcloud, options.method, options.voxel_size, options.density)
+        print('Thinned ' + cloud + ' -> ' + outcloud + ' (' + str(npoints) + ' of ' + str(read_header(cloud).point_count) +
+              ' points)')
@@ -0,0 +1,215 @@
+import sys, os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from point_io import read_chunks, cloud_bounds
+from spatial_index import indexed_chunks
+from grid_surface import aligned_extent, corrected_extent, read_difference_map, create_raster, finish_raster
+from polynomial import PolyNormalEquations
+from tracing import stage
+
+# Tiled processing for domains that are too large to grid as a single raster.  The (cellsize aligned) domain is split into
+# square tiles, and the clouds are split into per-tile files in a single streaming pass.  The tiles are then gridded and compared in parallel (one process per tile), and each tile hands back
+# only small statistics (sums and counts for the vertical offset, normal equations for the polynomial fit, see
+# polynomial.py) that are added together into the global result, so no process ever holds a full-domain grid.
+#
+# Usage (from another script):
+#   from tiling import tile_clouds, tiled_vertical_offset, tiled_polyfit
+#   tiling = tile_clouds(<input cloud>, <reference cloud>, tile_dir, tile_size=1000, chain=chain)
+#   vcorr = tiled_vertical_offset(tiling, tile_dir)
+#   m = tiled_polyfit(tiling, tile_dir, order, difference_map=<first guess map>)
+#
+# Tiles are aligned to the grid cells and points are assigned to tiles by the global grid cell they fall in, so every cell
+# of the domain belongs to exactly one tile and gives exactly the same value as it would in an untiled grid.  Gridding, the
+# differences and the global models are all cell-local, so tiles need no overlap with their neighbours and results are
+# seamless (and identical to the untiled results, up to floating point rounding) whatever the tile size.
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Default tile size (in map units)
+tile_size = 1000
+
+# Points (cell row, cell column and elevation) in the per-tile files
+tile_dtype = np.dtype([('row', np.int64), ('col', np.int64), ('z', np.float64)])
+
+# Function to split an extent (ulx, lry, lrx, uly) into tiles, returning a description of the tiling
+def make_tiles(extent, tile_size=tile_size, cellsize=cellsize):
+    (ulx, lry, lrx, uly) = extent
+    width = int(round((lrx - ulx) / cellsize))
+    height = int(round((uly - lry) / cellsize))
+    tile_cells = max(1, int(round(tile_size / cellsize)))
+
+    tiles = []
+    for r in range(0, height, tile_cells):
+        for c in range(0, width, tile_cells):
+            core = (r, c, min(r + tile_cells, height), min(c + tile_cells, width))
+            tiles.append({'id': 'r' + str(r // tile_cells) + '_c' + str(c // tile_cells), 'core': core})
+    return {'extent': (ulx, lry, lrx, uly), 'cellsize': cellsize, 'width': width, 'height': height,
+            'tile_cells': tile_cells, 'tiles': tiles}
+
+# Function to compute the extent (ulx, lry, lrx, uly) of a range of cells (row0, col0, row1, col1)
+def cell_extent(tiling, cells):
+    (ulx, lry, lrx, uly) = tiling['extent']
+    cs = tiling['cellsize']
+    (r0, c0, r1, c1) = cells
+    return (ulx + c0*cs, uly - r1*cs, ulx + c1*cs, uly - r0*cs)
+
+# Function to name the file holding the points of one cloud in one tile
+def tile_file(tile_dir, name, tile):
+    return os.path.join(tile_dir, name + '_' + tile['id'] + '.bin')
+
+# Function to split a point cloud into per-tile files (in one pass, with the corrections in the chain applied if given),
+# returning the number of points read (without a chain, only the part of the cloud inside the domain is read if it has a
+# spatial index, see spatial_index.py)
+def split_cloud(cloud, tiling, tile_dir, name, chain=None):
+    (ulx, lry, lrx, uly) = tiling['extent']
+    cs = tiling['cellsize']
+    n = tiling['tile_cells']
+    tiles_per_row = (tiling['width'] + n - 1) // n
+    tiles = tiling['tiles']
+
+    npoints = 0
+    chunks = read_chunks(cloud) if chain is not None else indexed_chunks(cloud, tiling['extent'])
+    for pts in chunks:
+        npoints += len(pts)
+        if chain is not None:
+            (pts, _) = chain.apply(pts)
+        row = np.floor((uly - pts['y']) / cs).astype(np.int64)
+        col = np.floor((pts['x'] - ulx) / cs).astype(np.int64)
+        inside = (row >= 0) & (row < tiling['height']) & (col >= 0) & (col < tiling['width'])
+        records = np.empty(np.count_nonzero(inside), dtype=tile_dtype)
+        (records['row'], records['col'], records['z']) = (row[inside], col[inside], pts['z'][inside])
+
+        # Append the points to the file of the tile their cell is in
+        index = (records['row'] // n) * tiles_per_row + records['col'] // n
+        order = np.argsort(index, kind='stable')
+        bounds = np.searchsorted(index[order], np.arange(len(tiles) + 1))
+        for k in np.nonzero(np.diff(bounds))[0]:
+            with open(tile_file(tile_dir, name, tiles[k]), 'ab') as f:
+                records[order[bounds[k]:bounds[k+1]]].tofile(f)
+    return npoints
+
+# Function to tile the domain of an SfM cloud (after the corrections in the chain, if given) and split it and a reference
+# cloud into per-tile files (named 'sfm' and 'reference'), returning the tiling
+def tile_clouds(incloud, ref_cloud, tile_dir, tile_size=tile_size, cellsize=cellsize, chain=None):
+    if chain is not None and len(chain) > 0:
+        extent = corrected_extent(incloud, chain, cellsize)
+    else:
+        extent = aligned_extent(*cloud_bounds(incloud), cellsize=cellsize)
+    tiling = make_tiles(extent, tile_size, cellsize)
+    print('Splitting the domain into ' + str(len(tiling['tiles'])) + ' tiles')
+    for (cloud, name) in ((incloud, 'sfm'), (ref_cloud, 'reference')):
+        with stage('split_cloud', cloud=cloud, tiles=len(tiling['tiles'])) as record:
+            record['points'] = split_cloud(cloud, tiling, tile_dir, name, chain=chain if name == 'sfm' else None)
+    return tiling
+
+# Function to grid the points of one cloud in one tile (NaN where there are no points)
+def grid_tile(tiling, tile_dir, name, tile):
+    (r0, c0, r1, c1) = tile['core']
+    (height, width) = (r1 - r0, c1 - c0)
+    total = np.zeros(height * width)
+    count = np.zeros(height * width, dtype=np.int64)
+    path = tile_file(tile_dir, name, tile)
+    if os.path.exists(path):
+        records = np.fromfile(path, dtype=tile_dtype)
+        idx = (records['row'] - r0) * width + (records['col'] - c0)
+        total += np.bincount(idx, weights=records['z'], minlength=total.size)
+        count += np.bincount(idx, minlength=count.size)
+    z = np.full(total.size, np.nan)
+    z[count > 0] = total[count > 0] / count[count > 0]
+    return z.reshape(height, width)
+
+# Function to compute the cell coordinates used by fit_correction (see dewarp_model.py), relative to (ulx, lry), of the core
+# cells of a tile
+def core_coordinates(tiling, tile):
+    (ulx, lry, lrx, uly) = tiling['extent']
+    (cr0, cc0, cr1, cc1) = tile['core']
+    xs = np.arange(cc0, cc1) * (lrx - ulx) / max(1, tiling['width'] - 1)
+    ys = (uly - lry) - np.arange(cr0, cr1) * (uly - lry) / max(1, tiling['height'] - 1)
+    return (xs, ys)
+
+# Function to compute the difference between the SfM and reference surfaces on the cells of a tile (optionally minus a
+# first guess difference map, in cm)
+def tile_difference(tiling, tile_dir, tile, difference_map=None):
+    sfm_z = grid_tile(tiling, tile_dir, 'sfm', tile)
+    reference_z = grid_tile(tiling, tile_dir, 'reference', tile)
+    diff = sfm_z - reference_z
+    if difference_map is not None:
+        cs = tiling['cellsize']
+        diff -= read_difference_map(difference_map, cell_extent(tiling, tile['core']), cs, cs) / 100
+    return diff
+
+# Function to compute the statistics of one tile (runs in a worker process)
+def tile_statistics(tiling, tile_dir, tile, order=None, difference_map=None):
+    diff = tile_difference(tiling, tile_dir, tile, difference_map)
+    (rows, cols) = np.nonzero(~np.isnan(diff))
+
+    # Sum and count of the differences (for the vertical offset)
+    if order is None:
+        return (float(diff[rows, cols].sum()), len(rows))
+
+    # Normal equations of the polynomial fit (scaled by the size of the whole domain)
+    (ulx, lry, lrx, uly) = tiling['extent']
+    (xs, ys) = core_coordinates(tiling, tile)
+    neq = PolyNormalEquations(order, (lrx - ulx, uly - lry))
+    neq.add(xs[cols], ys[rows], diff[rows, cols])
+    return neq
+
+# Function to run a function on one tile (in a worker process), tracing it as a step of its own
+def run_tile(function, tiling, tile_dir, tile, **kwargs):
+    with stage(function.__name__, tile=tile['id']):
+        return function(tiling, tile_dir, tile, **kwargs)
+
+# Function to run a function on every tile in a pool of worker processes, yielding (tile, result) pairs as they finish
+def map_tiles(function, tiling, tile_dir, workers=None, **kwargs):
+    if workers is None:
+        workers = os.cpu_count()
+    context = multiprocessing.get_context('spawn')     # (see apply_correction_to_clouds)
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tiling['tiles']))), mp_context=context) as pool:
+        futures = {}
+        for tile in tiling['tiles']:
+            futures[pool.submit(run_tile, function, tiling, tile_dir, tile, **kwargs)] = tile
+        for future in as_completed(futures):
+            yield (futures[future], future.result())
+
+# Function to estimate the vertical offset between the SfM and reference clouds (the mean difference of their surfaces)
+def tiled_vertical_offset(tiling, tile_dir, workers=None):
+    (total, count) = (0.0, 0)
+    for (_, (tile_total, tile_count)) in map_tiles(tile_statistics, tiling, tile_dir, workers):
+        total += tile_total
+        count += tile_count
+    if count == 0:
+        return np.nan
+    return total / count
+
+# Function to fit a polynomial model to the difference between the SfM and reference surfaces, with coordinates relative to
+# (ulx, lry) (the same model that fit_correction in dewarp_model.py fits to the untiled surfaces)
+def tiled_polyfit(tiling, tile_dir, order, difference_map=None, workers=None):
+    (ulx, lry, lrx, uly) = tiling['extent']
+    neq = PolyNormalEquations(order, (lrx - ulx, uly - lry))
+    for (_, tile_neq) in map_tiles(tile_statistics, tiling, tile_dir, workers, order=order, difference_map=difference_map):
+        neq.merge(tile_neq)
+    return neq.solve()
+
+# Function to compute the difference between the corrected SfM surface and the reference surface on the cells of a tile
+def tile_residual(tiling, tile_dir, tile, coefficients=None):
+    from polynomial import polygrid2d
+    diff = tile_difference(tiling, tile_dir, tile)
+    (xs, ys) = core_coordinates(tiling, tile)
+    return diff - polygrid2d(xs, ys, coefficients, dtype=np.float64)
+
+# Function to write a raster stitched together from the cells of each tile (without ever holding the whole raster)
+def write_tiled_raster(outraster, tiling, tile_dir, function, projection, scale=1.0, workers=None, **kwargs):
+    (ulx, lry, lrx, uly) = tiling['extent']
+    cs = tiling['cellsize']
+    outdata = create_raster(outraster, tiling['width'], tiling['height'], (ulx, cs, 0.0, uly, 0.0, -cs), projection)
+    band = outdata.GetRasterBand(1)
+    for (tile, z) in map_tiles(function, tiling, tile_dir, workers, **kwargs):
+        z = z * scale
+        z[np.isnan(z)] = -9999
+        band.WriteArray(z, int(tile['core'][1]), int(tile['core'][0]))
+    finish_raster(outdata)
+    outdata = None
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+
+# Structured tracing of the processing steps.  Each step (a stage of the pipeline, a gridding or correction pass, or an
+# external program) is recorded with its wall clock time, CPU time, peak memory, number of points processed (and points per
+# second) and whether it succeeded, so that it can be seen where the time goes on production runs and slow or failed steps
+# can be picked out.  Records are written as they finish, either as JSON lines (one record per line) or in the Chrome trace
+# event format (open the file in chrome://tracing or https://ui.perfetto.dev to see a timeline of the steps).
+#
+# Usage (from another script):
+#   from tracing import start_trace, stage, run_command
+#   start_trace(<trace file>)                       # Chrome trace format if the file ends in .json, otherwise JSON lines
+#   with stage('grid_surface', cloud=<cloud>) as record:
+#       ...
+#       record['points'] = n                        # Number of points processed (optional)
+#   record = run_command([<program>, <arguments>])  # Runs an external program, recording its exit status and stderr
+#   record = run_command([<program>, <arguments>], retries=2)      # Runs it up to 3 times, until it succeeds
+#   record = run_command([<program>, <arguments>], stdout=<file>, stderr=<file>)     # Writes its output to files
+#
+# Tracing is off unless start_trace() is called (or the SFM_TRACE environment variable names a trace file), in which case
+# stage() costs next to nothing.  start_trace() also sets SFM_TRACE, so any scripts run from a traced process (e.g. with
+# run_command) add their steps to the same trace.
+#
+# Each record has the fields:
+#   name, parent (the enclosing step, if any), status ('ok' or 'failed'), error, start (seconds since the epoch), seconds,
+#   cpu_seconds, peak_rss_mb, peak_shared, rss_mb (at the end of the step), points, points_per_second, pid, and any other
+#   arguments
+# and for external programs also command, returncode and stderr (the last stderr_length characters).
+#
+# On Linux, the peak memory of each step is measured by resetting the peak resident set size of the process at the start of
+# the step.  Elsewhere it is the peak of the process so far (which never goes down from one step to the next).  The peak
+# is that of the whole process, so it is only reset when no step is running in another thread.  A step that runs at the
+# same time as steps in other threads has peak_shared set (its peak includes their memory), and if they were already
+# running when it started, its peak_rss_mb is null (as the peak could not be reset for it).
+
+# Name of the environment variable with the trace file
+trace_variable = 'SFM_TRACE'
+
+# Number of characters of the stderr of external programs to keep
+stderr_length = 4000
+
+# Current trace (the open file, its format, the stack of open steps for each thread, and the open steps of all threads)
+trace = {'file': None, 'chrome': False, 'lock': threading.Lock(), 'local': threading.local(), 'open': []}
+
+# Function to start writing a trace to a file (appending to it if it already exists)
+def start_trace(trace_file=None):
+    if trace_file is None:
+        trace_file = os.environ.get(trace_variable)
+    if trace_file is None or trace_file == '':
+        return False
+    trace_file = os.path.abspath(trace_file)
+    if trace['file'] is not None:
+        if trace['file'].name == trace_file:
+            return True
+        trace['file'].close()
+    trace['chrome'] = trace_file.lower().endswith('.json')
+    trace['file'] = open(trace_file, 'a')
+    # (Chrome trace files are a JSON array, which the viewers accept without the closing bracket)
+    if trace['chrome'] and trace['file'].tell() == 0:
+        trace['file'].write('[\n')
+        trace['file'].flush()
+    os.environ[trace_variable] = trace_file
+    return True
+
+# Function to stop writing the trace
+def stop_trace():
+    if trace['file'] is not None:
+        trace['file'].close()
+        trace['file'] = None
+
+# Function to check whether a trace is being written
+def tracing():
+    if trace['file'] is None and os.environ.get(trace_variable):
+        start_trace()
+    return trace['file'] is not None
+
+# Function to get the current and peak resident set size of the process (in MB)
+def memory_usage():
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        return (int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024)
+    except (OSError, KeyError, ValueError):
+        try:
+            import resource
+        except ImportError:
+            return (None, None)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 1024**2 if sys.platform == 'darwin' else peak / 1024     # (bytes on macOS, KB elsewhere)
+        return (None, peak)
+
+# Function to reset the peak resident set size of the process (only possible on Linux)
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# Function to write a record to the trace
+def write_record(record, category='stage'):
+    if record.get('points') is not None and record['seconds'] > 0:
+        record['points_per_second'] = record['points'] / record['seconds']
+    if trace['chrome']:
+        event = {'name': record['name'], 'cat': category, 'ph': 'X', 'ts': record['start'] * 1e6,
+                 'dur': record['seconds'] * 1e6, 'pid': record['pid'], 'tid': threading.get_ident(),
+                 'args': dict((k, v) for (k, v) in record.items() if k not in ('name', 'start', 'seconds', 'pid'))}
+        line = json.dumps(event, default=str) + ',\n'
+    else:
+        line = json.dumps(record, default=str) + '\n'
+    with trace['lock']:
+        if trace['file'] is not None:
+            trace['file'].write(line)
+            trace['file'].flush()
+
+# Function to open a record for a step (and push it on the stack of open steps)
+def open_record(name, args):
+    stack = getattr(trace['local'], 'stack', None)
+    if stack is None:
+        stack = trace['local'].stack = []
+    record = {'name': name, 'parent': stack[-1]['name'] if len(stack) > 0 else None, 'status': 'ok', 'error': None,
+              'start': time.time(), 'points': None, 'pid': os.getpid(), 'peak_shared': False}
+    record.update(args)
+    (_, peak) = memory_usage()
+    if len(stack) > 0 and peak is not None:
+        stack[-1]['peak_rss_mb'] = max(stack[-1].get('peak_rss_mb') or 0, peak)
+
+    # (the peak is only reset if no step is open in another thread, and steps open in different threads share their peaks)
+    thread = threading.get_ident()
+    with trace['lock']:
+        others = [r for (t, r) in trace['open'] if t != thread]
+        for r in others:
+            r['peak_shared'] = True
+        record['peak_shared'] = len(others) > 0
+        exact = reset_peak_memory() if len(others) == 0 else False
+        trace['open'].append((thread, record))
+    stack.append(record)
+    return (record, stack, {'wall': time.perf_counter(), 'cpu': time.process_time(), 'exact': exact,
+                            'concurrent': len(others) > 0})
+
+# Function to close the record of a step (the peak memory of an enclosing step includes that of the steps inside it)
+def close_record(record, stack, started):
+    record['seconds'] = time.perf_counter() - started['wall']
+    record['cpu_seconds'] = time.process_time() - started['cpu']
+    (record['rss_mb'], peak) = memory_usage()
+    with trace['lock']:
+        trace['open'] = [(t, r) for (t, r) in trace['open'] if r is not record]
+    if started['concurrent']:
+        peak = None
+    elif started['exact']:
+        peak = max(peak, record.get('peak_rss_mb') or 0)
+    record['peak_rss_mb'] = peak
+    stack.pop()
+    if len(stack) > 0 and peak is not None:
+        stack[-1]['peak_rss_mb'] = max(stack[-1].get('peak_rss_mb') or 0, peak)
+
+# Function (context manager) to trace a step
+@contextmanager
+def stage(name, **args):
+    """Record the time and memory used by the code in the with block (set record['points'] to the points processed)"""
+    if not tracing():
+        yield dict(args)
+        return
+    (record, stack, started) = open_record(name, args)
+    try:
+        yield record
+    except BaseException as e:
+        if not (isinstance(e, SystemExit) and e.code in (None, 0)):
+            record['status'] = 'failed'
+            record['error'] = type(e).__name__ + ': ' + str(e)
+        raise
+    finally:
+        close_record(record, stack, started)
+        write_record(record)
+
+# Function to run an external program (given as a list of arguments, without a shell), recording its exit status, stderr
+# and resource usage, and returning the record.  The stderr of the program is passed on to the stderr stream (sys.stderr by
+# default), separately from its stdout.  A program that fails is run again up to `retries` times (waiting retry_delay
+# seconds, doubling each time), and check=True raises a RuntimeError if it still fails.  A program that can not be started
+# at all (e.g. it is not installed) is recorded as failed and its OSError is raised
+def run_command(cmd, name=None, stdout=None, check=True, retries=0, retry_delay=1.0, stderr=None, **args):
+    for attempt in range(retries + 1):
+        record = run_once(cmd, name, stdout, stderr, **args)
+        record['attempts'] = attempt + 1
+        if record['returncode'] == 0:
+            break
+        if attempt < retries:
+            print('Warning: ' + record['error'] + ', retrying (' + str(attempt + 1) + ' of ' + str(retries) + ')')
+            time.sleep(retry_delay * 2**attempt)
+    if check and record['returncode'] != 0:
+        raise RuntimeError(record['error'] + ': ' + ' '.join(record['command']))
+    return record
+
+# Function to run an external program once (see run_command)
+def run_once(cmd, name=None, stdout=None, stderr=None, **args):
+    if name is None:
+        name = os.path.basename(str(cmd[1] if str(cmd[0]) == sys.executable and len(cmd) > 1 else cmd[0]))
+    record = {'name': name, 'command': [str(c) for c in cmd], 'status': 'ok', 'error': None, 'start': time.time(),
+              'points': None, 'pid': os.getpid()}
+    record.update(args)
+    stack = getattr(trace['local'], 'stack', [])
+    record['parent'] = stack[-1]['name'] if len(stack) > 0 else None
+    tracing()
+
+    start = time.perf_counter()
+    try:
+        process = subprocess.Popen(cmd, stdout=stdout, stderr=subprocess.PIPE)
+    except OSError as e:
+        record['seconds'] = time.perf_counter() - start
+        (record['returncode'], record['cpu_seconds'], record['peak_rss_mb'], record['stderr']) = (None, None, None, '')
+        record['status'] = 'failed'
+        record['error'] = name + ' could not be run (' + type(e).__name__ + ': ' + str(e) + ')'
+        if trace['file'] is not None:
+            write_record(dict(record), category='command')
+        raise
+    # (read stderr in a thread, so that the program can not fill up the pipe while we wait for it)
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(process.stderr.read()))
+    reader.start()
+    if hasattr(os, 'wait4'):
+        (_, status, usage) = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        record['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+        record['peak_rss_mb'] = usage.ru_maxrss / 1024 if sys.platform != 'darwin' else usage.ru_maxrss / 1024**2
+    else:
+        process.wait()
+        (record['cpu_seconds'], record['peak_rss_mb']) = (None, None)
+    reader.join()
+    process.stderr.close()
+    record['seconds'] = time.perf_counter() - start
+    record['returncode'] = process.returncode
+    record['stderr'] = errors[0].decode(errors='replace')[-stderr_length:] if len(errors) > 0 else ''
+    if process.returncode != 0:
+        record['status'] = 'failed'
+        record['error'] = name + ' exited with status ' + str(process.returncode)
+
+    # Pass the stderr of the program on (as it is no longer going to the terminal)
+    stderr = sys.stderr if stderr is None else stderr
+    if stderr is not sys.stderr and stderr.seekable():
+        stderr.seek(0, os.SEEK_END)     # (after anything the program wrote to the same file)
+    stderr.write(record['stderr'])
+    stderr.flush()
+    if trace['file'] is not None:
+        write_record(dict(record), category='command')
+    return record
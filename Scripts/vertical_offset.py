@@ -0,0 +1,193 @@
+import sys, os
+import numpy as np
+sys.path.insert(1, os.path.dirname(os.path.realpath(__file__)) + '/../')
+from GeoRefPars import GeoRefPars
+from npc import npc_file
+from point_io import read_header, read_points, read_runs, laz_chunk_size
+from spatial_index import indexed_chunks, open_index
+
+# Raster-free estimation of the vertical offset between an SfM ground cloud and a reference ground cloud.  Instead of
+# gridding both clouds at full resolution to take the mean difference of the two surfaces (see RemoveVerticalOffset.py), SfM
+# ground points are drawn at random, in batches, and compared with the reference surface under each of them (the mean
+# elevation of the reference points in the same grid cell).  A robust estimate (the median, or a trimmed mean) of the
+# differences drawn so far is computed after each batch, and no more points are read once its confidence interval is narrower
+# than a tolerance.
+#
+# Usage (from another script):
+#   from vertical_offset import sampled_vertical_offset
+#   (vcorr, info) = sampled_vertical_offset(<input cloud>, <reference cloud>, tolerance=0.01, chain=chain)
+#   # info['samples'] is the number of differences used, info['ci'] the confidence interval of the estimate
+#
+# Options:
+#   tolerance: Stop once the half width of the (95%) confidence interval of the estimate is smaller than this
+#   max_samples: Largest number of SfM points drawn
+#   cellsize: Size of the cells around the samples in which the reference surface is found (defaults to the cellsize)
+#   estimator: 'median' or 'trimmed' (a 20% trimmed mean)
+#   chain: A chain of corrections (see correction_chain.py) applied to the SfM points as they are read
+#
+# The SfM points are drawn as short runs of consecutive points from random places in the cloud (see point_io.read_runs), so
+# only the parts of the SfM cloud around the runs are read.  The points of a run are usually neighbours (often in the same
+# reference cell), so their differences are not independent of each other, and the confidence intervals treat each run as
+# a cluster (from the spread of the sums over the runs rather than over the points).  If the reference cloud has a spatial index (see spatial_index.py),
+# the reference surface under each batch is found from the buckets of the index around its points, so an estimate that
+# converges early reads only a small part of either cloud.  Without an index, finding the reference surface takes a pass over
+# the reference cloud, so all max_samples points are drawn first and compared with it in a single pass (keeping only the sums
+# and counts of the reference points in the cells of the samples).
+
+# Read the georeferencing information and fusion parameters
+(crs, fusion_parameters, cellsize) = GeoRefPars()
+
+# Default sampling parameters (the first batch has min_samples points, and each batch after it as many as all of the ones
+# before it, so the number of samples doubles with each batch)
+tolerance = 0.01
+max_samples = 100000
+min_samples = 1000
+
+# Number of consecutive points in each run of SfM points drawn
+run_length = 16
+
+# Fraction of the differences trimmed from each end for the trimmed mean, and z score of the confidence intervals (95%)
+trim = 0.2
+z_score = 1.96
+
+# Function to compute a robust estimate of the centre of a set of differences, returning the estimate and its confidence
+# interval.  If the differences come in clusters that are not independent of each other, the cluster of each difference is
+# given, and the variances of the intervals are summed over the clusters (with one cluster per difference, this gives the
+# usual intervals for independent differences).
+def robust_estimate(diff, estimator='median', clusters=None):
+    d = np.sort(diff)
+    n = len(d)
+    if clusters is None:
+        clusters = np.arange(n)
+    else:
+        clusters = np.unique(clusters, return_inverse=True)[1]
+    if estimator == 'median':
+        # Confidence interval from the order statistics (normal approximation to the distribution of the number of differences
+        # below the median, with a standard deviation of sqrt(n)/2 for independent differences)
+        estimate = float(np.median(d))
+        sd = np.sqrt(np.sum(np.bincount(clusters, weights=(diff < estimate) - 0.5)**2))
+        lo = max(0, int(np.floor(n/2 - z_score*sd)) - 1)
+        hi = min(n - 1, int(np.ceil(n/2 + z_score*sd)) - 1)
+        return (estimate, (float(d[lo]), float(d[hi])))
+    elif estimator == 'trimmed':
+        # Confidence interval from the winsorized variance (Tukey and McLaughlin, 1963)
+        g = int(trim * n)
+        estimate = float(np.mean(d[g:n-g]))
+        winsorized = np.clip(diff, d[g], d[n-g-1])
+        residuals = np.bincount(clusters, weights=winsorized - np.mean(winsorized))
+        se = np.sqrt(np.sum(residuals**2) * n / (n - 1)) / ((1 - 2*trim) * n)
+        return (estimate, (estimate - z_score*se, estimate + z_score*se))
+    else:
+        raise ValueError('Unknown estimator: ' + str(estimator))
+
+# Function to find the elevation of the reference surface under each of a set of sample points (the mean elevation of the
+# reference points in the grid cell each sample falls in, NaN where there are none) in a single pass over the reference
+# cloud, or only over the buckets around the samples if the (open) spatial index of the reference cloud is given (see
+# spatial_index.py).  Only the cells that contain samples are kept track of.
+def reference_heights(samples, ref_cloud, cellsize=cellsize, index=None):
+    origin = np.floor(samples[:, :2].min(axis=0) / cellsize) * cellsize
+    (cols, rows) = np.floor((samples[:, :2] - origin) / cellsize).astype(np.int64).T
+    ncols = int(cols.max()) + 1
+    (cells, sample_cell) = np.unique(rows * ncols + cols, return_inverse=True)
+    sums = np.zeros(len(cells))
+    counts = np.zeros(len(cells))
+
+    if index is not None:
+        chunks = index.near(samples[:, :2], cellsize)
+    else:
+        (xmax, ymax) = samples[:, :2].max(axis=0) + cellsize
+        chunks = indexed_chunks(ref_cloud, (origin[0], origin[1], xmax, ymax))
+    for pts in chunks:
+        c = np.floor((pts['x'] - origin[0]) / cellsize).astype(np.int64)
+        r = np.floor((pts['y'] - origin[1]) / cellsize).astype(np.int64)
+        inside = (c >= 0) & (c < ncols) & (r >= 0)
+        key = r[inside] * ncols + c[inside]
+        k = np.minimum(np.searchsorted(cells, key), len(cells) - 1)
+        match = cells[k] == key
+        sums += np.bincount(k[match], weights=pts['z'][inside][match], minlength=len(cells))
+        counts += np.bincount(k[match], minlength=len(cells))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / counts)[sample_cell]
+
+# Function to estimate the vertical offset (SfM minus reference) from a sample of SfM points (an (n, 3) array, in random
+# order, with the cluster of each point if they are not independent, see robust_estimate), using progressively larger
+# subsets of it until the confidence interval is narrower than the tolerance
+def estimate_from_samples(samples, ref_cloud, tolerance=tolerance, cellsize=cellsize, estimator='median', clusters=None):
+    diff = samples[:, 2] - reference_heights(samples, ref_cloud, cellsize)
+    valid = ~np.isnan(diff)
+    diff = diff[valid]
+    if clusters is not None:
+        clusters = clusters[valid]
+    if len(diff) == 0:
+        return (np.nan, {'samples': 0, 'ci': None, 'converged': False})
+
+    n = min(min_samples, len(diff))
+    while True:
+        (estimate, ci) = robust_estimate(diff[:n], estimator, None if clusters is None else clusters[:n])
+        converged = (ci[1] - ci[0]) / 2 <= tolerance
+        if converged or n == len(diff):
+            return (estimate, {'samples': n, 'ci': ci, 'converged': bool(converged)})
+        n = min(2*n, len(diff))
+
+# Function to draw random SfM points in batches (of the given sizes), returning an (n, 3) array of points (in random order)
+# and the cluster (the run) each point is from for each batch.  The points are runs of consecutive points from random places
+# in the cloud, each drawn once (or independent points, each its own cluster, for a small LAZ cloud)
+def sample_batches(incloud, sizes, seed=None, chain=None):
+    rng = np.random.default_rng(seed)
+    header = read_header(incloud)
+    compressed = not npc_file(incloud) and header.are_points_compressed
+    if compressed and -(-sizes[0] // run_length) * laz_chunk_size >= header.point_count:
+        # (seeking to the runs of even the first batch would decompress about as much of a small LAZ cloud as a pass through
+        # it, which decompresses in parallel, so the whole sample is drawn in a single pass instead)
+        samples = read_points(incloud, max_points=sum(sizes), seed=seed, chain=chain)
+        rng.shuffle(samples)
+        clusters = np.arange(len(samples))
+        for (first, size) in zip(np.cumsum([0] + sizes[:-1]), sizes):
+            yield (samples[first:first+size], clusters[first:first+size])
+        return
+
+    nruns = max(1, -(-header.point_count // run_length))
+    runs = rng.choice(nruns, size=min(nruns, -(-sum(sizes) // run_length)), replace=False) * run_length
+    first = 0
+    for size in sizes:
+        count = -(-size // run_length)
+        if first >= len(runs):
+            return
+        starts = np.sort(runs[first:first+count])
+        (pts, run) = read_runs(incloud, starts, run_length, return_runs=True)
+        clusters = starts[run] // run_length
+        first += count
+        if chain is not None:
+            (pts, keep) = chain.apply(pts)
+            clusters = clusters[keep]
+        order = rng.permutation(len(pts))
+        yield (np.column_stack((pts['x'], pts['y'], pts['z']))[order], clusters[order])
+
+# Function to estimate the vertical offset between an SfM ground cloud and a reference ground cloud from random samples of
+# the SfM points, drawn in batches until the confidence interval is narrower than the tolerance
+def sampled_vertical_offset(incloud, ref_cloud, tolerance=tolerance, max_samples=max_samples, cellsize=cellsize,
+                            estimator='median', chain=None, seed=None):
+    index = open_index(ref_cloud)
+    if index is None:
+        (samples, clusters) = next(sample_batches(incloud, [max_samples], seed, chain), (np.empty((0, 3)), np.empty(0)))
+        return estimate_from_samples(samples, ref_cloud, tolerance, cellsize, estimator, clusters)
+
+    # Sizes of the batches (min_samples, then doubling the number drawn so far with each batch, up to max_samples)
+    sizes = [min(min_samples, max_samples)]
+    while sum(sizes) < max_samples:
+        sizes.append(min(sum(sizes), max_samples - sum(sizes)))
+
+    (diff, diff_runs) = (np.empty(0), np.empty(0, dtype=np.int64))
+    (estimate, ci, converged) = (np.nan, None, False)
+    for (samples, clusters) in sample_batches(incloud, sizes, seed, chain):
+        if len(samples) > 0:
+            d = samples[:, 2] - reference_heights(samples, ref_cloud, cellsize, index)
+            diff = np.concatenate((diff, d[~np.isnan(d)]))
+            diff_runs = np.concatenate((diff_runs, clusters[~np.isnan(d)]))
+        if len(diff) > 0:
+            (estimate, ci) = robust_estimate(diff, estimator, diff_runs)
+            converged = (ci[1] - ci[0]) / 2 <= tolerance
+            if converged:
+                break
+    return (estimate, {'samples': len(diff), 'ci': ci, 'converged': bool(converged)})
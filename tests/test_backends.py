@@ -0,0 +1,175 @@
+import sys, os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Scripts'))
+from backends import StubBackend
+from correction_chain import CorrectionChain
+from apply_correction import apply_correction_to_clouds
+from task_graph import Task, TaskError, run_graph
+from benchmark import make_domain, write_synthetic_cloud
+from point_io import cloud_bounds
+
+# Tests of the commands the fusion backend runs for each step of a chain of corrections, and of the retries and fail-fast
+# handling of the external programs, through the stub backend (which runs a stand-in for each program and records the
+# commands).  Run from the root of the repository with:
+#   python -m unittest discover tests       (or python -m pytest tests)
+
+# Function to read an ESRI ASCII grid (as written by the fusion backend), returning the values and the header
+def read_ascii_grid(asc):
+    with open(asc) as f:
+        header = dict(f.readline().split() for k in range(6))
+        return (np.loadtxt(f, ndmin=2), header)
+
+class StubBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = tempfile.mkdtemp()
+        self.domain = make_domain(2000)
+        self.clouds = []
+        for (k, name) in enumerate(['ground.laz', 'canopy.laz']):
+            cloud = os.path.join(self.working_dir, name)
+            write_synthetic_cloud(cloud, 'ground', self.domain, seed=k)
+            self.clouds.append(cloud)
+        self.bounds = [str(v) for v in cloud_bounds(self.clouds[0])]
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir, ignore_errors=True)
+
+    def apply(self, chain, backend=None):
+        """Apply a chain to the first cloud with the stub backend, returning the backend and the output cloud"""
+        backend = backend or StubBackend(retry_delay=0)
+        outcloud = os.path.join(self.working_dir, 'out.laz')
+        backend.apply(self.clouds[0], outcloud, chain)
+        return (backend, outcloud)
+
+    def test_clip(self):
+        chain = CorrectionChain()
+        chain.add_clip((1.0, 2.0, 3.0, 4.0))
+        (backend, outcloud) = self.apply(chain)
+        self.assertEqual(backend.commands, [['ClipData', self.clouds[0], outcloud, '1.0', '2.0', '3.0', '4.0']])
+
+    def test_offset(self):
+        chain = CorrectionChain()
+        chain.add_offset(0.5)
+        (backend, outcloud) = self.apply(chain)
+        self.assertEqual(backend.commands, [['ClipData', '/height', '/biaselev:-0.5', self.clouds[0], outcloud] + self.bounds])
+
+    def test_matrix(self):
+        chain = CorrectionChain()
+        chain.add_matrix(np.identity(4))
+        (backend, outcloud) = self.apply(chain)
+        self.assertEqual(len(backend.commands), 1)
+        cmd = backend.commands[0]
+        self.assertEqual(cmd[:8], ['CloudCompare', '-SILENT', '-AUTO_SAVE', 'OFF', '-C_EXPORT_FMT', 'LAS', '-EXT', 'laz'])
+        self.assertEqual(cmd[8:12], ['-O', '-GLOBAL_SHIFT', 'AUTO', self.clouds[0]])
+        self.assertEqual(cmd[12], '-APPLY_TRANS')
+        self.assertEqual(cmd[14:], ['-SAVE_CLOUDS', 'FILE', outcloud])
+
+    def check_surface_step(self, chain, backend, outcloud):
+        """Check the commands of a polynomial or spline step, and that its grid is positive and shifted back by /biaselev"""
+        self.assertEqual([cmd[0] for cmd in backend.commands], ['ASCII2DTM', 'ClipData'])
+        (ascii2dtm, clipdata) = backend.commands
+        dtm = ascii2dtm[1]
+        self.assertEqual(ascii2dtm[2:-1], backend.fusion_parameters)
+        self.assertEqual(clipdata[:3], ['ClipData', '/height', '/dtm:' + dtm])
+        self.assertTrue(clipdata[3].startswith('/biaselev:'))
+        self.assertEqual(clipdata[4:], [self.clouds[0], outcloud] + self.bounds)
+
+        # The grid (written again here, as the backend's working directory is gone) is at least 1 everywhere, and the
+        # correction minus the /biaselev shift
+        asc = os.path.join(self.working_dir, 'correction.asc')
+        vcorr = backend.write_correction_grid(asc, chain.steps[0], cloud_bounds(self.clouds[0]))
+        self.assertAlmostEqual(float(clipdata[3][len('/biaselev:'):]), -vcorr)
+        (grid, header) = read_ascii_grid(asc)
+        self.assertAlmostEqual(grid.min(), 1.0, places=5)
+        return (grid + vcorr, header)
+
+    def test_polynomial(self):
+        # (a plane that is negative over most of the domain, which ClipData could not use as it is)
+        chain = CorrectionChain()
+        (x0, y0) = (self.domain['xmin'], self.domain['ymin'])
+        chain.add_polynomial([-2.0, 0.01, 0.02, 0.0], (x0, y0))
+        (backend, outcloud) = self.apply(chain)
+        (correction, header) = self.check_surface_step(chain, backend, outcloud)
+        cellsize = float(header['cellsize'])
+        x = float(header['xllcorner']) + cellsize/2 - x0
+        y = float(header['yllcorner']) + (int(header['nrows']) - 0.5) * cellsize - y0
+        self.assertAlmostEqual(correction[0, 0], -2.0 + 0.02*x + 0.01*y, places=4)
+
+    def test_spline(self):
+        chain = CorrectionChain()
+        chain.add_spline(-np.ones((4, 4)), (self.domain['xmin'], self.domain['ymin']), 100.0)
+        (backend, outcloud) = self.apply(chain)
+        (correction, _) = self.check_surface_step(chain, backend, outcloud)
+        np.testing.assert_allclose(correction, -1.0, atol=1e-5)
+
+    def test_chain(self):
+        # (each step reads the output of the previous one, and only the last writes the output cloud)
+        # (and is given the bounds of the clipped cloud)
+        (xmin, ymin, xmax, ymax) = cloud_bounds(self.clouds[0])
+        chain = CorrectionChain()
+        chain.add_clip((xmin + 1, ymin + 1, xmax - 1, ymax + 5))
+        chain.add_offset(0.5)
+        (backend, outcloud) = self.apply(chain)
+        self.assertEqual(len(backend.commands), 2)
+        (clip, offset) = backend.commands
+        self.assertEqual(clip[2], offset[3])
+        self.assertEqual(offset[4], outcloud)
+        self.assertEqual(offset[5:], [str(v) for v in (xmin + 1, ymin + 1, xmax - 1, ymax)])
+
+    def test_retry(self):
+        # (ClipData fails once, and is run again)
+        backend = StubBackend(failures={'ClipData': 1}, retries=1, retry_delay=0)
+        record = backend.run(['ClipData', 'a.laz', 'b.laz'])
+        self.assertEqual(record['returncode'], 0)
+        self.assertEqual(record['attempts'], 2)
+
+        backend = StubBackend(failures={'ClipData': 1}, retries=1, retry_delay=0)
+        chain = CorrectionChain()
+        chain.add_offset(0.5)
+        results = apply_correction_to_clouds(self.clouds[:1], 'corrected', backend=backend, chain=chain)
+        self.assertIsNone(results[0][3])
+
+    def test_retries_exhausted(self):
+        backend = StubBackend(failures={'ClipData': 2}, retries=1, retry_delay=0)
+        with self.assertRaises(RuntimeError):
+            backend.run(['ClipData', 'a.laz', 'b.laz'])
+
+    def test_fail_fast_graph(self):
+        # (the first task fails, so the task that depends on it is never run, and neither is the independent one queued
+        # after it, as the graph stops at the first failure)
+        backend = StubBackend(failures={'ClipData': 1}, retry_delay=0)
+        tasks = [Task('fails', backend.run, ['ClipData', 'a.laz', 'b.laz']),
+                 Task('dependent', backend.run, ['ClipData', 'b.laz', 'c.laz'], after=['fails']),
+                 Task('independent', backend.run, ['ASCII2DTM', 'c.dtm'])]
+        with self.assertRaises(TaskError) as context:
+            run_graph(tasks, workers=1, fail_fast=True)
+        self.assertEqual(set(context.exception.errors), {'fails'})
+        self.assertEqual(context.exception.skipped, {'dependent', 'independent'})
+        self.assertEqual(backend.commands, [['ClipData', 'a.laz', 'b.laz']])
+
+    def test_no_fail_fast_graph(self):
+        # (without fail_fast, only the task that depends on the failed one is skipped)
+        backend = StubBackend(failures={'ClipData': 1}, retry_delay=0)
+        tasks = [Task('fails', backend.run, ['ClipData', 'a.laz', 'b.laz']),
+                 Task('dependent', backend.run, ['ClipData', 'b.laz', 'c.laz'], after=['fails']),
+                 Task('independent', backend.run, ['ASCII2DTM', 'c.dtm'])]
+        with self.assertRaises(TaskError) as context:
+            run_graph(tasks, workers=1, fail_fast=False)
+        self.assertEqual(context.exception.skipped, {'dependent'})
+        self.assertIn('independent', context.exception.results)
+
+    def test_fail_fast_clouds(self):
+        # (the first cloud fails, so the second is not corrected)
+        backend = StubBackend(failures={'ClipData': 1}, retry_delay=0)
+        chain = CorrectionChain()
+        chain.add_offset(0.5)
+        results = apply_correction_to_clouds(self.clouds, 'corrected', workers=1, backend=backend, fail_fast=True, chain=chain)
+        self.assertIsInstance(results[0][3], RuntimeError)
+        self.assertIn('not run', str(results[1][3]))
+        self.assertEqual(len(backend.commands), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import sys, os
+import unittest
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Scripts'))
+import bspline
+from bspline import SplineNormalEquations, spline_shape, splinefit2d, splineval2d, splinegrid2d
+
+# Tests of the smoothing B-spline surface models (bspline.py) against known answers: the recovery of a known smooth warp
+# (plain and robust fits), planes (which the roughness penalty does not resist), the separable grid evaluation against the
+# point evaluation, and fits from chunked and merged normal equations.  Run from the root of the repository with:
+#   python -m unittest discover tests       (or python -m pytest tests)
+
+# Function to compute a known warp over the 1000 x 800 domain of the tests (a few metres of bending is typical of SfM)
+def warp(x, y):
+    return 0.5*np.sin(x / 250) * np.cos(y / 200) + 0.2*(x / 1000)**2
+
+class BSplineTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.spacing = 100.0
+        self.shape = spline_shape(1000.0, 800.0, self.spacing)
+        self.x = rng.uniform(0, 1000, 50000)
+        self.y = rng.uniform(0, 800, 50000)
+        self.z = warp(self.x, self.y) + 0.05 * rng.standard_normal(len(self.x))
+        # (a grid of check points over the whole domain, rows from top to bottom as on a raster)
+        self.xs = np.linspace(0, 1000, 51)
+        self.ys = np.linspace(800, 0, 41)
+        (self.X, self.Y) = np.meshgrid(self.xs, self.ys)
+
+    def test_shape(self):
+        self.assertEqual(self.shape, (11, 13))
+        self.assertEqual(spline_shape(1001.0, 800.0, self.spacing), (11, 14))
+
+    def test_warp(self):
+        C = splinefit2d(self.x, self.y, self.z, self.shape, self.spacing)
+        self.assertEqual(C.shape, self.shape)
+        np.testing.assert_allclose(splineval2d(self.X, self.Y, C, self.spacing), warp(self.X, self.Y), atol=0.02)
+
+    def test_plane(self):
+        z = 1.0 + 0.002*self.x - 0.001*self.y
+        C = splinefit2d(self.x, self.y, z, self.shape, self.spacing)
+        np.testing.assert_allclose(splineval2d(self.X, self.Y, C, self.spacing), 1.0 + 0.002*self.X - 0.001*self.Y,
+                                   atol=1e-8)
+
+    def test_robust(self):
+        # (a tenth of the points are 5 m off the surface, which drags an ordinary fit but not a robust one)
+        z = self.z.copy()
+        z[::10] += 5.0
+        ordinary = splinefit2d(self.x, self.y, z, self.shape, self.spacing)
+        robust = splinefit2d(self.x, self.y, z, self.shape, self.spacing, robust=True)
+        self.assertGreater(np.max(np.abs(splineval2d(self.X, self.Y, ordinary, self.spacing) - warp(self.X, self.Y))), 0.3)
+        np.testing.assert_allclose(splineval2d(self.X, self.Y, robust, self.spacing), warp(self.X, self.Y), atol=0.02)
+
+    def test_splinegrid2d(self):
+        C = np.random.default_rng(1).standard_normal(self.shape)
+        zz = splinegrid2d(self.xs, self.ys, C, self.spacing, dtype=np.float64)
+        self.assertEqual(zz.shape, (len(self.ys), len(self.xs)))
+        np.testing.assert_allclose(zz, splineval2d(self.X, self.Y, C, self.spacing), atol=1e-12)
+
+    def test_chunked_and_merged(self):
+        direct = splinefit2d(self.x, self.y, self.z, self.shape, self.spacing)
+        chunk_size = bspline.chunk_size
+        bspline.chunk_size = 7000
+        try:
+            halves = [SplineNormalEquations(self.shape, self.spacing) for k in range(2)]
+            halves[0].add(self.x[:20000], self.y[:20000], self.z[:20000])
+            halves[1].add(self.x[20000:], self.y[20000:], self.z[20000:])
+        finally:
+            bspline.chunk_size = chunk_size
+        halves[0].merge(halves[1])
+        self.assertEqual(halves[0].n, len(self.z))
+        np.testing.assert_allclose(halves[0].solve(), direct, atol=1e-10)
+
+if __name__ == '__main__':
+    unittest.main()
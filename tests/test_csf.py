@@ -0,0 +1,63 @@
+import sys, os
+import unittest
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Scripts'))
+from csf import csf, simulate_cloth, spring_factors, satisfy_springs
+
+# Tests of the cloth simulation filter (csf.py) against known answers: the spring factors of each rigidness, one set of
+# springs, the parallel update of the cloth against the serial one, and the classification of a synthetic cloud (a sloping,
+# undulating ground with trees on it).  Run from the root of the repository with:
+#   python -m unittest discover tests       (or python -m pytest tests)
+
+class CSFTest(unittest.TestCase):
+
+    def test_spring_factors(self):
+        for (rigidness, factors) in ((1, (0.3, 0.3)), (2, (0.42, 0.51)), (3, (0.468, 0.657))):
+            np.testing.assert_allclose(spring_factors(rigidness), factors)
+
+    def test_satisfy_springs(self):
+        # (both particles movable: each moves the first factor of the distance towards the other; one fixed: the other moves
+        # the second factor)
+        factors = spring_factors(2)
+        h = np.array([[0.0, 1.0, 0.0, 1.0]])
+        movable = np.array([[True, True, True, False]])
+        satisfy_springs(h, movable, 1, 0, (0, 1), factors)
+        np.testing.assert_allclose(h, [[0.42, 0.58, 0.51, 1.0]])
+
+        # (along the columns, in pairs of rows starting on odd rows)
+        h = np.array([[5.0], [0.0], [2.0]])
+        movable = np.ones(h.shape, dtype=bool)
+        satisfy_springs(h, movable, 0, 1, (0, 2), factors)
+        np.testing.assert_allclose(h, [[5.0], [0.84], [1.16]])
+
+    def test_workers(self):
+        # (the cloth is split into blocks of rows for the threads, which must not change the result)
+        rng = np.random.default_rng(0)
+        height_values = rng.standard_normal((300, 200)).cumsum(axis=0) * 0.1
+        (h1, movable1) = simulate_cloth(height_values, workers=1)
+        (h4, movable4) = simulate_cloth(height_values, workers=4)
+        np.testing.assert_array_equal(h1, h4)
+        np.testing.assert_array_equal(movable1, movable4)
+
+    def test_classification(self):
+        rng = np.random.default_rng(0)
+        n = 20000
+        x = rng.uniform(0, 60, n)
+        y = rng.uniform(0, 60, n)
+        ground_z = 0.3*x + 0.1*y + np.sin(x / 7)
+        z = ground_z + 0.02 * rng.standard_normal(n)
+
+        # (most points within 3 m of a tree are on the tree, 1 to 12 m above the ground)
+        (cx, cy) = (rng.uniform(5, 55, 15), rng.uniform(5, 55, 15))
+        distance = np.min(np.hypot(x[:, None] - cx, y[:, None] - cy), axis=1)
+        vegetation = (distance < 3) & (rng.random(n) < 0.7)
+        z[vegetation] += rng.uniform(1, 12, np.count_nonzero(vegetation))
+
+        for sloop_smooth in (False, True):
+            ground = csf(x, y, z, sloop_smooth=sloop_smooth, class_threshold=0.5)
+            self.assertGreater(np.mean(ground[~vegetation]), 0.99)
+            self.assertLess(np.mean(ground[vegetation]), 0.02)
+            self.assertFalse(np.any(ground[vegetation & (z - ground_z > 2)]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import sys, os
+import unittest
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Scripts'))
+from icp_engine import icp, pyramid_icp, pyramid_levels, point_to_point_transform, transform_points
+
+# Tests of the ICP registration (icp_engine.py) against known answers: a known rigid transformation (a 1 degree rotation
+# and a shift of about a metre) between a synthetic terrain and a subset of its points, with large projected coordinates,
+# is recovered by both matching modes and by the coarse-to-fine pyramid.  Run from the root of the repository with:
+#   python -m unittest discover tests       (or python -m pytest tests)
+
+# Function to build a rigid transformation from a rotation about the vertical (in degrees, around a centre) and a shift
+def rigid_transform(angle, centre, shift):
+    a = np.radians(angle)
+    T = np.eye(4)
+    T[:3, :3] = [[np.cos(a), -np.sin(a), 0], [np.sin(a), np.cos(a), 0], [0, 0, 1]]
+    T[:3, 3] = centre - T[:3, :3] @ centre + shift
+    return T
+
+class ICPTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        x = rng.uniform(0, 100, 40000)
+        y = rng.uniform(0, 100, 40000)
+        self.reference = np.column_stack((x, y, 5*np.sin(x / 10)*np.cos(y / 13) + 0.05*x)) + [500000.0, 4000000.0, 100.0]
+        # (the source is a subset of the reference points away from its edges, moved by the inverse of a known transformation)
+        self.target = self.reference[np.flatnonzero((x > 5) & (x < 95) & (y > 5) & (y < 95))[::4]]
+        self.T = rigid_transform(1.0, self.target.mean(axis=0), [0.8, -0.5, 0.3])
+        self.source = transform_points(self.target, np.linalg.inv(self.T))
+
+    def test_point_to_point_transform(self):
+        T = point_to_point_transform(self.source, self.target)
+        np.testing.assert_allclose(transform_points(self.source, T), self.target, atol=1e-6)
+
+    def test_icp(self):
+        for mode in ('point_to_point', 'point_to_plane'):
+            (T, rms, iterations) = icp(self.source, self.reference, mode=mode, seed=0)
+            self.assertLess(rms, 1e-6)
+            np.testing.assert_allclose(T[:3, :3], self.T[:3, :3], atol=1e-8)
+            np.testing.assert_allclose(transform_points(self.source, T), self.target, atol=1e-6)
+
+    def test_initial(self):
+        # (starting from the answer, there is nothing left to do)
+        (T, rms, iterations) = icp(self.source, self.reference, initial=self.T, seed=0)
+        self.assertLessEqual(iterations, 2)
+        np.testing.assert_allclose(transform_points(self.source, T), self.target, atol=1e-6)
+
+    def test_pyramid_icp(self):
+        self.assertEqual(pyramid_levels(3), [2.0, 1.0, None])
+        (T, rms, iterations) = pyramid_icp(self.source, self.reference, pyramid_levels(3), seed=0)
+        self.assertLess(rms, 1e-6)
+        np.testing.assert_allclose(transform_points(self.source, T), self.target, atol=1e-6)
+
+    def test_mode(self):
+        self.assertRaises(ValueError, icp, self.source, self.reference, mode='plane_to_plane')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import sys, os
+import unittest
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Scripts'))
+import polynomial
+from polynomial import PolyNormalEquations, poly_terms, polyfit2d, polyval2d, polygrid2d
+
+# Tests of the polynomial surface models (polynomial.py) against known answers: the Horner and separable evaluations against
+# the sum of the terms, and fits (plain, chunked, merged and robust) of data drawn from a known polynomial.  Run from the root
+# of the repository with:
+#   python -m unittest discover tests       (or python -m pytest tests)
+
+# Function to evaluate a polynomial model term by term (the definition the faster evaluations must agree with)
+def sum_of_terms(x, y, m):
+    order = polynomial.poly_order(m)
+    return sum(m[k] * x**i * y**j for (k, (i, j)) in enumerate(poly_terms(order)))
+
+class PolynomialTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # (an order 3 model whose terms are all about as large as each other over the domain)
+        self.m = rng.standard_normal(16) / np.array([500.0**i * 300.0**j for (i, j) in poly_terms(3)])
+        self.x = rng.uniform(0, 500, 5000)
+        self.y = rng.uniform(0, 300, 5000)
+
+    def test_polyval2d(self):
+        np.testing.assert_allclose(polyval2d(self.x, self.y, self.m), sum_of_terms(self.x, self.y, self.m), rtol=1e-10)
+
+    def test_polygrid2d(self):
+        # (rows are ys and columns are xs, as on a raster)
+        xs = np.linspace(0, 500, 37)
+        ys = np.linspace(300, 0, 23)
+        zz = polygrid2d(xs, ys, self.m, dtype=np.float64)
+        self.assertEqual(zz.shape, (len(ys), len(xs)))
+        (X, Y) = np.meshgrid(xs, ys)
+        np.testing.assert_allclose(zz, polyval2d(X, Y, self.m), rtol=1e-10)
+
+    def test_polyfit2d(self):
+        z = sum_of_terms(self.x, self.y, self.m)
+        np.testing.assert_allclose(polyval2d(self.x, self.y, polyfit2d(self.x, self.y, z, 3)), z, atol=1e-8)
+
+    def test_chunked_and_merged(self):
+        # (the normal equations built in small chunks, and from separate halves of the data, give the direct least squares fit)
+        rng = np.random.default_rng(1)
+        z = sum_of_terms(self.x, self.y, self.m) + rng.standard_normal(len(self.x))
+        G = np.column_stack([self.x**i * self.y**j for (i, j) in poly_terms(2)])
+        direct = np.linalg.lstsq(G, z, rcond=None)[0]
+
+        scale = (500.0, 300.0)
+        chunk_size = polynomial.chunk_size
+        polynomial.chunk_size = 333
+        try:
+            whole = PolyNormalEquations(2, scale)
+            whole.add(self.x, self.y, z)
+            halves = [PolyNormalEquations(2, scale) for k in range(2)]
+            halves[0].add(self.x[:2000], self.y[:2000], z[:2000])
+            halves[1].add(self.x[2000:], self.y[2000:], z[2000:])
+        finally:
+            polynomial.chunk_size = chunk_size
+        halves[0].merge(halves[1])
+        self.assertEqual(halves[0].n, len(z))
+        np.testing.assert_allclose(whole.solve(), direct, rtol=1e-6, atol=1e-12)
+        np.testing.assert_allclose(halves[0].solve(), direct, rtol=1e-6, atol=1e-12)
+
+    def test_robust(self):
+        # (a tenth of the points are far off the surface, which skews an ordinary fit but not a robust one)
+        m = np.array([2.0, 0.01, 0.02, 0.0])
+        z = sum_of_terms(self.x, self.y, m)
+        z[::10] += 20.0
+        ordinary = polyfit2d(self.x, self.y, z, 1)
+        robust = polyfit2d(self.x, self.y, z, 1, robust=True)
+        self.assertGreater(abs(ordinary[0] - 2.0), 1.0)
+        np.testing.assert_allclose(robust, m, atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import sys, os
+import unittest
+import numpy as np
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Scripts'))
+from thinning import CellSelector, thin_index, voxel_thin
+
+# Tests of the thinning of point clouds (thinning.py) against known answers: the point kept in each cell is the one closest
+# to its centre, whether the points are added at once or in chunks, and voxel thinning keeps the centroid of each voxel.
+# Run from the root of the repository with:
+#   python -m unittest discover tests       (or python -m pytest tests)
+
+class ThinningTest(unittest.TestCase):
+
+    def test_cell_selector(self):
+        # (cells of 1 x 1 map units from the origin; the second chunk has a point closer to the centre of the first cell)
+        selector = CellSelector(1.0, (0.0, 0.0), (2.0, 1.0))
+        selector.add(np.array([[0.1, 0.1], [0.4, 0.6], [1.5, 0.9], [1.2, 0.5]]))
+        np.testing.assert_array_equal(selector.selected(), [1, 3])
+        selector.add(np.array([[0.5, 0.5], [1.9, 0.1], [2.0, 0.2]]))
+        np.testing.assert_array_equal(selector.selected(), [3, 4, 6])
+
+    def test_voxel_cells(self):
+        # (the same choice in 3D, where the height counts towards the distance to the centre of the voxel; the voxels are
+        # anchored at the lowest coordinates of the points)
+        points = np.array([[0.0, 0.0, 0.0], [0.5, 0.5, 0.9], [0.6, 0.4, 0.6], [0.5, 0.5, 1.5], [0.9, 0.9, 1.1]])
+        np.testing.assert_array_equal(thin_index(points, 'voxel', voxel_size=1.0), [2, 3])
+
+    def test_thin_index(self):
+        # (at most one point is kept per cell, it is the closest one to the centre of the cell, and adding the points in
+        # chunks keeps the same points)
+        rng = np.random.default_rng(0)
+        points = np.column_stack((rng.uniform(100, 120, 20000), rng.uniform(50, 60, 20000), rng.uniform(0, 5, 20000)))
+        keep = thin_index(points, 'density', density=4)
+        size = 0.5
+        cells = np.floor((points[:, :2] - points[:, :2].min(axis=0)) / size)
+        distance = np.sum(((points[:, :2] - points[:, :2].min(axis=0)) / size - cells - 0.5)**2, axis=1)
+        key = cells[:, 0] * 1000 + cells[:, 1]
+        self.assertEqual(len(keep), len(np.unique(key)))
+        for k in keep[:200]:
+            self.assertEqual(distance[k], distance[key == key[k]].min())
+
+        selector = CellSelector(size, points[:, :2].min(axis=0), points[:, :2].max(axis=0))
+        for start in range(0, len(points), 3000):
+            selector.add(points[start:start+3000, :2])
+        np.testing.assert_array_equal(selector.selected(), keep)
+
+    def test_voxel_thin(self):
+        points = np.array([[0.1, 0.1, 0.1], [0.3, 0.1, 0.2], [0.2, 0.4, 0.0], [1.1, 0.1, 0.1]])
+        thinned = voxel_thin(points, 0.5)
+        np.testing.assert_allclose(thinned[np.argsort(thinned[:, 0])], [[0.2, 0.2, 0.1], [1.1, 0.1, 0.1]])
+
+if __name__ == '__main__':
+    unittest.main()